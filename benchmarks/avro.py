@@ -0,0 +1,160 @@
+import os
+import time
+import logging
+import argparse
+
+from confluent_kafka.serialization import (
+    StringSerializer,
+    SerializationContext,
+    MessageField,
+)
+from confluent_kafka.schema_registry.avro import AvroSerializer
+
+from utils import (
+    generate_serial_number,
+    get_locations,
+    set_logging_handler,
+)
+from utils.payload import compile_payload
+from utils.avro import AvroValueSerializer
+
+
+TOPIC = "benchmark"
+
+
+class SchemaRegistryStub:
+    # Stand-in of SchemaRegistryClient.register_schema, no Schema Registry needed
+    def register_schema(
+        self,
+        subject_name: str,
+        schema,
+        normalize_schemas: bool = False,
+    ) -> int:
+        return 1
+
+
+def get_records(
+    locations: list,
+    count: int,
+) -> list:
+    build = compile_payload(
+        manufacturer="KafkaTemp",
+        dev_family="K1",
+        location_key="region",
+        lat_key="lat",
+        lng_key="lng",
+        temperature_key="temperature",
+        manufacturer_key="manufacturer",
+        dev_family_key="product",
+        timestamp_key="datetime",
+        serial_number_key="id",
+        _timestamp_epoch=False,
+    )
+    result = list()
+    for n in range(count):
+        location = locations[n % len(locations)]
+        result.append(
+            build(
+                20 + n / 1000,
+                generate_serial_number(n, "*Kafka"),
+                location["city"],
+                location["lat"],
+                location["lng"],
+            )
+        )
+    return result
+
+
+def run_avro_serializer(
+    schema_str: str,
+    records: list,
+    messages: int,
+) -> tuple:
+    # iot_kafka.py as it was
+    avro_serializer = AvroSerializer(
+        SchemaRegistryStub(),
+        schema_str=schema_str,
+    )
+    string_serializer = StringSerializer("utf_8")
+    result = list()
+    start = time.perf_counter()
+    for n in range(messages):
+        record = records[n % len(records)]
+        string_serializer(record["id"])
+        result.append(
+            avro_serializer(
+                record,
+                SerializationContext(
+                    TOPIC,
+                    MessageField.VALUE,
+                ),
+            )
+        )
+    return (time.perf_counter() - start) * 1e6 / messages, result
+
+
+def run_value_serializer(
+    schema_str: str,
+    records: list,
+    messages: int,
+    compiled: bool = True,
+) -> tuple:
+    avro_serializer = AvroValueSerializer(
+        SchemaRegistryStub(),
+        schema_str,
+        TOPIC,
+        compiled=compiled,
+    )
+    # Keys encoded once (at device creation)
+    keys = [record["id"].encode("utf-8") for record in records]
+    result = list()
+    start = time.perf_counter()
+    for n in range(messages):
+        keys[n % len(records)]
+        result.append(avro_serializer(records[n % len(records)]))
+    return (time.perf_counter() - start) * 1e6 / messages, result
+
+
+if __name__ == "__main__":
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
+
+    parser = argparse.ArgumentParser(
+        description="iot_kafka.py key/value encoding: AvroSerializer vs AvroValueSerializer (µs/record)"
+    )
+    parser.add_argument(
+        "--messages",
+        type=int,
+        default=200000,
+        help="Number of records (default: 200000)",
+    )
+    parser.add_argument(
+        "--schema-file",
+        default=os.path.join("schemas", "iot_kafka.avro"),
+        help="Avro schema file (default: schemas/iot_kafka.avro)",
+    )
+    parser.add_argument(
+        "--location-data",
+        default=os.path.join("config", "uk_coordinates.json"),
+        help="Location data file (default: config/uk_coordinates.json)",
+    )
+    args = parser.parse_args()
+
+    with open(args.schema_file, "r") as f:
+        schema_str = f.read()
+    records = get_records(get_locations(args.location_data), 1000)
+
+    old, old_result = run_avro_serializer(schema_str, records, args.messages)
+    for name, compiled in (
+        ("fastavro.schemaless_writer", False),
+        ("compiled encoder", True),
+    ):
+        new, new_result = run_value_serializer(
+            schema_str,
+            records,
+            args.messages,
+            compiled=compiled,
+        )
+        logging.info(
+            f"AvroSerializer {old:.2f} µs/record, AvroValueSerializer ({name}) {new:.2f} µs/record ({old / new:.1f}x), identical output: {old_result == new_result}"
+        )
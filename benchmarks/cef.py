@@ -0,0 +1,215 @@
+import os
+import math
+import time
+import random
+import logging
+import argparse
+
+from cefevent import CEFEvent
+
+from utils import (
+    get_locations,
+    set_logging_handler,
+)
+from utils.cef import SEVERITY_NAMES
+from iot_syslog import (
+    get_cef_encoder,
+    get_cef_header,
+)
+
+
+# Characters escaped (or stripped) by cefevent, plus non ASCII ones
+SPECIAL_CHARS = "\\|=\n\r\t =é°€ "
+
+
+def cef_message(
+    device_vendor: str,
+    device_product: str,
+    device_serial_number: str,
+    severity: int,
+    signature_id: int,
+    location: str,
+    lat: float,
+    lng: float,
+    temperature: float,
+    unit: str,
+) -> str:
+    # iot_syslog.py as it was: a CEFEvent per message
+    c = CEFEvent(strict=True)
+    c.set_field("version", "0")
+    c.set_field("name", "Telemetry")
+    c.set_field("deviceVendor", device_vendor)
+    c.set_field("deviceProduct", device_product)
+    c.set_field("deviceVersion", device_serial_number)
+    c.set_field("signatureId", str(signature_id))
+    c.set_field("severity", severity)
+    c.set_field("deviceCustomFloatingPoint1", temperature)
+    c.set_field("deviceCustomFloatingPoint1Label", unit)
+    c.set_field("deviceCustomFloatingPoint2", lat)
+    c.set_field("deviceCustomFloatingPoint2Label", "lat")
+    c.set_field("deviceCustomFloatingPoint3", lng)
+    c.set_field("deviceCustomFloatingPoint3Label", "lon")
+    c.set_field("deviceDirection", location)
+    return c.build_cef()
+
+
+def random_string(rnd: random.Random) -> str:
+    return "".join(
+        rnd.choice(SPECIAL_CHARS) if rnd.random() < 0.3 else chr(rnd.randint(33, 126))
+        for _ in range(rnd.randint(0, 12))
+    )
+
+
+def random_float(rnd: random.Random):
+    return rnd.choice(
+        (
+            rnd.uniform(-1000, 1000),
+            round(rnd.uniform(-100, 100), 4),
+            rnd.randint(-10, 10),
+            0.0,
+            -0.0,
+            math.inf,
+            math.nan,
+            1e-300,
+            str(rnd.uniform(-10, 10)),
+            "not a float",
+            None,
+        )
+    )
+
+
+def check(
+    cases: int,
+    seed: int,
+) -> int:
+    # CEFEncoder output is the same as cefevent's for random inputs, both
+    # raising ValueError for the same invalid ones. Returns the mismatches
+    rnd = random.Random(seed)
+    mismatches = 0
+    encoders = dict()
+    for _ in range(cases):
+        unit = random_string(rnd)
+        args = (
+            random_string(rnd),
+            random_string(rnd),
+            random_string(rnd),
+            rnd.choice((5, rnd.randint(-2, 12), rnd.choice(SEVERITY_NAMES), "3", 7.0)),
+            rnd.choice((100, rnd.randint(0, 1000))),
+            random_string(rnd),
+            random_float(rnd),
+            random_float(rnd),
+            random_float(rnd),
+        )
+        try:
+            expected = cef_message(*args[:8], args[8], unit)
+        except ValueError:
+            expected = ValueError
+        try:
+            if unit not in encoders:
+                encoders[unit] = get_cef_encoder(unit).encode
+            (
+                device_vendor,
+                device_product,
+                device_serial_number,
+                severity,
+                signature_id,
+                location,
+                lat,
+                lng,
+                temperature,
+            ) = args
+            result = encoders[unit](
+                get_cef_header(
+                    device_vendor,
+                    device_product,
+                    device_serial_number,
+                    signature_id,
+                ),
+                severity,
+                temperature,
+                lat,
+                lng,
+                location,
+            )
+        except ValueError:
+            result = ValueError
+        if result != expected:
+            mismatches += 1
+            logging.error(f"Mismatch for {args}, unit {unit!r}: {result!r} != {expected!r}")
+    return mismatches
+
+
+if __name__ == "__main__":
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
+
+    parser = argparse.ArgumentParser(
+        description="CEF events/sec: CEFEvent per message vs CEFEncoder (checking both give the same output first)"
+    )
+    parser.add_argument(
+        "--messages",
+        type=int,
+        default=100000,
+        help="Number of events per run (default: 100000)",
+    )
+    parser.add_argument(
+        "--cases",
+        type=int,
+        default=20000,
+        help="Random inputs compared (default: 20000)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=42,
+        help="Random seed of the inputs compared (default: 42)",
+    )
+    parser.add_argument(
+        "--location-data",
+        default=os.path.join("config", "uk_coordinates.json"),
+        help="Location data file (default: config/uk_coordinates.json)",
+    )
+    args = parser.parse_args()
+
+    mismatches = check(args.cases, args.seed)
+    logging.info(f"Random inputs compared: {args.cases}, mismatches: {mismatches}")
+
+    locations = get_locations(args.location_data)
+    serial_numbers = [f"{n:012x}" for n in range(25)]
+
+    start = time.perf_counter()
+    for n in range(args.messages):
+        location = locations[n % len(locations)]
+        cef_message(
+            "SysTemp",
+            "SysIotLog",
+            serial_numbers[n % 25],
+            5,
+            100,
+            location["city"],
+            location["lat"],
+            location["lng"],
+            20.1234,
+            "C",
+        )
+    rate = args.messages / (time.perf_counter() - start)
+    logging.info(f"CEFEvent: {rate:,.0f} events/sec")
+
+    encode = get_cef_encoder("C").encode
+    headers = [
+        get_cef_header("SysTemp", "SysIotLog", serial_number)
+        for serial_number in serial_numbers
+    ]
+    start = time.perf_counter()
+    for n in range(args.messages):
+        location = locations[n % len(locations)]
+        encode(
+            headers[n % 25],
+            5,
+            20.1234,
+            location["lat"],
+            location["lng"],
+            location["city"],
+        )
+    rate = args.messages / (time.perf_counter() - start)
+    logging.info(f"CEFEncoder: {rate:,.0f} events/sec")
@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+
+import aiocoap
+import aiocoap.resource as resource
+
+from confluent_kafka import Producer
+from logging.handlers import TimedRotatingFileHandler
+
+from utils import (
+    set_logging_handler,
+    telemetry,
+)
+from utils.payload import compile_payload
+from coap_server import (
+    SpoolWriter,
+    KafkaWriter,
+    TelemetryResource,
+    create_server,
+)
+
+
+COAP_HOST = "127.0.0.1"
+COAP_PATH = "telemetry"
+
+
+class HandlerTelemetryResource(resource.Resource):
+    # TelemetryResource as it was, with a TimedRotatingFileHandler per record
+    def __init__(
+        self,
+        logger,
+        encoding: str = "utf-8",
+    ):
+        super().__init__()
+        self.logger = logger
+        self.encoding = encoding
+
+    async def render_post(self, request):
+        try:
+            payload = json.loads(request.payload.decode(self.encoding))
+            if isinstance(payload, dict):
+                logging.info(
+                    f"{request.code} from {request.remote.uri} ({request.mid})"
+                )
+                self.logger.info(json.dumps(payload))
+                return aiocoap.Message(
+                    code=resource.numbers.codes.CONTENT,
+                    payload=b"OK",
+                )
+            else:
+                raise ValueError("Invalid payload, not JSON")
+        except Exception as err:
+            return aiocoap.Message(
+                code=resource.numbers.codes.BAD_REQUEST,
+                payload=str(err).encode(self.encoding),
+            )
+
+
+async def run(
+    telemetry_resource,
+    port: int,
+    requests: int,
+    concurrency: int,
+) -> tuple:
+    server = await create_server(
+        telemetry_resource,
+        COAP_HOST,
+        port,
+        COAP_PATH,
+    )
+    client = await aiocoap.Context.create_client_context()
+    build_payload = compile_payload(
+        manufacturer="CoAP",
+        dev_family="CPd",
+        location_key="pos",
+        lat_key="lat",
+        lng_key="long",
+        temperature_key="tmp",
+        manufacturer_key="manufacturer",
+        dev_family_key="family",
+        serial_number_key="sn",
+        _json=True,
+    )
+    uri = f"coap://{COAP_HOST}:{port}/{COAP_PATH}"
+    semaphore = asyncio.Semaphore(concurrency)
+    rejected = 0
+
+    async def request(n: int) -> None:
+        nonlocal rejected
+        async with semaphore:
+            response = await client.request(
+                aiocoap.Message(
+                    code=aiocoap.POST,
+                    payload=build_payload(20 + n % 10, f"{n:012x}", "London", 51.5072, -0.1275),
+                    uri=uri,
+                )
+            ).response
+            if not response.code.is_successful():
+                rejected += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(request(n) for n in range(requests)))
+    elapsed = time.perf_counter() - start
+
+    await client.shutdown()
+    await server.shutdown()
+    return requests / elapsed, rejected
+
+
+async def run_handler(
+    directory: str,
+    port: int,
+    requests: int,
+    concurrency: int,
+    **kwargs,
+) -> tuple:
+    handler = TimedRotatingFileHandler(
+        os.path.join(directory, COAP_PATH),
+        when="s",
+        interval=5,
+        backupCount=172800,
+        encoding="utf-8",
+        delay=False,
+    )
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger = logging.getLogger(f"{__name__}.handler")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        return await run(
+            HandlerTelemetryResource(logger),
+            port,
+            requests,
+            concurrency,
+        )
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+
+
+async def run_spool(
+    directory: str,
+    port: int,
+    requests: int,
+    concurrency: int,
+    **kwargs,
+) -> tuple:
+    writer = SpoolWriter(directory, COAP_PATH)
+    writer.start()
+    try:
+        return await run(
+            TelemetryResource(writer),
+            port,
+            requests,
+            concurrency,
+        )
+    finally:
+        await writer.close()
+
+
+async def run_kafka(
+    directory: str,
+    port: int,
+    requests: int,
+    concurrency: int,
+    queue_max_messages: int = 100000,
+    **kwargs,
+) -> tuple:
+    # librdkafka in-process mock cluster, no broker needed
+    producer = Producer(
+        {
+            "test.mock.num.brokers": 1,
+            "queue.buffering.max.messages": queue_max_messages,
+        }
+    )
+    writer = KafkaWriter(producer, COAP_PATH)
+    writer.start()
+    try:
+        return await run(
+            TelemetryResource(writer),
+            port,
+            requests,
+            concurrency,
+        )
+    finally:
+        await writer.close()
+
+
+def count_lines(directory: str) -> int:
+    result = 0
+    for file_name in os.listdir(directory):
+        with open(os.path.join(directory, file_name), "rb") as f:
+            result += f.read().count(b"\n")
+    return result
+
+
+if __name__ == "__main__":
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
+
+    parser = argparse.ArgumentParser(
+        description="coap_server.py requests/sec: TimedRotatingFileHandler vs SpoolWriter"
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=5000,
+        help="Number of requests per run (default: 5000)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=32,
+        help="Client requests in flight (default: 32)",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=56830,
+        help="CoAP server port (default: 56830)",
+    )
+    parser.add_argument(
+        "--kafka-queue",
+        type=int,
+        default=100000,
+        help="KafkaWriter queue.buffering.max.messages, set it below --requests to see 5.03 responses (default: 100000)",
+    )
+    args = parser.parse_args()
+
+    for name, runner in (
+        ("TimedRotatingFileHandler", run_handler),
+        ("SpoolWriter", run_spool),
+        ("KafkaWriter (mock)", run_kafka),
+    ):
+        with tempfile.TemporaryDirectory() as directory:
+            # Per request log lines are out of the measurement
+            logging.getLogger().setLevel(logging.WARNING)
+            telemetry.snapshot()
+            rate, rejected = asyncio.run(
+                runner(
+                    directory,
+                    args.port,
+                    args.requests,
+                    args.concurrency,
+                    queue_max_messages=args.kafka_queue,
+                )
+            )
+            stats = telemetry.snapshot()
+            logging.getLogger().setLevel(logging.INFO)
+            summary = f"{name:>24}: {rate:,.0f} requests/sec, {count_lines(directory)} records spooled, {stats['sent']} delivered, {rejected} rejected"
+            if "max" in stats:
+                summary += ", latency ms " + " ".join(
+                    f"{p}={stats[p] * 1000:.2f}" for p in ("p50", "p99", "max")
+                )
+            logging.info(summary)
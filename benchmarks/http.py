@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import argparse
+import threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from utils import (
+    set_logging_handler,
+    telemetry,
+)
+from iot_http import (
+    HTTPRestProxyClient,
+    AsyncHTTPRestProxyClient,
+)
+
+
+TOPIC = "benchmark"
+
+
+class RestProxyStub(BaseHTTPRequestHandler):
+    # Minimal stand-in of the Rest Proxy POST /topics/{topic} endpoint
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    delay = 0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.delay > 0:
+            time.sleep(self.delay)
+        response = json.dumps(
+            {
+                "offsets": [
+                    {
+                        "partition": 0,
+                        "offset": n,
+                        "error_code": None,
+                        "error": None,
+                    }
+                    for n in range(len(body["records"]))
+                ]
+            }
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.kafka.v2+json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    # Listen backlog of 128 instead of 5, not to have connections refused
+    # (and retried by the client after a delay) at high concurrency
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def run_sync(
+    base_url: str,
+    records: int,
+    batch_size: int,
+) -> None:
+    client = HTTPRestProxyClient(
+        base_url,
+        batch_size=batch_size,
+    )
+    for n in range(records):
+        client.produce_json(TOPIC, str(n), {"n": n})
+    client.close()
+
+
+async def run_async(
+    base_url: str,
+    records: int,
+    batch_size: int,
+    concurrency: int,
+) -> None:
+    client = AsyncHTTPRestProxyClient(
+        base_url,
+        batch_size=batch_size,
+        concurrency=concurrency,
+    )
+    await client.start()
+    for n in range(records):
+        await client.produce_json(TOPIC, str(n), {"n": n})
+    await client.close()
+
+
+def report(name: str) -> None:
+    stats = telemetry.snapshot()
+    logging.info(
+        f"{name:>16}: {stats['sent'] / stats['elapsed']:,.0f} records/sec, failed={stats['failed']}, latency ms p50={stats.get('p50', 0) * 1000:.2f} p99={stats.get('p99', 0) * 1000:.2f}"
+    )
+
+
+if __name__ == "__main__":
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP, sample_rate=0)
+
+    parser = argparse.ArgumentParser(
+        description="HTTP Rest Proxy client: sync vs async at several concurrency levels, against a local stub server"
+    )
+    parser.add_argument(
+        "--records",
+        type=int,
+        default=2000,
+        help="Number of records per run (default: 2000)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Records per request (default: 1)",
+    )
+    parser.add_argument(
+        "--delay-ms",
+        type=float,
+        default=5,
+        help="Stub server response delay, to emulate a slow Rest Proxy (default: 5)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        default="1,2,4,8,16,32",
+        help="Comma separated async concurrency levels (default: 1,2,4,8,16,32)",
+    )
+    args = parser.parse_args()
+
+    RestProxyStub.delay = args.delay_ms / 1000
+    server = StubServer(("127.0.0.1", 0), RestProxyStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    try:
+        telemetry.snapshot()
+        run_sync(base_url, args.records, args.batch_size)
+        report("sync")
+        for concurrency in [int(c) for c in args.concurrency.split(",")]:
+            telemetry.snapshot()
+            asyncio.run(
+                run_async(
+                    base_url,
+                    args.records,
+                    args.batch_size,
+                    concurrency,
+                )
+            )
+            report(f"async ({concurrency})")
+
+    finally:
+        server.shutdown()
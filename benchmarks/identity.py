@@ -0,0 +1,89 @@
+import os
+import time
+import logging
+import argparse
+import tempfile
+
+from utils import (
+    get_locations,
+    get_location_id,
+    get_temp_mu,
+    generate_serial_number,
+    set_logging_handler,
+)
+from utils.identity import get_identities
+
+
+SEED = "*Kafka"
+
+
+def per_device(
+    devices: int,
+    locations: list,
+) -> tuple:
+    # DeviceTable as it was: generate_serial_number() (SHA-256 hex digest and
+    # f-string), get_location_id() and get_temp_mu() (SHA-256 of the city,
+    # not memoized) per device
+    serial_numbers = list()
+    location_ids = list()
+    temp_mus = list()
+    for _id in range(devices):
+        serial_number = generate_serial_number(_id, SEED)
+        location_id = get_location_id(serial_number, locations)
+        serial_numbers.append(serial_number)
+        location_ids.append(location_id)
+        temp_mus.append(get_temp_mu.__wrapped__(locations[location_id]["city"]))
+    return serial_numbers, location_ids, temp_mus
+
+
+if __name__ == "__main__":
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
+
+    parser = argparse.ArgumentParser(
+        description="Device identities/sec: per device vs bulk generation vs loaded from the identity cache"
+    )
+    parser.add_argument(
+        "--devices",
+        type=int,
+        default=1000000,
+        help="Number of devices (default: 1000000)",
+    )
+    parser.add_argument(
+        "--location-data",
+        default=os.path.join("config", "uk_coordinates.json"),
+        help="Location data file (default: config/uk_coordinates.json)",
+    )
+    args = parser.parse_args()
+
+    locations = get_locations(args.location_data)
+
+    start = time.perf_counter()
+    expected = per_device(args.devices, locations)
+    elapsed = time.perf_counter() - start
+    logging.info(f"Per device: {elapsed:.2f}s ({args.devices / elapsed:,.0f} devices/sec)")
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for name, _cache_dir in (
+            ("Bulk", None),
+            ("Bulk, saved to the identity cache", cache_dir),
+            ("Loaded from the identity cache", cache_dir),
+        ):
+            start = time.perf_counter()
+            serial_numbers, location_ids = get_identities(
+                0,
+                args.devices,
+                SEED,
+                locations,
+                cache_dir=_cache_dir,
+            )
+            temp_mus = [get_temp_mu(locations[n]["city"]) for n in location_ids]
+            elapsed = time.perf_counter() - start
+            identical = (
+                serial_numbers == expected[0]
+                and list(location_ids) == expected[1]
+                and temp_mus == expected[2]
+            )
+            logging.info(
+                f"{name}: {elapsed:.2f}s ({args.devices / elapsed:,.0f} devices/sec), identical: {identical}"
+            )
@@ -0,0 +1,166 @@
+import os
+import time
+import logging
+import argparse
+
+from confluent_kafka import Producer
+
+from utils import (
+    set_logging_handler,
+    telemetry,
+)
+from utils.payload import compile_payload
+from iot_kafka import (
+    PRODUCER_PROFILES,
+    DeliveryPoller,
+    delivery_report,
+    get_producer_config,
+)
+
+
+TOPIC = "benchmark"
+
+# librdkafka in-process mock cluster, no broker needed
+MOCK_CONFIG = {
+    "test.mock.num.brokers": 1,
+    "log_level": 3,
+}
+
+
+def get_values(count: int) -> list:
+    build = compile_payload(
+        manufacturer="KafkaTemp",
+        dev_family="K1",
+        location_key="region",
+        lat_key="lat",
+        lng_key="lng",
+        temperature_key="temperature",
+        manufacturer_key="manufacturer",
+        dev_family_key="product",
+        timestamp_key="datetime",
+        serial_number_key="id",
+        _timestamp_epoch=False,
+        _json=True,
+    )
+    return [
+        build(20 + n / 1000, f"{n:012x}", "London", 51.5072, -0.1275)
+        for n in range(count)
+    ]
+
+
+def warm_up(
+    producer: Producer,
+    value: bytes,
+) -> None:
+    # Broker connection, topic metadata and first batch out of the
+    # measurement (one record produced and flushed, not accounted)
+    producer.produce(topic=TOPIC, value=value)
+    producer.flush()
+
+
+def run_poll(
+    values: list,
+    messages: int,
+) -> float:
+    # iot_kafka.py as it was: producer.poll(0) before every record on the
+    # main thread and a delivery callback per record
+    producer = Producer(dict(MOCK_CONFIG))
+    warm_up(producer, values[0])
+    start = time.perf_counter()
+    for n in range(messages):
+        producer.poll(0)
+        while True:
+            try:
+                producer.produce(
+                    topic=TOPIC,
+                    value=values[n % len(values)],
+                    on_delivery=delivery_report,
+                )
+                break
+            except BufferError:
+                producer.poll(0.01)
+    producer.flush()
+    return messages / (time.perf_counter() - start)
+
+
+def run_poller(
+    values: list,
+    messages: int,
+    profile: str = None,
+    batch_accounting: bool = False,
+) -> float:
+    producer = Producer(
+        get_producer_config(
+            MOCK_CONFIG,
+            profile=profile,
+            batch_accounting=batch_accounting,
+        )
+    )
+    warm_up(producer, values[0])
+    poller = DeliveryPoller(
+        producer,
+        batch_accounting=batch_accounting,
+    )
+    poller.start()
+    start = time.perf_counter()
+    for n in range(messages):
+        value = values[n % len(values)]
+        while True:
+            try:
+                producer.produce(
+                    topic=TOPIC,
+                    value=value,
+                    on_delivery=poller.on_delivery,
+                )
+                break
+            except BufferError:
+                # Queue full, wait for the poller thread to drain it
+                time.sleep(0.01)
+        poller.produced(len(value))
+    poller.close()
+    return messages / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
+    # Per record logs are out of the measurement
+    telemetry.sample_rate = 0
+
+    parser = argparse.ArgumentParser(
+        description="iot_kafka.py producer: records/sec per profile and delivery accounting mode (librdkafka mock cluster)"
+    )
+    parser.add_argument(
+        "--messages",
+        type=int,
+        default=500000,
+        help="Number of records per run (default: 500000)",
+    )
+    args = parser.parse_args()
+
+    values = get_values(1000)
+
+    def report(
+        name: str,
+        rate: float,
+    ) -> None:
+        stats = telemetry.snapshot()
+        summary = f"{name:>38}: {rate:,.0f} records/sec, delivered={stats['sent']} failed={stats['failed']}"
+        if "max" in stats:
+            summary += f", latency ms p50={stats['p50'] * 1000:.2f} p99={stats['p99'] * 1000:.2f}"
+        logging.info(summary)
+
+    telemetry.snapshot()
+    report("poll(0) per record (callback)", run_poll(values, args.messages))
+    for profile in (None,) + tuple(PRODUCER_PROFILES):
+        for batch_accounting in (False, True):
+            rate = run_poller(
+                values,
+                args.messages,
+                profile=profile,
+                batch_accounting=batch_accounting,
+            )
+            report(
+                f"{profile or 'default'} ({'batch' if batch_accounting else 'callback'})",
+                rate,
+            )
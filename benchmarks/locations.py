@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from utils import (
+    get_locations,
+    set_logging_handler,
+)
+from utils.devices import DeviceTable
+from utils.locations import compile_locations
+
+
+SEED = "*Kafka"
+
+
+def generate_locations(
+    rows: int,
+    seed: int,
+) -> list:
+    # World sized location data: `rows` cities over ~200 countries
+    rnd = random.Random(seed)
+    countries = [f"Country {n}" for n in range(200)]
+    return [
+        {
+            "city": f"City {n}",
+            "lat": round(rnd.uniform(-90, 90), 4),
+            "lng": round(rnd.uniform(-180, 180), 4),
+            "country": rnd.choice(countries),
+        }
+        for n in range(rows)
+    ]
+
+
+def get_rss_mb() -> tuple:
+    # (peak RSS, private RSS) in MB. ru_maxrss is inherited from the parent
+    # across exec on Linux, VmHWM is not. Memory mapped (file backed) pages
+    # of the location store are shared by all the processes, RssAnon is what
+    # each process holds on its own
+    status = dict()
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                status[name] = value
+    except FileNotFoundError:
+        pass
+    if "VmHWM" in status:
+        return (
+            int(status["VmHWM"].split()[0]) / 1024,
+            int(status["RssAnon"].split()[0]) / 1024,
+        )
+    # KiB on Linux, bytes on macOS
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return max_rss_mb, max_rss_mb
+
+
+def startup(
+    location_data_file: str,
+    devices: int,
+) -> dict:
+    # What a simulator does on start: load the location data and build its
+    # DeviceTable
+    start = time.perf_counter()
+    table = DeviceTable(
+        devices,
+        SEED,
+        location_data_file,
+    )
+    elapsed = time.perf_counter() - start
+    max_rss_mb, private_rss_mb = get_rss_mb()
+    return {
+        "seconds": elapsed,
+        "max_rss_mb": max_rss_mb,
+        "private_rss_mb": private_rss_mb,
+        "locations": [table.location(_id) for _id in range(devices)],
+    }
+
+
+def run_child(
+    location_data_file: str,
+    devices: int,
+) -> dict:
+    # Fresh process, nothing cached
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.locations",
+            "--child",
+            location_data_file,
+            "--devices",
+            str(devices),
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output)
+
+
+if __name__ == "__main__":
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
+
+    parser = argparse.ArgumentParser(
+        description="Simulator startup time and peak RSS: JSON location data vs location store (synthetic world sized dataset)"
+    )
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=3000000,
+        help="Number of locations (default: 3000000)",
+    )
+    parser.add_argument(
+        "--devices",
+        type=int,
+        default=25,
+        help="Number of devices per simulator (default: 25)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=42,
+        help="Random seed of the locations (default: 42)",
+    )
+    parser.add_argument(
+        "--child",
+        help=argparse.SUPPRESS,
+    )
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(startup(args.child, args.devices)))
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        json_file = os.path.join(tmp_dir, "locations.json")
+        store_file = os.path.join(tmp_dir, "locations.bin")
+        locations = generate_locations(args.rows, args.seed)
+        with open(json_file, "w") as f:
+            f.write(json.dumps(locations))
+        start = time.perf_counter()
+        compile_locations(locations, store_file)
+        logging.info(
+            f"{args.rows:,} locations, JSON: {os.path.getsize(json_file) / 2**20:.0f} MB, store: {os.path.getsize(store_file) / 2**20:.0f} MB (compiled in {time.perf_counter() - start:.2f}s)"
+        )
+        del locations
+
+        store = get_locations(store_file)
+        identical = len(store) == args.rows and all(
+            a == b for a, b in zip(get_locations(json_file), store)
+        )
+        logging.info(f"Store rows identical to JSON: {identical}")
+        del store
+
+        results = dict()
+        for name, location_data_file in (
+            ("JSON", json_file),
+            ("Store", store_file),
+        ):
+            results[name] = run_child(location_data_file, args.devices)
+            logging.info(
+                f"{name}: startup {results[name]['seconds']:.3f}s, peak RSS {results[name]['max_rss_mb']:.0f} MB, private RSS {results[name]['private_rss_mb']:.0f} MB"
+            )
+        logging.info(
+            f"Device locations identical: {results['JSON']['locations'] == results['Store']['locations']}"
+        )
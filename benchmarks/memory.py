@@ -0,0 +1,112 @@
+import os
+import gc
+import logging
+import argparse
+import tracemalloc
+
+from utils import (
+    get_delta,
+    get_details,
+    get_locations,
+    get_next_interval,
+    set_logging_handler,
+)
+from utils.devices import DeviceTable
+from utils.scheduler import DeviceScheduler
+
+
+SEED = "*Kafka"
+MIN_ITERVAL_MS = 5000
+MAX_ITERVAL_MS = 10000
+
+
+def dict_layout(
+    devices: int,
+    location_data_file: str,
+) -> dict:
+    # Device cache as originally kept by every iot_*.py simulator
+    result = dict()
+    for _id in range(devices):
+        serial_number, location, temp_mu, temp_sigma = get_details(
+            _id,
+            SEED,
+            location_data_file,
+        )
+        result[_id] = {
+            "serial_number": serial_number,
+            "temperature": get_delta(temp_mu, temp_sigma),
+            "last_sent": get_next_interval(
+                MIN_ITERVAL_MS,
+                MAX_ITERVAL_MS,
+            ),
+            "location": location,
+        }
+    return result
+
+
+def table_layout(
+    devices: int,
+    location_data_file: str,
+) -> tuple:
+    scheduler = DeviceScheduler(
+        MIN_ITERVAL_MS,
+        MAX_ITERVAL_MS,
+    )
+    table = DeviceTable(
+        devices,
+        SEED,
+        location_data_file,
+    )
+    for _id in range(devices):
+        scheduler.add(_id)
+    return (
+        table,
+        scheduler,
+    )
+
+
+def measure(
+    layout,
+    devices: int,
+    location_data_file: str,
+) -> int:
+    gc.collect()
+    tracemalloc.start()
+    data = layout(devices, location_data_file)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del data
+    return size
+
+
+if __name__ == "__main__":
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
+
+    parser = argparse.ArgumentParser(
+        description="Memory used per simulated device: dict of dicts vs DeviceTable"
+    )
+    parser.add_argument(
+        "--devices",
+        type=int,
+        default=100000,
+        help="Number of simulated devices (default: 100000)",
+    )
+    parser.add_argument(
+        "--location-data",
+        default=os.path.join("config", "uk_coordinates.json"),
+        help="Location data file (default: config/uk_coordinates.json)",
+    )
+    args = parser.parse_args()
+
+    # Locations are shared by both layouts, load them before tracing
+    get_locations(args.location_data)
+
+    for name, layout in (
+        ("dict", dict_layout),
+        ("table", table_layout),
+    ):
+        size = measure(layout, args.devices, args.location_data)
+        logging.info(
+            f"{name:>5} layout: {args.devices} devices, {size / 1024 / 1024:.1f} MiB, {size / args.devices:.1f} bytes/device"
+        )
@@ -0,0 +1,213 @@
+import os
+import time
+import asyncio
+import logging
+import argparse
+import threading
+
+import paho.mqtt.client as mqtt
+
+from utils import (
+    set_logging_handler,
+    telemetry,
+)
+from iot_mqtt import MQTTConnection
+
+
+HOST = "127.0.0.1"
+TOPIC = "python/mqtt/PicoQ/Q1/{}"
+MESSAGE = b'{"epoch": "2024-04-08T10:55:36.000Z", "temperature": 71.2345, "location": "London", "latitude": 51.5072, "longitude": -0.1275, "unit": "F"}'
+
+
+class BrokerStub:
+    # Minimal MQTT 3.1.1 broker stand-in: acknowledges CONNECT, PUBLISH (QoS
+    # 1/2), PUBREL and PINGREQ, after `delay` seconds, messages are dropped
+    def __init__(
+        self,
+        delay: float = 0,
+    ) -> None:
+        self.delay = delay
+
+    def _ack(
+        self,
+        writer: asyncio.StreamWriter,
+        packet: bytes,
+    ) -> None:
+        if self.delay > 0:
+            asyncio.get_running_loop().call_later(self.delay, writer.write, packet)
+        else:
+            writer.write(packet)
+
+    async def handle(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        try:
+            while True:
+                header = (await reader.readexactly(1))[0]
+                # Remaining length (variable length encoding)
+                length, shift = 0, 0
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length)
+                command = header >> 4
+                if command == 1:
+                    writer.write(b"\x20\x02\x00\x00")
+                elif command == 3:
+                    qos = (header >> 1) & 0x03
+                    if qos:
+                        topic_length = int.from_bytes(body[:2], "big")
+                        packet_id = body[2 + topic_length : 4 + topic_length]
+                        self._ack(writer, (b"\x40\x02" if qos == 1 else b"\x50\x02") + packet_id)
+                elif command == 6:
+                    self._ack(writer, b"\x70\x02" + body[:2])
+                elif command == 12:
+                    writer.write(b"\xd0\x00")
+                elif command == 14:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def run_thread(
+    port: int,
+    messages: int,
+    qos: int,
+) -> float:
+    # iot_mqtt.py as it was: publish() from the main thread, paho network
+    # loop on its own thread (loop_start)
+    published = threading.Semaphore(0)
+    client = mqtt.Client(
+        mqtt.CallbackAPIVersion.VERSION2,
+        client_id="benchmark-thread",
+    )
+    client.on_publish = lambda *args: published.release()
+    client.connect(HOST, port=port)
+    client.loop_start()
+    start = time.perf_counter()
+    for n in range(messages):
+        client.publish(TOPIC.format(n % 1000), MESSAGE, qos=qos)
+    for _ in range(messages):
+        published.acquire()
+    elapsed = time.perf_counter() - start
+    client.disconnect()
+    client.loop_stop()
+    return messages / elapsed
+
+
+async def run_async(
+    port: int,
+    messages: int,
+    qos: int,
+    connections: int,
+    max_inflight: int,
+) -> float:
+    pool = [
+        MQTTConnection(
+            HOST,
+            port,
+            f"benchmark-{n}",
+            60,
+            qos=qos,
+            max_inflight=max_inflight,
+        )
+        for n in range(connections)
+    ]
+    for connection in pool:
+        await connection.connect()
+    while not all(connection.is_connected() for connection in pool):
+        await asyncio.sleep(0.01)
+    start = time.perf_counter()
+    for n in range(messages):
+        await pool[n % connections].publish(TOPIC.format(n % 1000), MESSAGE)
+    for connection in pool:
+        await connection.close(timeout=60)
+    return messages / (time.perf_counter() - start)
+
+
+async def main(args) -> None:
+    broker = BrokerStub(delay=args.delay_ms / 1000)
+    server = await asyncio.start_server(broker.handle, HOST, 0)
+    port = server.sockets[0].getsockname()[1]
+
+    for qos in args.qos:
+        telemetry.snapshot()
+        rate = await asyncio.get_running_loop().run_in_executor(
+            None,
+            run_thread,
+            port,
+            args.messages,
+            qos,
+        )
+        logging.info(f"QoS {qos}, loop_start thread: {rate:,.0f} msgs/sec")
+        for connections in args.connections:
+            for max_inflight in args.max_inflight:
+                telemetry.snapshot()
+                rate = await run_async(
+                    port,
+                    args.messages,
+                    qos,
+                    connections,
+                    max_inflight,
+                )
+                stats = telemetry.snapshot()
+                logging.info(
+                    f"QoS {qos}, asyncio {connections} connections, {max_inflight} in flight: {rate:,.0f} msgs/sec, published={stats['sent']} failed={stats['failed']}, latency ms p50={stats.get('p50', 0) * 1000:.2f} p99={stats.get('p99', 0) * 1000:.2f}"
+                )
+
+    server.close()
+    await server.wait_closed()
+
+
+if __name__ == "__main__":
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
+    # Per message logs are out of the measurement
+    telemetry.sample_rate = 0
+
+    parser = argparse.ArgumentParser(
+        description="iot_mqtt.py msgs/sec against a local stub broker: loop_start thread vs asyncio connection pool"
+    )
+    parser.add_argument(
+        "--messages",
+        type=int,
+        default=50000,
+        help="Number of messages per run (default: 50000)",
+    )
+    parser.add_argument(
+        "--qos",
+        type=int,
+        nargs="+",
+        default=[0, 1, 2],
+        help="QoS levels (default: 0 1 2)",
+    )
+    parser.add_argument(
+        "--connections",
+        type=int,
+        nargs="+",
+        default=[1, 4],
+        help="Connection pool sizes (default: 1 4)",
+    )
+    parser.add_argument(
+        "--max-inflight",
+        type=int,
+        nargs="+",
+        default=[20, 200],
+        help="In flight windows (default: 20 200)",
+    )
+    parser.add_argument(
+        "--delay-ms",
+        type=float,
+        default=1,
+        help="Stub broker delay acknowledging each message, in milliseconds (default: 1)",
+    )
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import logging
+import argparse
+
+from utils import (
+    generate_payload,
+    get_locations,
+    set_logging_handler,
+)
+from utils.payload import compile_payload
+
+
+# Payload layouts (and serialisation) of each iot_*.py simulator. iot_syslog.py
+# is not here: it sends CEF messages, not built by compile_payload (see
+# benchmarks/cef.py)
+LAYOUTS = {
+    "kafka": (
+        False,
+        {
+            "manufacturer": "KafkaTemp",
+            "dev_family": "K1",
+            "location_key": "region",
+            "lat_key": "lat",
+            "lng_key": "lng",
+            "temperature_key": "temperature",
+            "manufacturer_key": "manufacturer",
+            "dev_family_key": "product",
+            "timestamp_key": "datetime",
+            "serial_number_key": "id",
+            "_timestamp_epoch": False,
+        },
+    ),
+    "http": (
+        False,
+        {
+            "manufacturer": "KafkaHttpTemp",
+            "dev_family": "Kh1",
+            "location_key": "loc",
+            "lat_key": "lt",
+            "lng_key": "lg",
+            "temperature_key": "temp",
+            "manufacturer_key": "mnf",
+            "dev_family_key": "prd",
+            "timestamp_key": "tm",
+            "serial_number_key": "sn",
+        },
+    ),
+    "mqtt": (
+        True,
+        {
+            "unit": "F",
+            "temperature_key": "temperature",
+            "location_key": "location",
+            "lat_key": "latitude",
+            "lng_key": "longitude",
+            "timestamp_key": "epoch",
+            "serial_number_key": None,
+            "_timestamp_epoch": False,
+        },
+    ),
+    "rabbitmq": (
+        True,
+        {
+            "manufacturer": "RMQ",
+            "dev_family": "sx",
+            "location_key": "region",
+            "lat_key": "lat",
+            "lng_key": "lon",
+            "temperature_key": "temp",
+            "manufacturer_key": "provider",
+            "dev_family_key": "product",
+            "serial_number_key": "serno",
+            "_timestamp_epoch": False,
+        },
+    ),
+    "coap": (
+        True,
+        {
+            "manufacturer": "CoAP",
+            "dev_family": "CPd",
+            "location_key": "pos",
+            "lat_key": "lat",
+            "lng_key": "long",
+            "temperature_key": "tmp",
+            "manufacturer_key": "manufacturer",
+            "dev_family_key": "family",
+            "serial_number_key": "sn",
+        },
+    ),
+}
+
+
+def generate(
+    is_json: bool,
+    layout: dict,
+):
+    # Payload as generated by the simulators before compile_payload
+    layout = dict(layout)
+    with_serial_number = layout["serial_number_key"] is not None
+    if not with_serial_number:
+        layout.pop("serial_number_key")
+
+    def build(
+        temperature: float,
+        serial_number: str,
+        location: str,
+        lat: float,
+        lng: float,
+    ):
+        result = generate_payload(
+            temperature,
+            serial_number=serial_number if with_serial_number else None,
+            location=location,
+            lat=lat,
+            lng=lng,
+            **layout,
+        )
+        if is_json:
+            return json.dumps(result).encode("utf-8")
+        return result
+
+    return build
+
+
+def run(
+    build,
+    locations: list,
+    messages: int,
+) -> float:
+    start = time.perf_counter()
+    for n in range(messages):
+        location = locations[n % len(locations)]
+        build(
+            20.1234,
+            "cb05503d6cdc",
+            location["city"],
+            location["lat"],
+            location["lng"],
+        )
+    return messages / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
+
+    parser = argparse.ArgumentParser(
+        description="Payload generation: generate_payload vs compile_payload"
+    )
+    parser.add_argument(
+        "--messages",
+        type=int,
+        default=200000,
+        help="Number of messages per layout (default: 200000)",
+    )
+    parser.add_argument(
+        "--location-data",
+        default=os.path.join("config", "uk_coordinates.json"),
+        help="Location data file (default: config/uk_coordinates.json)",
+    )
+    args = parser.parse_args()
+
+    locations = get_locations(args.location_data)
+    for name, (is_json, layout) in LAYOUTS.items():
+        old = generate(is_json, layout)
+        new = compile_payload(_json=is_json, **layout)
+
+        # Same payload when given the same timestamp
+        timestamp_key = layout.get("timestamp_key", "timestamp")
+        identical = True
+        for location in locations:
+            expected = generate(False, layout)(
+                20.1234,
+                "cb05503d6cdc",
+                location["city"],
+                location["lat"],
+                location["lng"],
+            )
+            result = new(
+                20.1234,
+                "cb05503d6cdc",
+                location["city"],
+                location["lat"],
+                location["lng"],
+                timestamp=expected[timestamp_key],
+            )
+            if is_json:
+                expected = json.dumps(expected).encode("utf-8")
+            identical &= result == expected
+
+        old_rate = run(old, locations, args.messages)
+        new_rate = run(new, locations, args.messages)
+        logging.info(
+            f"{name:>8} ({'JSON' if is_json else 'dict'}): generate_payload {old_rate:,.0f} msgs/sec, compile_payload {new_rate:,.0f} msgs/sec ({new_rate / old_rate:.1f}x), identical output: {identical}"
+        )
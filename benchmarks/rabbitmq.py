@@ -0,0 +1,269 @@
+import os
+import time
+import struct
+import asyncio
+import logging
+import argparse
+
+import pika
+
+from pika import frame, spec
+
+from utils import (
+    set_logging_handler,
+    telemetry,
+)
+from iot_rabbitmq import AMQPPublisher
+
+
+HOST = "127.0.0.1"
+QUEUE = "iot-rabbitmq"
+MESSAGE = b'{"temp": 20.1234, "region": "London", "lat": 51.5072, "lon": -0.1275, "provider": "RMQ", "product": "sx", "serno": "cb05503d6cdc", "timestamp": "2024-04-08T10:55:36.000Z"}'
+
+
+class BrokerStub:
+    # Minimal AMQP 0-9-1 broker stand-in (frames encoded/decoded by pika):
+    # connection and channel handshakes, queue declare, confirm select and
+    # publish. On channels in confirm mode the messages received are acked
+    # after `delay` seconds, the messages read in one go with a single
+    # multiple ack (as RabbitMQ does), messages are dropped
+    def __init__(
+        self,
+        delay: float = 0,
+    ) -> None:
+        self.delay = delay
+
+    @staticmethod
+    def _send(
+        writer: asyncio.StreamWriter,
+        channel: int,
+        method,
+    ) -> None:
+        writer.write(frame.Method(channel, method).marshal())
+
+    def _flush_acks(
+        self,
+        writer: asyncio.StreamWriter,
+        acks: dict,
+    ) -> None:
+        packet = b"".join(
+            frame.Method(channel, spec.Basic.Ack(delivery_tag, multiple=True)).marshal()
+            for channel, delivery_tag in acks.items()
+        )
+        acks.clear()
+        if self.delay > 0:
+            asyncio.get_running_loop().call_later(self.delay, writer.write, packet)
+        else:
+            writer.write(packet)
+
+    async def handle(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        # channel -> last delivery tag (channels in confirm mode)
+        confirms = dict()
+        # channel -> body bytes still expected
+        bodies = dict()
+        # channel -> delivery tag to ack, sent once the frames already
+        # received are processed (the reader waiting for more)
+        acks = dict()
+        try:
+            await reader.readexactly(8)
+            self._send(
+                writer,
+                0,
+                spec.Connection.Start(
+                    server_properties={
+                        "product": "stub",
+                        "capabilities": {
+                            "publisher_confirms": True,
+                            "basic.nack": True,
+                        },
+                    }
+                ),
+            )
+            while True:
+                header = await reader.readexactly(7)
+                frame_type, channel, size = struct.unpack(">BHI", header)
+                payload = await reader.readexactly(size + 1)
+                if frame_type == spec.FRAME_BODY:
+                    bodies[channel] -= size
+                elif frame_type == spec.FRAME_HEADER:
+                    bodies[channel] = frame.decode_frame(header + payload)[1].body_size
+                elif frame_type == spec.FRAME_METHOD:
+                    method = frame.decode_frame(header + payload)[1].method
+                    if isinstance(method, spec.Connection.StartOk):
+                        self._send(writer, 0, spec.Connection.Tune(2047, 131072, 0))
+                    elif isinstance(method, spec.Connection.Open):
+                        self._send(writer, 0, spec.Connection.OpenOk())
+                    elif isinstance(method, spec.Channel.Open):
+                        self._send(writer, channel, spec.Channel.OpenOk())
+                    elif isinstance(method, spec.Queue.Declare):
+                        self._send(writer, channel, spec.Queue.DeclareOk(method.queue, 0, 0))
+                    elif isinstance(method, spec.Confirm.Select):
+                        confirms[channel] = 0
+                        self._send(writer, channel, spec.Confirm.SelectOk())
+                    elif isinstance(method, spec.Channel.Close):
+                        confirms.pop(channel, None)
+                        self._send(writer, channel, spec.Channel.CloseOk())
+                    elif isinstance(method, spec.Connection.Close):
+                        self._send(writer, 0, spec.Connection.CloseOk())
+                        return
+                # Message complete (no body frame for empty bodies)
+                if frame_type in (spec.FRAME_HEADER, spec.FRAME_BODY) and bodies[channel] == 0:
+                    del bodies[channel]
+                    if channel in confirms:
+                        confirms[channel] += 1
+                        if not acks:
+                            loop.call_soon(self._flush_acks, writer, acks)
+                        acks[channel] = confirms[channel]
+        except (asyncio.IncompleteReadError, asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def run_blocking(
+    port: int,
+    messages: int,
+    confirms: bool,
+) -> float:
+    # iot_rabbitmq.py as it was: BlockingConnection, one basic_publish per
+    # message (with confirms each basic_publish waits for its ack)
+    connection = pika.BlockingConnection(
+        pika.ConnectionParameters(
+            host=HOST,
+            port=port,
+        )
+    )
+    channel = connection.channel()
+    channel.queue_declare(queue=QUEUE)
+    if confirms:
+        channel.confirm_delivery()
+    start = time.perf_counter()
+    for _ in range(messages):
+        channel.basic_publish(
+            exchange="",
+            routing_key=QUEUE,
+            body=MESSAGE,
+        )
+    # Written to the socket
+    connection.process_data_events(0)
+    elapsed = time.perf_counter() - start
+    connection.close()
+    return messages / elapsed
+
+
+async def run_async(
+    port: int,
+    messages: int,
+    confirms: bool,
+    connections: int,
+    channels: int,
+    max_inflight: int,
+) -> float:
+    pool = [
+        AMQPPublisher(
+            HOST,
+            port,
+            QUEUE,
+            channels=channels,
+            confirms=confirms,
+            max_inflight=max_inflight,
+        )
+        for _ in range(connections)
+    ]
+    for publisher in pool:
+        await publisher.connect()
+    start = time.perf_counter()
+    for n in range(messages):
+        await pool[n % connections].publish(MESSAGE)
+    for publisher in pool:
+        await publisher.close(timeout=60)
+    return messages / (time.perf_counter() - start)
+
+
+async def main(args) -> None:
+    broker = BrokerStub(delay=args.delay_ms / 1000)
+    server = await asyncio.start_server(broker.handle, HOST, 0)
+    port = server.sockets[0].getsockname()[1]
+
+    for confirms in (False, True):
+        label = "on" if confirms else "off"
+        # Each confirm is a round trip, fewer messages
+        messages = args.messages // 10 if confirms else args.messages
+        rate = await asyncio.get_running_loop().run_in_executor(
+            None,
+            run_blocking,
+            port,
+            messages,
+            confirms,
+        )
+        logging.info(f"Confirms {label}, BlockingConnection: {rate:,.0f} msgs/sec")
+        for connections in args.connections:
+            for channels in args.channels:
+                telemetry.snapshot()
+                rate = await run_async(
+                    port,
+                    args.messages,
+                    confirms,
+                    connections,
+                    channels,
+                    args.max_inflight,
+                )
+                stats = telemetry.snapshot()
+                logging.info(
+                    f"Confirms {label}, asyncio {connections} connections x {channels} channels, {args.max_inflight} in flight: {rate:,.0f} msgs/sec, published={stats['sent']} failed={stats['failed']}, latency ms p50={stats.get('p50', 0) * 1000:.2f} p99={stats.get('p99', 0) * 1000:.2f}"
+                )
+
+    server.close()
+    await server.wait_closed()
+
+
+if __name__ == "__main__":
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
+    # Per message logs are out of the measurement
+    telemetry.sample_rate = 0
+    logging.getLogger("pika").setLevel(logging.WARNING)
+
+    parser = argparse.ArgumentParser(
+        description="iot_rabbitmq.py msgs/sec against a local stub AMQP broker, publisher confirms on vs off: BlockingConnection vs asyncio connection/channel pool"
+    )
+    parser.add_argument(
+        "--messages",
+        type=int,
+        default=50000,
+        help="Number of messages per run (default: 50000, a tenth of it for BlockingConnection with confirms)",
+    )
+    parser.add_argument(
+        "--connections",
+        type=int,
+        nargs="+",
+        default=[1, 4],
+        help="Connection pool sizes (default: 1 4)",
+    )
+    parser.add_argument(
+        "--channels",
+        type=int,
+        nargs="+",
+        default=[1, 4],
+        help="Channels per connection (default: 1 4)",
+    )
+    parser.add_argument(
+        "--max-inflight",
+        type=int,
+        default=100,
+        help="Messages not yet confirmed per channel (default: 100)",
+    )
+    parser.add_argument(
+        "--delay-ms",
+        type=float,
+        default=1,
+        help="Stub broker delay acknowledging each message, in milliseconds (default: 1)",
+    )
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
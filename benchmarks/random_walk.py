@@ -0,0 +1,114 @@
+import os
+import time
+import random
+import logging
+import argparse
+
+from array import array
+
+from utils import (
+    round_temp,
+    get_delta,
+    set_logging_handler,
+)
+from utils.random_walk import np, TemperatureWalk
+
+
+def per_device(
+    temperatures,
+    ids: list,
+) -> list:
+    # Temperature update as originally done by every iot_*.py simulator
+    result = list()
+    for _id in ids:
+        temperatures[_id] = round_temp(temperatures[_id] + get_delta())
+        result.append(temperatures[_id])
+    return result
+
+
+def run(
+    step,
+    temperatures,
+    ids: list,
+    ticks: int,
+) -> float:
+    start = time.perf_counter()
+    for _ in range(ticks):
+        step(temperatures, ids)
+    return (time.perf_counter() - start) / ticks
+
+
+if __name__ == "__main__":
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
+
+    parser = argparse.ArgumentParser(
+        description="Temperature random walk: per device vs batch (NumPy/pure Python)"
+    )
+    parser.add_argument(
+        "--devices",
+        type=int,
+        default=100000,
+        help="Number of devices due per tick (default: 100000)",
+    )
+    parser.add_argument(
+        "--ticks",
+        type=int,
+        default=10,
+        help="Number of ticks to average (default: 10)",
+    )
+    parser.add_argument(
+        "--seed",
+        default="benchmark",
+        help="Random seed (default: benchmark)",
+    )
+    args = parser.parse_args()
+
+    temp_mus = [random.randint(7, 23) for _ in range(args.devices)]
+    ids = list(range(args.devices))
+
+    results = [
+        (
+            "per device",
+            per_device,
+            array("d", temp_mus),
+        ),
+    ]
+    backends = [False]
+    if np is None:
+        logging.warning("NumPy is not installed, skipping NumPy backend")
+    else:
+        backends.append(True)
+    for use_numpy in backends:
+        walker = TemperatureWalk(
+            seed=args.seed,
+            use_numpy=use_numpy,
+        )
+        results.append(
+            (
+                "batch (NumPy)" if use_numpy else "batch (Python)",
+                walker.step,
+                walker.initial(temp_mus),
+            )
+        )
+
+    for name, step, temperatures in results:
+        elapsed = run(step, temperatures, ids, args.ticks)
+        logging.info(
+            f"{name:>14}: {elapsed * 1000:.2f} ms/tick, {elapsed * 1e9 / args.devices:.1f} ns/device"
+        )
+
+    if np is not None:
+        # Both backends must generate the same walk for the same seed
+        python_walk, numpy_walk = (
+            TemperatureWalk(seed=args.seed, use_numpy=use_numpy)
+            for use_numpy in (False, True)
+        )
+        python_temps = python_walk.initial(temp_mus)
+        numpy_temps = numpy_walk.initial(temp_mus)
+        for _ in range(args.ticks):
+            python_walk.step(python_temps, ids)
+            numpy_walk.step(numpy_temps, ids)
+        logging.info(
+            f"NumPy and pure Python output identical: {list(python_temps) == numpy_temps.tolist()}"
+        )
@@ -0,0 +1,137 @@
+import os
+import time
+import asyncio
+import logging
+import argparse
+
+from utils import (
+    set_logging_handler,
+    telemetry,
+)
+from utils.engine import Simulator
+from benchmarks.replay import SEED, SinkTransport
+
+
+class StallingTransport(SinkTransport):
+    # Blocks the event loop for `stall` seconds every `every` seconds (e.g.
+    # broker GC pause, full socket buffer)
+    def __init__(
+        self,
+        stall: float,
+        every: float,
+    ) -> None:
+        super().__init__()
+        self.stall = stall
+        self.every = every
+        self._next_stall = time.monotonic() + every
+
+    async def send_batch(
+        self,
+        records: list,
+    ) -> list:
+        if self.stall > 0 and time.monotonic() >= self._next_stall:
+            time.sleep(self.stall)
+            self._next_stall = time.monotonic() + self.every
+        return await super().send_batch(records)
+
+
+def run(
+    devices: int,
+    rate: float,
+    seconds: float,
+    stall: float,
+    every: float,
+    location_data_file: str,
+    open_loop: bool,
+) -> dict:
+    # Per device intervals averaging what `devices` need to send `rate`
+    # msgs/sec
+    interval_ms = round(devices / rate * 1000)
+    transport = StallingTransport(stall, every)
+    simulator = Simulator(
+        transport,
+        devices,
+        SEED,
+        location_data_file,
+        0,
+        2 * interval_ms,
+        random_seed="42",
+        target_rate=rate if open_loop else None,
+    )
+
+    async def run_for():
+        try:
+            await asyncio.wait_for(simulator.run(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    telemetry.snapshot()
+    asyncio.run(run_for())
+    stats = telemetry.snapshot()
+    stats["rate"] = transport.sent / seconds
+    return stats
+
+
+if __name__ == "__main__":
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
+
+    parser = argparse.ArgumentParser(
+        description="Achieved vs target msgs/sec and schedule lag with a stalling transport: per device intervals (closed loop) vs RateScheduler (open loop)"
+    )
+    parser.add_argument(
+        "--devices",
+        type=int,
+        default=10000,
+        help="Number of devices (default: 10000)",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=20000,
+        help="Target msgs/sec (default: 20000)",
+    )
+    parser.add_argument(
+        "--seconds",
+        type=float,
+        default=10,
+        help="Duration of each run (default: 10)",
+    )
+    parser.add_argument(
+        "--stall-ms",
+        type=float,
+        default=200,
+        help="Transport stall, 0 for none (default: 200)",
+    )
+    parser.add_argument(
+        "--stall-every",
+        type=float,
+        default=1,
+        help="Seconds between stalls (default: 1)",
+    )
+    parser.add_argument(
+        "--location-data",
+        default=os.path.join("config", "uk_coordinates.json"),
+        help="Location data file (default: config/uk_coordinates.json)",
+    )
+    args = parser.parse_args()
+
+    for name, open_loop in (
+        ("Per device intervals", False),
+        ("Target rate", True),
+    ):
+        stats = run(
+            args.devices,
+            args.rate,
+            args.seconds,
+            args.stall_ms / 1000,
+            args.stall_every,
+            args.location_data,
+            open_loop,
+        )
+        summary = f"{name}: {stats['rate']:,.0f} msgs/sec (target {args.rate:,.0f})"
+        if "lag_max" in stats:
+            summary += f", schedule lag ms p50={stats['lag_p50'] * 1000:.1f} p99={stats['lag_p99'] * 1000:.1f} max={stats['lag_max'] * 1000:.1f}"
+        else:
+            summary += ", schedule lag not measured"
+        logging.info(summary)
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+
+from utils import set_logging_handler
+from utils.engine import (
+    Playback,
+    Simulator,
+    Transport,
+)
+from utils.payload import compile_payload
+from utils.recording import (
+    Recording,
+    get_recording_file,
+)
+from benchmarks.payload import LAYOUTS
+
+
+SEED = "$Rabbitmq"
+
+
+class SinkTransport(Transport):
+    # iot_rabbitmq.py payloads, kept in memory instead of sent
+    name = "rabbitmq"
+    timestamp_epoch = False
+
+    def __init__(
+        self,
+        keep: bool = False,
+    ) -> None:
+        is_json, layout = LAYOUTS["rabbitmq"]
+        self.build_payload = compile_payload(_json=is_json, **layout)
+        self.keep = keep
+        self.sent = 0
+        self.payloads = list()
+
+    def encode(
+        self,
+        _id: int,
+        temperature: float,
+        location: dict,
+        timestamp: str = None,
+    ) -> bytes:
+        return self.build_payload(
+            temperature,
+            self.devices.serial_numbers[_id],
+            location["city"],
+            location["lat"],
+            location["lng"],
+            timestamp=timestamp,
+        )
+
+    async def send_batch(
+        self,
+        records: list,
+    ) -> list:
+        self.sent += len(records)
+        if self.keep:
+            self.payloads.extend(record for _, record in records)
+        return []
+
+
+def live(
+    devices: int,
+    steps: int,
+    location_data_file: str,
+    recording_dir: str = None,
+    keep: bool = False,
+) -> tuple:
+    # Every device due on every tick (0 ms interval), no sleep between ticks
+    transport = SinkTransport(keep=keep)
+    simulator = Simulator(
+        transport,
+        devices,
+        SEED,
+        location_data_file,
+        0,
+        0,
+        random_seed="42",
+        recording_dir=recording_dir,
+    )
+
+    async def run_steps():
+        for _ in range(steps):
+            await simulator.step()
+
+    start = time.perf_counter()
+    asyncio.run(run_steps())
+    elapsed = time.perf_counter() - start
+    if simulator.recorder is not None:
+        simulator.recorder.close()
+    return transport, transport.sent / elapsed
+
+
+def playback(
+    recording_file: str,
+) -> tuple:
+    transport = SinkTransport(keep=True)
+    player = Playback(
+        transport,
+        Recording(recording_file),
+        speed=0,
+    )
+    start = time.perf_counter()
+    asyncio.run(player.play())
+    return transport, transport.sent / (time.perf_counter() - start)
+
+
+def without_timestamp(payload: bytes) -> dict:
+    result = json.loads(payload)
+    result.pop("timestamp")
+    return result
+
+
+if __name__ == "__main__":
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
+
+    parser = argparse.ArgumentParser(
+        description="Records/sec: live generation and encoding (with and without recording) vs playback of the recording"
+    )
+    parser.add_argument(
+        "--devices",
+        type=int,
+        default=10000,
+        help="Number of devices (default: 10000)",
+    )
+    parser.add_argument(
+        "--steps",
+        type=int,
+        default=50,
+        help="Ticks, all the devices due on each one (default: 50)",
+    )
+    parser.add_argument(
+        "--location-data",
+        default=os.path.join("config", "uk_coordinates.json"),
+        help="Location data file (default: config/uk_coordinates.json)",
+    )
+    args = parser.parse_args()
+
+    _, rate = live(args.devices, args.steps, args.location_data)
+    logging.info(f"Live: {rate:,.0f} records/sec")
+
+    with tempfile.TemporaryDirectory() as recording_dir:
+        recorded, rate = live(
+            args.devices,
+            args.steps,
+            args.location_data,
+            recording_dir=recording_dir,
+            keep=True,
+        )
+        recording_file = get_recording_file(recording_dir, SinkTransport.name)
+        logging.info(
+            f"Live, recording: {rate:,.0f} records/sec ({os.path.getsize(recording_file) / 2**20:.1f} MB recorded)"
+        )
+
+        played, rate = playback(recording_file)
+        logging.info(f"Playback: {rate:,.0f} records/sec")
+
+        # Same payloads but the timestamp, rewritten on playback
+        identical = len(played.payloads) == len(recorded.payloads) and all(
+            without_timestamp(a) == without_timestamp(b)
+            for a, b in zip(recorded.payloads, played.payloads)
+        )
+        logging.info(f"Played back payloads identical (but the timestamp): {identical}")
@@ -0,0 +1,192 @@
+import os
+import time
+import asyncio
+import socket
+import logging
+import argparse
+import threading
+
+from utils import (
+    get_locations,
+    set_logging_handler,
+    telemetry,
+)
+from iot_syslog import (
+    FRAMINGS,
+    SyslogPool,
+    get_cef_encoder,
+    get_cef_header,
+    get_host_name,
+    syslog_message,
+)
+
+
+HOST = "127.0.0.1"
+
+
+class SyslogSink:
+    # TCP syslog server stand-in, counts the bytes received (all connections)
+    def __init__(self) -> None:
+        self.received = 0
+        self._lock = threading.Lock()
+        self._server = socket.create_server((HOST, 0))
+        self.port = self._server.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self) -> None:
+        while True:
+            connection, _ = self._server.accept()
+            threading.Thread(target=self._read, args=(connection,), daemon=True).start()
+
+    def _read(
+        self,
+        connection: socket.socket,
+    ) -> None:
+        with connection:
+            while True:
+                data = connection.recv(1 << 20)
+                if not data:
+                    break
+                with self._lock:
+                    self.received += len(data)
+
+    def wait(
+        self,
+        expected: int,
+        timeout: float = 60,
+    ) -> None:
+        deadline = time.monotonic() + timeout
+        while self.received < expected and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+
+def run_per_device(
+    sink: SyslogSink,
+    messages: list,
+    count: int,
+    devices: int,
+) -> float:
+    # iot_syslog.py as it was: one TCP connection per device, one sendall per
+    # message (without the 10 ms sleep after each one)
+    sockets = [socket.create_connection((HOST, sink.port)) for _ in range(devices)]
+    data = [message + b"\n" for message in messages]
+    expected = sink.received + sum(len(data[n % len(data)]) for n in range(count))
+    start = time.perf_counter()
+    for n in range(count):
+        sockets[n % devices].sendall(data[n % len(data)])
+    sink.wait(expected)
+    elapsed = time.perf_counter() - start
+    for sock in sockets:
+        sock.close()
+    return count / elapsed
+
+
+async def run_pool(
+    sink: SyslogSink,
+    messages: list,
+    count: int,
+    connections: int,
+    framing: str,
+    tick: int,
+) -> float:
+    pool = SyslogPool(
+        HOST,
+        sink.port,
+        size=connections,
+        framing=framing,
+    )
+    telemetry.snapshot()
+    received = sink.received
+    start = time.perf_counter()
+    for n in range(count):
+        await pool.send(messages[n % len(messages)])
+        # Devices due on the same loop iteration
+        if n % tick == tick - 1:
+            await pool.flush()
+    await pool.flush()
+    sink.wait(received + telemetry.snapshot()["bytes"])
+    elapsed = time.perf_counter() - start
+    await pool.close()
+    return count / elapsed
+
+
+if __name__ == "__main__":
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
+
+    parser = argparse.ArgumentParser(
+        description="iot_syslog.py msgs/sec against a local TCP sink: one connection per device vs shared connection pool"
+    )
+    parser.add_argument(
+        "--messages",
+        type=int,
+        default=200000,
+        help="Number of messages per run (default: 200000)",
+    )
+    parser.add_argument(
+        "--devices",
+        type=int,
+        default=25,
+        help="Devices, i.e. connections of the per device run (default: 25)",
+    )
+    parser.add_argument(
+        "--connections",
+        type=int,
+        nargs="+",
+        default=[1, 4],
+        help="Connection pool sizes (default: 1 4)",
+    )
+    parser.add_argument(
+        "--tick",
+        type=int,
+        nargs="+",
+        default=[1, 25, 1000],
+        help="Messages sent per loop iteration, i.e. coalesced (default: 1 25 1000)",
+    )
+    parser.add_argument(
+        "--location-data",
+        default=os.path.join("config", "uk_coordinates.json"),
+        help="Location data file (default: config/uk_coordinates.json)",
+    )
+    args = parser.parse_args()
+
+    # Pre-built, so only the transport is measured
+    host_name = get_host_name()
+    encode = get_cef_encoder().encode
+    locations = get_locations(args.location_data)
+    start = time.perf_counter()
+    messages = [
+        syslog_message(
+            host_name,
+            encode,
+            get_cef_header("SysTemp", "SysIotLog", f"{n:012x}"),
+            temperature=20.1234 + n / 100,
+            location=location["city"],
+            lat=location["lat"],
+            lng=location["lng"],
+        )
+        for n, location in enumerate(locations)
+    ]
+    logging.info(
+        f"syslog_message(): {len(messages) / (time.perf_counter() - start):,.0f} msgs/sec"
+    )
+
+    sink = SyslogSink()
+    rate = run_per_device(sink, messages, args.messages, args.devices)
+    logging.info(f"One connection per device ({args.devices}): {rate:,.0f} msgs/sec")
+    for framing in FRAMINGS:
+        for connections in args.connections:
+            for tick in args.tick:
+                rate = asyncio.run(
+                    run_pool(
+                        sink,
+                        messages,
+                        args.messages,
+                        connections,
+                        framing,
+                        tick,
+                    )
+                )
+                logging.info(
+                    f"Pool of {connections} connections, {framing}, {tick} messages per write: {rate:,.0f} msgs/sec"
+                )
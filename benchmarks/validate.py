@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import logging
+import argparse
+
+from utils import (
+    get_locations,
+    set_logging_handler,
+)
+from utils.payload import compile_payload
+from utils.validate import (
+    JSON_BACKENDS,
+    JSONValidator,
+    get_json_backend,
+)
+from benchmarks.payload import LAYOUTS
+
+
+def loads_dumps(data: bytes) -> bytes:
+    # TelemetryResource as it was: parsed and then serialised back
+    payload = json.loads(data.decode("utf-8"))
+    if not isinstance(payload, dict):
+        raise ValueError("Invalid payload, not JSON")
+    return json.dumps(payload).encode("utf-8")
+
+
+def get_payloads(
+    layout: dict,
+    locations: list,
+) -> list:
+    build = compile_payload(_json=True, **layout)
+    return [
+        build(
+            20.1234,
+            "cb05503d6cdc",
+            location["city"],
+            location["lat"],
+            location["lng"],
+        )
+        for location in locations
+    ]
+
+
+def get_required_keys(layout: dict) -> tuple:
+    return tuple(
+        value
+        for key, value in layout.items()
+        if key.endswith("_key") and value is not None
+    )
+
+
+def run(
+    validate,
+    payloads: list,
+    messages: int,
+) -> float:
+    start = time.perf_counter()
+    for n in range(messages):
+        try:
+            validate(payloads[n % len(payloads)])
+        except ValueError:
+            pass
+    return messages / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
+
+    parser = argparse.ArgumentParser(
+        description="Payload validations/sec: json.loads + json.dumps vs JSONValidator (per JSON backend)"
+    )
+    parser.add_argument(
+        "--messages",
+        type=int,
+        default=200000,
+        help="Number of messages per payload shape (default: 200000)",
+    )
+    parser.add_argument(
+        "--location-data",
+        default=os.path.join("config", "uk_coordinates.json"),
+        help="Location data file (default: config/uk_coordinates.json)",
+    )
+    args = parser.parse_args()
+
+    backends = list()
+    for backend in JSON_BACKENDS:
+        try:
+            backends.append(get_json_backend(backend))
+        except ImportError:
+            logging.info(f"JSON backend '{backend}' is not installed, skipping it")
+
+    locations = get_locations(args.location_data)
+    # Payload layouts of the simulators plus a payload missing keys (rejected)
+    shapes = dict()
+    for name, (_, layout) in LAYOUTS.items():
+        shapes[name] = (
+            get_required_keys(layout),
+            get_payloads(layout, locations),
+        )
+    shapes["invalid"] = (
+        get_required_keys(LAYOUTS["coap"][1]),
+        [b'{"tmp": 20.1234, "sn": "cb05503d6cdc"}'],
+    )
+
+    for name, (required_keys, payloads) in shapes.items():
+        results = [f"loads+dumps {run(loads_dumps, payloads, args.messages):,.0f}"]
+        for backend in backends:
+            validator = JSONValidator(
+                required_keys=required_keys,
+                backend=backend,
+            )
+            results.append(
+                f"{backend} {run(validator, payloads, args.messages):,.0f}"
+            )
+        logging.info(f"{name:>8}: validations/sec {', '.join(results)}")
@@ -1,5 +1,7 @@
 import os
+import sys
 import json
+import time
 import aiocoap
 import asyncio
 import logging
@@ -7,38 +9,233 @@ import logging
 import aiocoap.resource as resource
 
 from dotenv import load_dotenv, find_dotenv
-from logging.handlers import TimedRotatingFileHandler
+from confluent_kafka import Producer, KafkaException
+from configparser import ConfigParser
+from concurrent.futures import ThreadPoolExecutor
 
-from utils import set_logging_handler
+from utils import (
+    sys_exc,
+    get_env_bool,
+    set_logging_handler,
+    telemetry,
+)
+from utils.validate import JSONValidator
+
+
+class SpoolWriter:
+    # Validated payloads are appended to an in-memory buffer and written in
+    # chunks by a background task. The file being written (`file_name`) does
+    # not match the Spool Dir connector input.file.pattern, once older than
+    # `interval` seconds or larger than `max_bytes` it is atomically renamed
+    # to `file_name`.%Y-%m-%d_%H-%M-%S (same as TimedRotatingFileHandler)
+    def __init__(
+        self,
+        directory: str,
+        file_name: str,
+        interval: float = 5,
+        max_bytes: int = 10485760,
+        flush_interval: float = 0.2,
+    ) -> None:
+        self.path = os.path.join(directory, file_name)
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self._buffer = bytearray()
+        self._count = 0
+        self._received = None
+        self._file = None
+        self._opened_at = None
+        self._size = 0
+        self._task = None
+        # Single thread, so chunks are written (and rotated) in order
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def write(
+        self,
+        data: bytes,
+        received: float = None,
+    ) -> None:
+        if self._received is None:
+            self._received = received or time.monotonic()
+        self._buffer += data
+        self._buffer += b"\n"
+        self._count += 1
+
+    def _open(self) -> None:
+        self._file = open(self.path, "ab")
+        self._opened_at = time.time()
+        self._size = self._file.tell()
+
+    def _rotate(self) -> None:
+        self._file.close()
+        self._file = None
+        if self._size > 0:
+            opened_at = int(self._opened_at)
+            while True:
+                rotated = f"{self.path}.{time.strftime('%Y-%m-%d_%H-%M-%S', time.localtime(opened_at))}"
+                if not os.path.exists(rotated):
+                    break
+                opened_at += 1
+            os.rename(self.path, rotated)
+
+    def _write(
+        self,
+        chunk: bytes,
+        rotate: bool = False,
+    ) -> None:
+        if self._file is None:
+            self._open()
+        if chunk:
+            self._file.write(chunk)
+            self._file.flush()
+            self._size += len(chunk)
+        if (
+            rotate
+            or self._size >= self.max_bytes
+            or time.time() - self._opened_at >= self.interval
+        ):
+            self._rotate()
+
+    async def flush(
+        self,
+        rotate: bool = False,
+    ) -> None:
+        chunk = bytes(self._buffer)
+        count, received = self._count, self._received
+        self._buffer.clear()
+        self._count, self._received = 0, None
+        await asyncio.get_running_loop().run_in_executor(
+            self._executor,
+            self._write,
+            chunk,
+            rotate,
+        )
+        if count:
+            # Latency of the oldest record in the chunk (receipt to disk)
+            telemetry.sent(len(chunk), time.monotonic() - received, count=count)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logging.error(sys_exc(sys.exc_info()))
+            telemetry.tick()
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        await self.flush(rotate=True)
+        self._executor.shutdown(wait=True)
+
+
+class KafkaWriter:
+    # Validated payloads produced straight to the Kafka topic (no spool dir),
+    # delivery reports are served by a background task. write() raises
+    # BufferError when the producer queue is full (backpressure)
+    def __init__(
+        self,
+        producer,
+        topic: str,
+        poll_interval: float = 0.05,
+        flush_timeout: float = 30,
+    ) -> None:
+        self.producer = producer
+        self.topic = topic
+        self.poll_interval = poll_interval
+        self.flush_timeout = flush_timeout
+        self._task = None
+
+    def write(
+        self,
+        data: bytes,
+        received: float = None,
+    ) -> None:
+        if received is None:
+            received = time.monotonic()
+
+        def delivery_report(err, msg) -> None:
+            if err is not None:
+                telemetry.failed()
+                logging.error(
+                    f"Delivery failed for the topic '{msg.topic()}': {err}"
+                )
+            else:
+                # End to end latency, CoAP receipt to Kafka ack
+                telemetry.sent(len(msg), time.monotonic() - received)
+
+        self.producer.produce(
+            topic=self.topic,
+            value=data,
+            on_delivery=delivery_report,
+        )
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                self.producer.poll(0)
+            except Exception:
+                logging.error(sys_exc(sys.exc_info()))
+            telemetry.tick()
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        logging.info("Flushing Kafka Producer")
+        await asyncio.get_running_loop().run_in_executor(
+            None,
+            self.producer.flush,
+            self.flush_timeout,
+        )
 
 
 class TelemetryResource(resource.Resource):
     def __init__(
         self,
-        logger,
+        writer,
+        validator: JSONValidator = None,
         encoding: str = "utf-8",
+        retry_after: int = 1,
     ):
         super().__init__()
-        self.logger = logger
+        self.writer = writer
+        self.validator = validator or JSONValidator(encoding=encoding)
         self.encoding = encoding
+        self.retry_after = retry_after
+
+    def _unavailable(
+        self,
+        payload: bytes,
+    ) -> aiocoap.Message:
+        # The client is to retry after Max-Age seconds
+        response = aiocoap.Message(
+            code=resource.numbers.codes.SERVICE_UNAVAILABLE,
+            payload=payload,
+        )
+        response.opt.max_age = self.retry_after
+        return response
 
     async def render_post(self, request):
-        # Validate payload
+        received = time.monotonic()
+        # Validate payload, 4.00 if invalid
         try:
-            payload = json.loads(request.payload.decode(self.encoding))
-            if isinstance(payload, dict):
-                # Log request to screen
-                logging.info(
-                    f"{request.code} from {request.remote.uri} ({request.mid})"
-                )
-                # Log request to disk (JSON payload)
-                self.logger.info(json.dumps(payload))
-                return aiocoap.Message(
-                    code=resource.numbers.codes.CONTENT,
-                    payload=b"OK",
-                )
-            else:
-                raise ValueError("Invalid payload, not JSON")
+            payload = self.validator(request.payload)
+            # Spool/produce request as received (JSON payload, one per line)
+            data = request.payload
+            if b"\n" in data or b"\r" in data:
+                if self.validator.encoding is None:
+                    # Only whitespace can be a new line in (UTF-8) JSON
+                    data = data.replace(b"\r", b" ").replace(b"\n", b" ")
+                else:
+                    data = json.dumps(payload).encode(self.encoding)
         except Exception as err:
             logging.error(
                 f"{request.code} from {request.remote.uri} ({request.mid}): {err}"
@@ -47,16 +244,40 @@ class TelemetryResource(resource.Resource):
                 code=resource.numbers.codes.BAD_REQUEST,
                 payload=str(err).encode(self.encoding),
             )
+        # Log request to screen
+        if telemetry.sample():
+            logging.info(f"{request.code} from {request.remote.uri} ({request.mid})")
+        # Write errors are the server's: 5.03 if transient, 5.00 otherwise
+        try:
+            self.writer.write(data, received)
+        except BufferError:
+            # Producer queue full
+            telemetry.failed()
+            return self._unavailable(b"Producer queue full")
+        except KafkaException as err:
+            telemetry.failed()
+            logging.error(sys_exc(sys.exc_info()))
+            return self._unavailable(str(err).encode(self.encoding))
+        except Exception as err:
+            telemetry.failed()
+            logging.error(sys_exc(sys.exc_info()))
+            return aiocoap.Message(
+                code=resource.numbers.codes.INTERNAL_SERVER_ERROR,
+                payload=str(err).encode(self.encoding),
+            )
+        return aiocoap.Message(
+            code=resource.numbers.codes.CONTENT,
+            payload=b"OK",
+        )
 
     # https://docs.confluent.io/kafka-connectors/spooldir/current/connectors/json_source_connector.html#spooldir-json-source-connector
 
 
-async def main(
-    logger,
-    coap_host,
-    coap_port,
-    coap_path,
-    encoding,
+async def create_server(
+    telemetry_resource: TelemetryResource,
+    coap_host: str,
+    coap_port: int,
+    coap_path: str,
 ):
     # Resource tree creation
     root = resource.Site()
@@ -69,13 +290,10 @@ async def main(
     )
     root.add_resource(
         [coap_path],
-        TelemetryResource(
-            logger,
-            encoding=encoding,
-        ),
+        telemetry_resource,
     )
 
-    await aiocoap.Context.create_server_context(
+    return await aiocoap.Context.create_server_context(
         bind=(
             coap_host,
             coap_port,
@@ -83,10 +301,36 @@ async def main(
         site=root,
     )
 
+
+async def main(
+    writer,
+    validator,
+    coap_host,
+    coap_port,
+    coap_path,
+    encoding,
+):
+    writer.start()
+    context = await create_server(
+        TelemetryResource(
+            writer,
+            validator=validator,
+            encoding=encoding,
+        ),
+        coap_host,
+        coap_port,
+        coap_path,
+    )
+
     logging.info(f"Started CoAP server on {coap_host}:{coap_port}")
 
     # Run forever
-    await asyncio.get_running_loop().create_future()
+    try:
+        await asyncio.get_running_loop().create_future()
+    finally:
+        await context.shutdown()
+        await writer.close()
+        telemetry.tick(force=True)
 
 
 if __name__ == "__main__":
@@ -97,30 +341,71 @@ if __name__ == "__main__":
     COAP_PORT = int(os.environ["COAP_PORT"])
     COAP_PATH = os.environ["COAP_PATH"]
     COAP_ENCODING = os.environ["COAP_ENCODING"]
+    COAP_SPOOL_INTERVAL = float(os.environ.get("COAP_SPOOL_INTERVAL", 5))
+    COAP_SPOOL_MAX_BYTES = int(os.environ.get("COAP_SPOOL_MAX_BYTES", 10485760))
+    COAP_SPOOL_FLUSH_MS = int(os.environ.get("COAP_SPOOL_FLUSH_MS", 200))
+    COAP_KAFKA_BRIDGE = get_env_bool("COAP_KAFKA_BRIDGE")
+    COAP_JSON_BACKEND = os.environ.get("COAP_JSON_BACKEND") or None
+    COAP_REQUIRED_KEYS = os.environ.get(
+        "COAP_REQUIRED_KEYS",
+        "timestamp,tmp,manufacturer,family,pos,lat,long,sn",
+    )
 
     FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
     set_logging_handler(FILE_APP)
 
-    # Log to file
-    handler = TimedRotatingFileHandler(
-        os.path.join("coap-data", COAP_PATH),
-        when="s",
-        interval=5,
-        backupCount=172800,
+    # Payload validation (JSON object with the keys sent by iot_coap.py)
+    validator = JSONValidator(
+        required_keys=tuple(key for key in COAP_REQUIRED_KEYS.split(",") if key),
+        backend=COAP_JSON_BACKEND,
         encoding=COAP_ENCODING,
-        delay=False,
     )
-    handler.setFormatter(logging.Formatter("%(message)s"))
-    handler.setLevel(logging.INFO)
-    logger = logging.getLogger(FILE_APP)
-    logger.addHandler(handler)
-
-    asyncio.run(
-        main(
-            logger,
-            COAP_HOST,
-            COAP_PORT,
+    logging.info(f"Validating payloads using the '{validator.backend}' JSON backend")
+
+    if COAP_KAFKA_BRIDGE:
+        KAFKA_CONFIG_FILE = os.environ["KAFKA_CONFIG_FILE"]
+        KAFKA_COAP_TOPIC = os.environ["KAFKA_COAP_TOPIC"]
+        COAP_KAFKA_QUEUE_MAX_MESSAGES = int(
+            os.environ.get("COAP_KAFKA_QUEUE_MAX_MESSAGES", 100000)
+        )
+
+        config = ConfigParser()
+        config.read(KAFKA_CONFIG_FILE)
+
+        # Produce to Kafka (bypassing the Spool Dir source connector)
+        kafka_config = dict(config["kafka"])
+        kafka_config.update(
+            {
+                "client.id": FILE_APP,
+                "queue.buffering.max.messages": COAP_KAFKA_QUEUE_MAX_MESSAGES,
+            }
+        )
+        writer = KafkaWriter(
+            Producer(kafka_config),
+            KAFKA_COAP_TOPIC,
+        )
+        logging.info(f"Producing to Kafka topic '{KAFKA_COAP_TOPIC}'")
+
+    else:
+        # Spool to disk (Spool Dir source connector)
+        writer = SpoolWriter(
+            "coap-data",
             COAP_PATH,
-            COAP_ENCODING,
+            interval=COAP_SPOOL_INTERVAL,
+            max_bytes=COAP_SPOOL_MAX_BYTES,
+            flush_interval=COAP_SPOOL_FLUSH_MS / 1000,
         )
-    )
+
+    try:
+        asyncio.run(
+            main(
+                writer,
+                validator,
+                COAP_HOST,
+                COAP_PORT,
+                COAP_PATH,
+                COAP_ENCODING,
+            )
+        )
+    except KeyboardInterrupt:
+        logging.info("CTRL-C pressed by user")
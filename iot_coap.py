@@ -1,123 +1,276 @@
 import os
 import sys
-import json
 import time
 import asyncio
 import logging
+import functools
 
 from dotenv import load_dotenv, find_dotenv
 
-from aiocoap import Message, Context, POST
+from aiocoap import Message, Context, POST, CON, NON
+from aiocoap.numbers.codes import SERVICE_UNAVAILABLE
 from aiocoap.error import NetworkError
 
 from utils import (
     sys_exc,
-    round_temp,
-    get_delta,
-    generate_payload,
-    get_next_interval,
+    get_env_bool,
     set_logging_handler,
-    get_details,
+    telemetry,
 )
+from utils.engine import (
+    Simulator,
+    Transport,
+    run,
+)
+from utils.payload import compile_payload
 
 
-async def main():
-    # Load env variables
-    load_dotenv(find_dotenv())
-    LOCATION_DATA = os.environ["LOCATION_DATA"]
+class CoAPSender:
+    # Requests sent as tasks with up to `concurrency` of them in flight,
+    # send() waits for a free slot (backpressure). The client context is
+    # kept on network errors, sending is paused for `backoff` seconds instead
+    def __init__(
+        self,
+        uri: str,
+        concurrency: int = 16,
+        non_confirmable: bool = False,
+        backoff: float = 1,
+    ) -> None:
+        self.uri = uri
+        self.concurrency = max(1, concurrency)
+        self.mtype = NON if non_confirmable else CON
+        self.backoff = backoff
+        self.client = None
+        self._semaphore = None
+        self._tasks = set()
+        # Responses to NON requests not received yet
+        self._responses = set()
+        self._paused_until = 0
+
+    async def start(self) -> None:
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self.client = await Context.create_client_context()
+
+    def paused_for(self) -> float:
+        return max(0, self._paused_until - time.monotonic())
+
+    def _on_response(
+        self,
+        serial_number: str,
+        message: bytes,
+        start: float,
+        response: Message,
+    ) -> None:
+        if response.code.is_successful():
+            if self.mtype is CON:
+                telemetry.sent(len(message), time.monotonic() - start)
+        else:
+            telemetry.failed()
+            if response.code == SERVICE_UNAVAILABLE:
+                # Server overloaded, retry after Max-Age seconds
+                self._paused_until = time.monotonic() + (
+                    response.opt.max_age or self.backoff
+                )
+        if telemetry.sample():
+            logging.info(f"Result ({response.code}): {response.payload}")
+            logging.info(
+                f"Sent message from device ({serial_number}) to URI {self.uri}: {message}"
+            )
+
+    def _on_error(
+        self,
+        serial_number: str,
+        message: bytes,
+        err: Exception,
+    ) -> None:
+        telemetry.failed()
+        if err.__traceback__ is None:
+            # Set on a response future, never raised
+            logging.error(f"{type(err)} | {err}")
+        else:
+            logging.error(sys_exc((type(err), err, err.__traceback__)))
+        logging.error(
+            f"Error when sending message from device ({serial_number}) to URI {self.uri}: {message}"
+        )
+        if isinstance(err, NetworkError):
+            self._paused_until = time.monotonic() + self.backoff
+
+    def _on_non_response(
+        self,
+        serial_number: str,
+        message: bytes,
+        start: float,
+        future: asyncio.Future,
+    ) -> None:
+        self._responses.discard(future)
+        if future.cancelled():
+            return
+        err = future.exception()
+        if err is not None:
+            self._on_error(serial_number, message, err)
+        else:
+            self._on_response(serial_number, message, start, future.result())
+
+    async def _request(
+        self,
+        serial_number: str,
+        message: bytes,
+    ) -> None:
+        try:
+            request = Message(
+                code=POST,
+                mtype=self.mtype,
+                payload=message,
+                uri=self.uri,
+            )
+            start = time.monotonic()
+            response = self.client.request(request).response
+            if self.mtype is NON:
+                # Not acknowledged: counted as sent once handed over to the
+                # client (put on the wire by it right away), the slot is
+                # freed without waiting for the response. Error responses
+                # and network errors are still counted as failed
+                telemetry.sent(len(message))
+                self._responses.add(response)
+                response.add_done_callback(
+                    functools.partial(
+                        self._on_non_response,
+                        serial_number,
+                        message,
+                        start,
+                    )
+                )
+                return
+            self._on_response(serial_number, message, start, await response)
+
+        except Exception as err:
+            self._on_error(serial_number, message, err)
+
+        finally:
+            self._semaphore.release()
+
+    async def send(
+        self,
+        serial_number: str,
+        message: bytes,
+    ) -> None:
+        await self._semaphore.acquire()
+        task = asyncio.create_task(self._request(serial_number, message))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def close(self) -> None:
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+        for response in list(self._responses):
+            response.cancel()
+        if self.client is not None:
+            await self.client.shutdown()
+
+
+class CoAPTransport(Transport):
+    # JSON payloads POSTed to `uri` by the CoAPSender, sending is paused
+    # after a network error or a 5.03 response
+    name = "coap"
+
+    def __init__(
+        self,
+        sender: CoAPSender,
+        manufacturer: str,
+        dev_family: str,
+    ) -> None:
+        self.sender = sender
+        # Payload builder
+        self.build_payload = compile_payload(
+            manufacturer=manufacturer,
+            dev_family=dev_family,
+            location_key="pos",
+            lat_key="lat",
+            lng_key="long",
+            temperature_key="tmp",
+            manufacturer_key="manufacturer",
+            dev_family_key="family",
+            serial_number_key="sn",
+            _json=True,
+        )
+
+    async def start(self) -> None:
+        await self.sender.start()
+
+    def encode(
+        self,
+        _id: int,
+        temperature: float,
+        location: dict,
+        timestamp: int = None,
+    ) -> bytes:
+        return self.build_payload(
+            temperature,
+            self.devices.serial_numbers[_id],
+            location["city"],
+            location["lat"],
+            location["lng"],
+            timestamp=timestamp,
+        )
+
+    async def send_batch(
+        self,
+        records: list,
+    ) -> list:
+        retry = list()
+        for _id, message in records:
+            try:
+                await self.sender.send(self.devices.serial_numbers[_id], message)
+
+            except Exception:
+                logging.error(sys_exc(sys.exc_info()))
+                retry.append(_id)
+        return retry
+
+    def paused_for(self) -> float:
+        return self.sender.paused_for()
+
+    async def close(self) -> None:
+        await self.sender.close()
+
+
+def get_simulator() -> Simulator:
     COAP_HOST = os.environ["COAP_HOST"]
     COAP_PORT = int(os.environ["COAP_PORT"])
     COAP_PATH = os.environ["COAP_PATH"]
-    COAP_DEVICES = min(25, int(os.environ["COAP_DEVICES"]))
-    COAP_MIN_ITERVAL_MS = int(os.environ["COAP_MIN_ITERVAL_MS"])
-    COAP_MAX_ITERVAL_MS = int(os.environ["HTTP_MAX_ITERVAL_MS"])
+    COAP_CONCURRENCY = int(os.environ.get("COAP_CONCURRENCY", 16))
+    COAP_NON_CONFIRMABLE = get_env_bool("COAP_NON_CONFIRMABLE")
     COAP_URI = f"coap://{COAP_HOST}:{COAP_PORT}/{COAP_PATH}"
 
     SEED = "_CoAP"
     MANUFACTURER = "CoAP"
     DEVICE_FAMILY = "CPd"
 
-    # Devices cache
-    devices = dict()
-    for _id in range(COAP_DEVICES):
-        serial_number, location, temp_mu, temp_sigma = get_details(
-            _id,
-            SEED,
-            LOCATION_DATA,
-        )
-        devices[_id] = {
-            "serial_number": serial_number,
-            "temperature": get_delta(temp_mu, temp_sigma),
-            "last_sent": get_next_interval(
-                COAP_MIN_ITERVAL_MS,
-                COAP_MAX_ITERVAL_MS,
-            ),
-            "location": location,
-        }
-
-    client = await Context.create_client_context()
-
-    try:
-        message = None
-        while True:
-            for _id in range(COAP_DEVICES):
-                try:
-                    if devices[_id]["last_sent"] < time.time():
-                        devices[_id]["temperature"] = round_temp(
-                            devices[_id]["temperature"] + get_delta()
-                        )
-                        message = generate_payload(
-                            devices[_id]["temperature"],
-                            serial_number=devices[_id]["serial_number"],
-                            manufacturer=MANUFACTURER,
-                            dev_family=DEVICE_FAMILY,
-                            location=devices[_id]["location"]["city"],
-                            lat=devices[_id]["location"]["lat"],
-                            lng=devices[_id]["location"]["lng"],
-                            location_key="pos",
-                            lat_key="lat",
-                            lng_key="long",
-                            temperature_key="tmp",
-                            manufacturer_key="manufacturer",
-                            dev_family_key="family",
-                            serial_number_key="sn",
-                        )
-                        request = Message(
-                            code=POST,
-                            payload=json.dumps(message).encode("utf-8"),
-                            uri=COAP_URI,
-                        )
-                        response = await client.request(request).response
-                        logging.info(f"Result ({response.code}): {response.payload}")
-                        devices[_id]["last_sent"] = get_next_interval(
-                            COAP_MIN_ITERVAL_MS,
-                            COAP_MAX_ITERVAL_MS,
-                        )
-                        logging.info(
-                            f"Sent message from device ({devices[_id]['serial_number']}) to URI {COAP_URI}: {message}"
-                        )
-
-                except (Exception, NetworkError) as err:
-                    logging.error(sys_exc(sys.exc_info()))
-                    logging.error(
-                        f"Error when sending message from device ({devices[_id]['serial_number']}) to URI {COAP_URI}: {message}"
-                    )
-                    if err.__class__ == NetworkError:
-                        client = await Context.create_client_context()
-                        await asyncio.sleep(1)
-
-            await asyncio.sleep(0.05)
-
-    except KeyboardInterrupt:
-        logging.info("CTRL-C pressed by user")
+    sender = CoAPSender(
+        COAP_URI,
+        concurrency=COAP_CONCURRENCY,
+        non_confirmable=COAP_NON_CONFIRMABLE,
+    )
+    return Simulator.from_env(
+        CoAPTransport(
+            sender,
+            MANUFACTURER,
+            DEVICE_FAMILY,
+        ),
+        "COAP",
+        SEED,
+    )
 
 
 if __name__ == "__main__":
 
-    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
-    set_logging_handler(FILE_APP)
-
     # Load env variables
     load_dotenv(find_dotenv())
 
-    asyncio.run(main())
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
+
+    try:
+        asyncio.run(run(get_simulator()))
+    except KeyboardInterrupt:
+        logging.info("CTRL-C pressed by user")
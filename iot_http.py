@@ -1,28 +1,152 @@
 import os
 import sys
+import json
 import time
+import asyncio
 import logging
+import aiohttp
 import requests
 
 from dotenv import load_dotenv, find_dotenv
 
 from utils import (
     sys_exc,
-    round_temp,
-    get_delta,
-    generate_payload,
-    get_next_interval,
+    get_env_bool,
     set_logging_handler,
-    get_details,
+    telemetry,
 )
+from utils.engine import (
+    Simulator,
+    Transport,
+    run,
+)
+from utils.payload import compile_payload
+
 
+class RestProxyBatcher:
+    # Records buffered per topic, sent in batches of `batch_size` records or
+    # once the first record has been buffered for `linger_ms`
+    HEADERS = {
+        "Content-Type": "application/vnd.kafka.json.v2+json",
+        "Accept": "application/vnd.kafka.v2+json, application/vnd.kafka+json, application/json",
+    }
 
-class HTTPRestProxyClient:
     def __init__(
         self,
         base_url: str,
+        batch_size: int = 1,
+        linger_ms: int = 0,
     ) -> None:
         self.base_url = base_url
+        self.batch_size = max(1, batch_size)
+        self.linger = linger_ms / 1000
+        self._records = dict()
+        self._buffered_at = dict()
+
+    def _buffer(
+        self,
+        topic_name: str,
+        key: str,
+        value: dict,
+    ) -> bool:
+        records = self._records.get(topic_name)
+        if records is None:
+            records = self._records[topic_name] = list()
+            self._buffered_at[topic_name] = time.monotonic()
+        records.append(
+            {
+                "key": key,
+                "value": value,
+            }
+        )
+        return len(records) >= self.batch_size or self.linger <= 0
+
+    def _take(
+        self,
+        topic_name: str,
+    ) -> list:
+        self._buffered_at.pop(topic_name, None)
+        return self._records.pop(topic_name, None)
+
+    def _expired(self) -> list:
+        now = time.monotonic()
+        return [
+            topic_name
+            for topic_name, buffered_at in self._buffered_at.items()
+            if now - buffered_at >= self.linger
+        ]
+
+    def next_flush_in(self) -> float:
+        if not self._buffered_at:
+            return None
+        return max(
+            0,
+            min(self._buffered_at.values()) + self.linger - time.monotonic(),
+        )
+
+    def _delivery_report(
+        self,
+        topic_name: str,
+        records: list,
+        size: int,
+        status_code: int,
+        response,
+        latency: float,
+    ) -> None:
+        if status_code != 200 or not isinstance(response, dict):
+            # Error or not a JSON response (e.g. HTML page of a load balancer)
+            telemetry.failed(len(records))
+            logging.error(
+                f"Unable to produce {len(records)} message(s) to topic {topic_name} ({status_code} | {response})"
+            )
+            return
+
+        # One offset per record, error_code set for the ones not produced
+        offsets = response.get("offsets") or list()
+        failed = 0
+        for n, record in enumerate(records):
+            offset = offsets[n] if n < len(offsets) else {"error": "Missing offset"}
+            if offset.get("error_code") is None and offset.get("error") is None:
+                if telemetry.sample():
+                    logging.info(
+                        f"Message produced to topic {topic_name}: {record['key']} | {record['value']}"
+                    )
+            else:
+                failed += 1
+                logging.error(
+                    f"Unable to produce message to topic {topic_name}: {record['key']} | {record['value']} ({offset.get('error_code')} | {offset.get('error')})"
+                )
+        if failed:
+            telemetry.failed(failed)
+        if failed < len(records):
+            telemetry.sent(
+                size * (len(records) - failed) // len(records),
+                latency,
+                count=len(records) - failed,
+            )
+
+
+class HTTPRestProxyClient(RestProxyBatcher):
+    def __init__(
+        self,
+        base_url: str,
+        batch_size: int = 1,
+        linger_ms: int = 0,
+        pool_size: int = 10,
+    ) -> None:
+        super().__init__(
+            base_url,
+            batch_size=batch_size,
+            linger_ms=linger_ms,
+        )
+        # Persistent (keep-alive) connections reused by all requests
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
     def _submit(
         self,
@@ -30,23 +154,15 @@ class HTTPRestProxyClient:
         verb: str = "GET",
         headers: dict = None,
         body: dict = None,
+        data: bytes = None,
     ):
-        if verb == "POST":
-            session = requests.post
-        elif verb == "PATCH":
-            session = requests.patch
-        elif verb == "PUT":
-            session = requests.put
-        elif verb == "DELETE":
-            session = requests.delete
-        else:
-            session = requests.get
-
         try:
-            response = session(
+            response = self.session.request(
+                verb,
                 path,
                 headers=headers,
                 json=body,
+                data=data,
             )
         except Exception:
             status_code = 500
@@ -54,7 +170,10 @@ class HTTPRestProxyClient:
             logging.error(response)
         else:
             status_code = response.status_code
-            response = response.json()
+            try:
+                response = response.json()
+            except ValueError:
+                response = response.text
 
         return status_code, response
 
@@ -64,116 +183,324 @@ class HTTPRestProxyClient:
         key: str,
         value: dict,
     ) -> None:
-        headers = {
-            "Content-Type": "application/vnd.kafka.json.v2+json",
-            "Accept": "application/vnd.kafka.v2+json, application/vnd.kafka+json, application/json",
-        }
-        status_code, response = self._submit(
-            f"{self.base_url}/topics/{topic_name}",
-            verb="POST",
-            headers=headers,
-            body={
-                "records": [
-                    {
-                        "key": key,
-                        "value": value,
-                    }
-                ]
-            },
+        if self._buffer(topic_name, key, value):
+            self.flush(topic_name)
+
+    def poll(self) -> None:
+        for topic_name in self._expired():
+            self.flush(topic_name)
+
+    def flush(
+        self,
+        topic_name: str = None,
+    ) -> None:
+        if topic_name is None:
+            for topic_name in list(self._records.keys()):
+                self.flush(topic_name)
+            return
+
+        records = self._take(topic_name)
+        if not records:
+            return
+        try:
+            data = json.dumps({"records": records}).encode("utf-8")
+            start = time.monotonic()
+            status_code, response = self._submit(
+                f"{self.base_url}/topics/{topic_name}",
+                verb="POST",
+                headers=self.HEADERS,
+                data=data,
+            )
+            self._delivery_report(
+                topic_name,
+                records,
+                len(data),
+                status_code,
+                response,
+                time.monotonic() - start,
+            )
+        except Exception:
+            # Taken from the buffer already, so never lost silently
+            telemetry.failed(len(records))
+            logging.error(sys_exc(sys.exc_info()))
+
+    def close(self) -> None:
+        self.flush()
+        self.session.close()
+
+
+class AsyncHTTPRestProxyClient(RestProxyBatcher):
+    # Up to `concurrency` requests in flight over keep-alive connections,
+    # flush() waits for a free slot when the Rest Proxy is slow (backpressure)
+    def __init__(
+        self,
+        base_url: str,
+        batch_size: int = 1,
+        linger_ms: int = 0,
+        concurrency: int = 8,
+    ) -> None:
+        super().__init__(
+            base_url,
+            batch_size=batch_size,
+            linger_ms=linger_ms,
         )
-        if status_code == 200:
-            logging.info(f"Message produced to topic {topic_name}: {key} | {value}")
-        else:
-            logging.error(
-                f"Unable to produce message to topic {topic_name}: {key} | {value} ({status_code | {response}})"
+        self.concurrency = max(1, concurrency)
+        self.session = None
+        self._semaphore = None
+        self._tasks = set()
+
+    async def start(self) -> None:
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.concurrency,
+                keepalive_timeout=60,
+            ),
+        )
+
+    async def _submit(
+        self,
+        path: str,
+        verb: str = "GET",
+        headers: dict = None,
+        data: bytes = None,
+    ):
+        try:
+            async with self.session.request(
+                verb,
+                path,
+                headers=headers,
+                data=data,
+            ) as response:
+                status_code = response.status
+                response = await response.text()
+            try:
+                response = json.loads(response)
+            except ValueError:
+                pass
+        except Exception:
+            status_code = 500
+            response = sys_exc(sys.exc_info())
+            logging.error(response)
+
+        return status_code, response
+
+    async def _send(
+        self,
+        topic_name: str,
+        records: list,
+        data: bytes,
+    ) -> None:
+        try:
+            start = time.monotonic()
+            status_code, response = await self._submit(
+                f"{self.base_url}/topics/{topic_name}",
+                verb="POST",
+                headers=self.HEADERS,
+                data=data,
+            )
+            self._delivery_report(
+                topic_name,
+                records,
+                len(data),
+                status_code,
+                response,
+                time.monotonic() - start,
             )
+        except Exception:
+            telemetry.failed(len(records))
+            logging.error(sys_exc(sys.exc_info()))
+        finally:
+            self._semaphore.release()
+
+    async def produce_json(
+        self,
+        topic_name: str,
+        key: str,
+        value: dict,
+    ) -> None:
+        if self._buffer(topic_name, key, value):
+            await self.flush(topic_name)
 
+    async def poll(self) -> None:
+        for topic_name in self._expired():
+            await self.flush(topic_name)
 
-if __name__ == "__main__":
+    async def flush(
+        self,
+        topic_name: str = None,
+    ) -> None:
+        if topic_name is None:
+            for topic_name in list(self._records.keys()):
+                await self.flush(topic_name)
+            return
 
-    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
-    set_logging_handler(FILE_APP)
+        records = self._take(topic_name)
+        if not records:
+            return
+        data = json.dumps({"records": records}).encode("utf-8")
+        await self._semaphore.acquire()
+        task = asyncio.create_task(self._send(topic_name, records, data))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
 
-    # Load env variables
-    load_dotenv(find_dotenv())
-    LOCATION_DATA = os.environ["LOCATION_DATA"]
+    async def close(self) -> None:
+        await self.flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+        await self.session.close()
+
+
+class RestProxyTransport(Transport):
+    # Records produced to `topic` through the Rest Proxy keyed by serial
+    # number, either with the HTTPRestProxyClient (requests sent from the
+    # event loop thread, blocking it) or the AsyncHTTPRestProxyClient
+    name = "http"
+
+    def __init__(
+        self,
+        client: RestProxyBatcher,
+        topic: str,
+        manufacturer: str,
+        dev_family: str,
+    ) -> None:
+        self.client = client
+        self.topic = topic
+        self.is_async = isinstance(client, AsyncHTTPRestProxyClient)
+        # Payload builder
+        self.build_payload = compile_payload(
+            manufacturer=manufacturer,
+            dev_family=dev_family,
+            location_key="loc",
+            lat_key="lt",
+            lng_key="lg",
+            temperature_key="temp",
+            manufacturer_key="mnf",
+            dev_family_key="prd",
+            timestamp_key="tm",
+            serial_number_key="sn",
+        )
+
+    async def start(self) -> None:
+        if self.is_async:
+            await self.client.start()
+
+    def encode(
+        self,
+        _id: int,
+        temperature: float,
+        location: dict,
+        timestamp: int = None,
+    ) -> dict:
+        return self.build_payload(
+            temperature,
+            self.devices.serial_numbers[_id],
+            location["city"],
+            location["lat"],
+            location["lng"],
+            timestamp=timestamp,
+        )
+
+    def dump(
+        self,
+        record: dict,
+    ) -> bytes:
+        return json.dumps(record).encode("utf-8")
+
+    def load(
+        self,
+        payload: bytes,
+    ) -> dict:
+        return json.loads(payload)
+
+    async def send_batch(
+        self,
+        records: list,
+    ) -> list:
+        client = self.client
+        serial_numbers = self.devices.serial_numbers
+        retry = list()
+        for _id, value in records:
+            try:
+                if self.is_async:
+                    await client.produce_json(self.topic, serial_numbers[_id], value)
+                else:
+                    client.produce_json(self.topic, serial_numbers[_id], value)
+
+            except Exception:
+                logging.error(sys_exc(sys.exc_info()))
+                retry.append(_id)
+        return retry
+
+    async def poll(self) -> None:
+        if self.is_async:
+            await self.client.poll()
+        else:
+            self.client.poll()
+
+    def next_flush_in(self) -> float:
+        return self.client.next_flush_in()
+
+    async def close(self) -> None:
+        logging.info("Flushing HTTP client")
+        if self.is_async:
+            await self.client.close()
+        else:
+            self.client.close()
+        logging.info("Stopped HTTP client")
+
+
+def get_simulator() -> Simulator:
     HTTP_SCHEME = os.environ["HTTP_SCHEME"]
     HTTP_HOST = os.environ["HTTP_HOST"]
     HTTP_PORT = int(os.environ["HTTP_PORT"])
-    KAFKA_HTTP_CLIENT_ID = os.environ["KAFKA_HTTP_CLIENT_ID"]
     KAFKA_HTTP_TOPIC = os.environ["KAFKA_HTTP_TOPIC"]
-    KAFKA_SCHEMA_FILE = os.environ["KAFKA_SCHEMA_FILE"]
-    HTTP_DEVICES = min(25, int(os.environ["HTTP_DEVICES"]))
-    HTTP_MIN_ITERVAL_MS = int(os.environ["HTTP_MIN_ITERVAL_MS"])
-    HTTP_MAX_ITERVAL_MS = int(os.environ["HTTP_MAX_ITERVAL_MS"])
+    HTTP_BATCH_SIZE = int(os.environ.get("HTTP_BATCH_SIZE", 1))
+    HTTP_LINGER_MS = int(os.environ.get("HTTP_LINGER_MS", 0))
+    HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 10))
+    HTTP_ASYNC = get_env_bool("HTTP_ASYNC")
+    HTTP_CONCURRENCY = int(os.environ.get("HTTP_CONCURRENCY", 8))
 
     SEED = "http://"
     MANUFACTURER = "KafkaHttpTemp"
     DEVICE_FAMILY = "Kh1"
 
-    # Devices cache
-    devices = dict()
-    for _id in range(HTTP_DEVICES):
-        serial_number, location, temp_mu, temp_sigma = get_details(
-            _id,
-            SEED,
-            LOCATION_DATA,
+    base_url = f"{HTTP_SCHEME}://{HTTP_HOST}:{HTTP_PORT}"
+    if HTTP_ASYNC:
+        client = AsyncHTTPRestProxyClient(
+            base_url,
+            batch_size=HTTP_BATCH_SIZE,
+            linger_ms=HTTP_LINGER_MS,
+            concurrency=HTTP_CONCURRENCY,
         )
-        devices[_id] = {
-            "serial_number": serial_number,
-            "temperature": get_delta(temp_mu, temp_sigma),
-            "last_sent": get_next_interval(
-                HTTP_MIN_ITERVAL_MS,
-                HTTP_MAX_ITERVAL_MS,
-            ),
-            "location": location,
-        }
+    else:
+        client = HTTPRestProxyClient(
+            base_url,
+            batch_size=HTTP_BATCH_SIZE,
+            linger_ms=HTTP_LINGER_MS,
+            pool_size=HTTP_POOL_SIZE,
+        )
+    return Simulator.from_env(
+        RestProxyTransport(
+            client,
+            KAFKA_HTTP_TOPIC,
+            MANUFACTURER,
+            DEVICE_FAMILY,
+        ),
+        "HTTP",
+        SEED,
+    )
 
-    client = HTTPRestProxyClient(f"{HTTP_SCHEME}://{HTTP_HOST}:{HTTP_PORT}")
 
-    # Main thread loop
-    try:
-        while True:
-            for _id in range(HTTP_DEVICES):
-                try:
-                    if devices[_id]["last_sent"] < time.time():
-                        devices[_id]["temperature"] = round_temp(
-                            devices[_id]["temperature"] + get_delta()
-                        )
-                        value = generate_payload(
-                            devices[_id]["temperature"],
-                            serial_number=devices[_id]["serial_number"],
-                            manufacturer=MANUFACTURER,
-                            dev_family=DEVICE_FAMILY,
-                            location=devices[_id]["location"]["city"],
-                            lat=devices[_id]["location"]["lat"],
-                            lng=devices[_id]["location"]["lng"],
-                            location_key="loc",
-                            lat_key="lt",
-                            lng_key="lg",
-                            temperature_key="temp",
-                            manufacturer_key="mnf",
-                            dev_family_key="prd",
-                            timestamp_key="tm",
-                            serial_number_key="sn",
-                        )
-                        client.produce_json(
-                            KAFKA_HTTP_TOPIC,
-                            devices[_id]["serial_number"],
-                            value,
-                        )
-                        devices[_id]["last_sent"] = get_next_interval(
-                            HTTP_MIN_ITERVAL_MS,
-                            HTTP_MAX_ITERVAL_MS,
-                        )
-
-                except Exception:
-                    logging.error(sys_exc(sys.exc_info()))
-
-            time.sleep(0.05)
+if __name__ == "__main__":
 
+    # Load env variables
+    load_dotenv(find_dotenv())
+
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
+
+    try:
+        asyncio.run(run(get_simulator()))
     except KeyboardInterrupt:
         logging.info("CTRL-C pressed by user")
-
-    finally:
-        logging.info("Stopped HTTP client")
@@ -1,29 +1,74 @@
 import os
 import sys
-import time
+import asyncio
 import logging
+import threading
 
 from dotenv import load_dotenv, find_dotenv
 from configparser import ConfigParser
 
 from confluent_kafka import Producer
-from confluent_kafka.serialization import (
-    StringSerializer,
-    SerializationContext,
-    MessageField,
-)
 from confluent_kafka.schema_registry import SchemaRegistryClient
-from confluent_kafka.schema_registry.avro import AvroSerializer
 
 from utils import (
     sys_exc,
-    round_temp,
-    get_delta,
-    generate_payload,
-    get_next_interval,
+    get_env_bool,
     set_logging_handler,
-    get_details,
+    telemetry,
+)
+from utils.avro import AvroValueSerializer
+from utils.devices import DeviceTable
+from utils.engine import (
+    Simulator,
+    Transport,
+    run,
 )
+from utils.payload import compile_payload
+
+
+# Producer throughput profiles (env var KAFKA_PRODUCER_PROFILE)
+PRODUCER_PROFILES = {
+    "latency": {
+        "linger.ms": 0,
+        "batch.size": 16384,
+        "compression.type": "none",
+        "acks": 1,
+        "queue.buffering.max.messages": 10000,
+    },
+    "balanced": {
+        "linger.ms": 5,
+        "batch.size": 131072,
+        "compression.type": "lz4",
+        "acks": "all",
+        "queue.buffering.max.messages": 100000,
+    },
+    "max-throughput": {
+        "linger.ms": 100,
+        "batch.size": 1048576,
+        "compression.type": "zstd",
+        "acks": 1,
+        "queue.buffering.max.messages": 1000000,
+    },
+}
+
+
+def get_producer_config(
+    kafka_config: dict,
+    profile: str = None,
+    batch_accounting: bool = False,
+) -> dict:
+    # Profile settings override the ones on the config file
+    result = dict(kafka_config)
+    if profile:
+        if profile not in PRODUCER_PROFILES:
+            raise ValueError(
+                f"Invalid producer profile '{profile}', it must be one of: {', '.join(PRODUCER_PROFILES)}"
+            )
+        result.update(PRODUCER_PROFILES[profile])
+    if batch_accounting:
+        # Delivery reports (Python callbacks) only for the records failed
+        result["delivery.report.only.error"] = True
+    return result
 
 
 def delivery_report(
@@ -35,131 +80,260 @@ def delivery_report(
     else:
         key = msg.key()
     if err is not None:
+        telemetry.failed()
         logging.error(
             f"Delivery failed for record/key '{key}' for the topic '{msg.topic()}': {err}"
         )
     else:
-        logging.info(
-            f"Record/key '{key}' successfully produced to topic/partition '{msg.topic()}/{msg.partition()}' at offset #{msg.offset()}"
+        telemetry.sent(len(msg), msg.latency())
+        if telemetry.sample():
+            logging.info(
+                f"Record/key '{key}' successfully produced to topic/partition '{msg.topic()}/{msg.partition()}' at offset #{msg.offset()}"
+            )
+
+
+class DeliveryPoller(threading.Thread):
+    # Serves the delivery reports on its own thread, so the main loop does
+    # not call producer.poll() before every record. With `batch_accounting`
+    # (producer set with delivery.report.only.error) there is no callback
+    # per record delivered: the records delivered are worked out on every
+    # poll from the records produced and the ones still in the queue
+    def __init__(
+        self,
+        producer: Producer,
+        timeout: float = 0.1,
+        batch_accounting: bool = False,
+    ) -> None:
+        super().__init__(daemon=True)
+        self.producer = producer
+        self.timeout = timeout
+        self.batch_accounting = batch_accounting
+        self.on_delivery = self._failed if batch_accounting else delivery_report
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._produced = 0
+        self._produced_bytes = 0
+        self._failed_count = 0
+        self._accounted = 0
+
+    def produced(
+        self,
+        size: int,
+    ) -> None:
+        if self.batch_accounting:
+            with self._lock:
+                self._produced += 1
+                self._produced_bytes += size
+
+    def _failed(
+        self,
+        err,
+        msg,
+    ) -> None:
+        self._failed_count += 1
+        delivery_report(err, msg)
+
+    def account(self) -> None:
+        # Records produced read before the queue length, so a record being
+        # produced is never counted as delivered
+        with self._lock:
+            produced = self._produced
+            produced_bytes = self._produced_bytes
+        delivered = produced - self._failed_count - len(self.producer) - self._accounted
+        if delivered > 0:
+            self._accounted += delivered
+            telemetry.sent(
+                round(produced_bytes * delivered / produced),
+                count=delivered,
+            )
+
+    def run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                self.producer.poll(self.timeout)
+                if self.batch_accounting:
+                    self.account()
+            except Exception:
+                logging.error(sys_exc(sys.exc_info()))
+
+    def close(
+        self,
+        timeout: float = None,
+    ) -> int:
+        # Stop polling and flush the producer (on the calling thread)
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+        result = self.producer.flush() if timeout is None else self.producer.flush(timeout)
+        if self.batch_accounting:
+            self.account()
+        return result
+
+
+class KafkaTransport(Transport):
+    # Avro records produced to `topic` keyed by serial number, delivery
+    # reports served by the DeliveryPoller thread
+    name = "kafka"
+    timestamp_epoch = False
+
+    def __init__(
+        self,
+        producer: Producer,
+        poller: DeliveryPoller,
+        avro_serializer: AvroValueSerializer,
+        topic: str,
+        manufacturer: str,
+        dev_family: str,
+    ) -> None:
+        self.producer = producer
+        self.poller = poller
+        self.avro_serializer = avro_serializer
+        self.topic = topic
+        self.keys = None
+        # Payload builder
+        self.build_payload = compile_payload(
+            manufacturer=manufacturer,
+            dev_family=dev_family,
+            location_key="region",
+            lat_key="lat",
+            lng_key="lng",
+            temperature_key="temperature",
+            manufacturer_key="manufacturer",
+            dev_family_key="product",
+            timestamp_key="datetime",
+            serial_number_key="id",
+            _timestamp_epoch=False,
         )
 
+    def bind(
+        self,
+        devices: DeviceTable,
+    ) -> None:
+        super().bind(devices)
+        # Keys (serial numbers) never change, encoded once
+        self.keys = [
+            serial_number.encode("utf-8") for serial_number in devices.serial_numbers
+        ]
 
-if __name__ == "__main__":
+    async def start(self) -> None:
+        self.poller.start()
 
-    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
-    set_logging_handler(FILE_APP)
+    def encode(
+        self,
+        _id: int,
+        temperature: float,
+        location: dict,
+        timestamp: str = None,
+    ) -> bytes:
+        value = self.build_payload(
+            temperature,
+            self.devices.serial_numbers[_id],
+            location["city"],
+            location["lat"],
+            location["lng"],
+            timestamp=timestamp,
+        )
+        return self.avro_serializer(value)
 
-    # Load env variables
-    load_dotenv(find_dotenv())
-    LOCATION_DATA = os.environ["LOCATION_DATA"]
+    async def send_batch(
+        self,
+        records: list,
+    ) -> list:
+        producer = self.producer
+        poller = self.poller
+        keys = self.keys
+        retry = list()
+        for _id, value in records:
+            try:
+                producer.produce(
+                    topic=self.topic,
+                    key=keys[_id],
+                    value=value,
+                    on_delivery=poller.on_delivery,
+                )
+                poller.produced(len(value))
+
+            except Exception:
+                # e.g. BufferError, local queue full
+                logging.error(sys_exc(sys.exc_info()))
+                retry.append(_id)
+        return retry
+
+    async def close(self) -> None:
+        logging.info("Flushing Kafka Producer")
+        self.poller.close()
+
+
+def get_simulator() -> Simulator:
     KAFKA_CONFIG_FILE = os.environ["KAFKA_CONFIG_FILE"]
     KAFKA_CLIENT_ID = os.environ["KAFKA_CLIENT_ID"]
     KAFKA_TOPIC = os.environ["KAFKA_TOPIC"]
-    KAFKA_MIN_ITERVAL_MS = int(os.environ["KAFKA_MIN_ITERVAL_MS"])
-    KAFKA_MAX_ITERVAL_MS = int(os.environ["KAFKA_MAX_ITERVAL_MS"])
     KAFKA_SCHEMA_FILE = os.environ["KAFKA_SCHEMA_FILE"]
-    KAFKA_DEVICES = min(25, int(os.environ["KAFKA_DEVICES"]))
+    KAFKA_PRODUCER_PROFILE = os.environ.get("KAFKA_PRODUCER_PROFILE") or None
+    KAFKA_BATCH_ACCOUNTING = get_env_bool("KAFKA_BATCH_ACCOUNTING")
 
     SEED = "*Kafka"
     MANUFACTURER = "KafkaTemp"
     DEVICE_FAMILY = "K1"
 
-    # Devices cache
-    devices = dict()
-    for _id in range(KAFKA_DEVICES):
-        serial_number, location, temp_mu, temp_sigma = get_details(
-            _id,
-            SEED,
-            LOCATION_DATA,
-        )
-        devices[_id] = {
-            "serial_number": serial_number,
-            "temperature": get_delta(temp_mu, temp_sigma),
-            "last_sent": get_next_interval(
-                KAFKA_MIN_ITERVAL_MS,
-                KAFKA_MAX_ITERVAL_MS,
-            ),
-            "location": location,
-        }
-
     config = ConfigParser()
     config.read(KAFKA_CONFIG_FILE)
 
     # Producer
-    kafka_config = dict(config["kafka"])
+    kafka_config = get_producer_config(
+        config["kafka"],
+        profile=KAFKA_PRODUCER_PROFILE,
+        batch_accounting=KAFKA_BATCH_ACCOUNTING,
+    )
     kafka_config.update(
         {
             "client.id": KAFKA_CLIENT_ID,
         }
     )
     producer = Producer(kafka_config)
+    if KAFKA_PRODUCER_PROFILE:
+        logging.info(f"Producer profile '{KAFKA_PRODUCER_PROFILE}'")
+
+    # Delivery reports served on a dedicated thread
+    poller = DeliveryPoller(
+        producer,
+        batch_accounting=KAFKA_BATCH_ACCOUNTING,
+    )
 
     # Schema Registry
     schema_registry_config = dict(config["schema-registry"])
     schema_registry_client = SchemaRegistryClient(schema_registry_config)
     with open(KAFKA_SCHEMA_FILE, "r") as f:
         schema_str = f.read()
-    avro_serializer = AvroSerializer(
+    avro_serializer = AvroValueSerializer(
         schema_registry_client,
-        schema_str=schema_str,
+        schema_str,
+        KAFKA_TOPIC,
+    )
+
+    return Simulator.from_env(
+        KafkaTransport(
+            producer,
+            poller,
+            avro_serializer,
+            KAFKA_TOPIC,
+            MANUFACTURER,
+            DEVICE_FAMILY,
+        ),
+        "KAFKA",
+        SEED,
     )
-    string_serializer = StringSerializer("utf_8")
 
-    # Main thread loop
-    try:
-        while True:
-            for _id in range(KAFKA_DEVICES):
-                try:
-                    if devices[_id]["last_sent"] < time.time():
-                        devices[_id]["temperature"] = round_temp(
-                            devices[_id]["temperature"] + get_delta()
-                        )
-                        producer.poll(0)
-                        value = generate_payload(
-                            devices[_id]["temperature"],
-                            serial_number=devices[_id]["serial_number"],
-                            manufacturer=MANUFACTURER,
-                            dev_family=DEVICE_FAMILY,
-                            location=devices[_id]["location"]["city"],
-                            lat=devices[_id]["location"]["lat"],
-                            lng=devices[_id]["location"]["lng"],
-                            location_key="region",
-                            lat_key="lat",
-                            lng_key="lng",
-                            temperature_key="temperature",
-                            manufacturer_key="manufacturer",
-                            dev_family_key="product",
-                            timestamp_key="datetime",
-                            serial_number_key="id",
-                            _timestamp_epoch=False,
-                        )
-
-                        producer.produce(
-                            topic=KAFKA_TOPIC,
-                            key=string_serializer(devices[_id]["serial_number"]),
-                            value=avro_serializer(
-                                value,
-                                SerializationContext(
-                                    KAFKA_TOPIC,
-                                    MessageField.VALUE,
-                                ),
-                            ),
-                            on_delivery=delivery_report,
-                        )
-
-                        devices[_id]["last_sent"] = get_next_interval(
-                            KAFKA_MIN_ITERVAL_MS,
-                            KAFKA_MAX_ITERVAL_MS,
-                        )
-
-                except Exception:
-                    logging.error(sys_exc(sys.exc_info()))
-
-            time.sleep(0.05)
 
+if __name__ == "__main__":
+
+    # Load env variables
+    load_dotenv(find_dotenv())
+
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
+
+    try:
+        asyncio.run(run(get_simulator()))
     except KeyboardInterrupt:
         logging.info("CTRL-C pressed by user")
-
-    finally:
-        logging.info("Flushing Kafka Producer")
-        producer.flush()
@@ -0,0 +1,274 @@
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import argparse
+import selectors
+import subprocess
+
+from dotenv import load_dotenv, find_dotenv
+
+from utils import (
+    sys_exc,
+    get_env_bool,
+    get_devices_count,
+    set_logging_handler,
+)
+
+
+PROTOCOLS = (
+    "kafka",
+    "http",
+    "mqtt",
+    "rabbitmq",
+    "syslog",
+    "coap",
+)
+
+
+class Worker:
+    # One iot_*.py process simulating shard `index` (of `shards`) of the
+    # device ids, its telemetry snapshots are read from a pipe (TELEMETRY_FD)
+    def __init__(
+        self,
+        protocol: str,
+        index: int,
+        shards: int,
+        stats_interval: float,
+        log_folder: str,
+    ) -> None:
+        self.protocol = protocol
+        self.index = index
+        read_fd, write_fd = os.pipe()
+        env = dict(os.environ)
+        env.update(
+            {
+                "SHARD_INDEX": str(index),
+                "SHARD_COUNT": str(shards),
+                "TELEMETRY_FD": str(write_fd),
+                "LOG_STATS_INTERVAL": str(stats_interval),
+            }
+        )
+        with open(
+            os.path.join(log_folder, f"iot_{protocol}.{index}.log"), "ab"
+        ) as log_file:
+            self.process = subprocess.Popen(
+                [sys.executable, f"iot_{protocol}.py"],
+                env=env,
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+                pass_fds=(write_fd,),
+                # Own session: CTRL-C in the terminal only reaches the
+                # supervisor, which stops the workers (a second SIGINT would
+                # interrupt their flush on close)
+                start_new_session=True,
+            )
+        os.close(write_fd)
+        self.reader = os.fdopen(read_fd, "r")
+
+    def __str__(self) -> str:
+        return f"iot_{self.protocol}.py #{self.index} (pid {self.process.pid})"
+
+
+class Supervisor:
+    # Spawns `workers` processes per protocol and logs their aggregated
+    # throughput every `interval` seconds
+    def __init__(
+        self,
+        protocols: list,
+        workers: int,
+        interval: float = 10,
+        log_folder: str = "logs",
+    ) -> None:
+        self.protocols = protocols
+        self.workers = workers
+        self.interval = interval
+        self.log_folder = log_folder
+        self._selector = selectors.DefaultSelector()
+        self._running = list()
+        self._reset()
+
+    def _reset(self) -> None:
+        self._started = time.monotonic()
+        self._stats = {
+            protocol: {
+                "sent": 0,
+                "failed": 0,
+                "bytes": 0,
+                "p99": None,
+                "lag_p99": None,
+            }
+            for protocol in self.protocols
+        }
+
+    def start(self) -> None:
+        os.makedirs(self.log_folder, exist_ok=True)
+        for protocol in self.protocols:
+            # No more shards than devices
+            devices = get_devices_count(
+                int(os.environ[f"{protocol.upper()}_DEVICES"]),
+                scale_mode=get_env_bool("SCALE_MODE"),
+            )
+            shards = max(1, min(self.workers, devices))
+            for index in range(shards):
+                worker = Worker(
+                    protocol,
+                    index,
+                    shards,
+                    self.interval,
+                    self.log_folder,
+                )
+                self._selector.register(worker.reader, selectors.EVENT_READ, worker)
+                self._running.append(worker)
+                logging.info(f"Started {worker}, shard {index + 1}/{shards}")
+
+    def _read(
+        self,
+        worker: Worker,
+    ) -> None:
+        line = worker.reader.readline()
+        if not line:
+            # Pipe closed, worker exited
+            self._selector.unregister(worker.reader)
+            worker.reader.close()
+            self._running.remove(worker)
+            logging.warning(
+                f"Stopped {worker}, exit code {worker.process.wait()} (see {self.log_folder}/iot_{worker.protocol}.{worker.index}.log)"
+            )
+            return
+        self._add(worker, line)
+
+    def _add(
+        self,
+        worker: Worker,
+        line: str,
+    ) -> None:
+        try:
+            snapshot = json.loads(line)
+        except ValueError:
+            logging.error(f"Invalid telemetry from {worker}: {line.strip()}")
+            return
+        stats = self._stats[worker.protocol]
+        for key in ("sent", "failed", "bytes"):
+            stats[key] += snapshot[key]
+        for key in ("p99", "lag_p99"):
+            if key in snapshot:
+                stats[key] = max(stats[key] or 0, snapshot[key])
+
+    def _log(self) -> None:
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        total = 0
+        for protocol, stats in self._stats.items():
+            workers = sum(1 for worker in self._running if worker.protocol == protocol)
+            total += stats["sent"]
+            summary = f"iot_{protocol}.py ({workers} workers): sent={stats['sent']} ({stats['sent'] / elapsed:.1f}/s), failed={stats['failed']}, bytes={stats['bytes']} ({stats['bytes'] / elapsed:.1f}/s)"
+            if stats["p99"] is not None:
+                summary += f", latency ms p99 (worst worker)={stats['p99'] * 1000:.2f}"
+            if stats["lag_p99"] is not None:
+                summary += f", schedule lag ms p99 (worst worker)={stats['lag_p99'] * 1000:.2f}"
+            logging.info(summary)
+        logging.info(
+            f"Total ({elapsed:.1f}s): sent={total} ({total / elapsed:.1f}/s, {total * 60 / elapsed:.0f}/min)"
+        )
+        self._reset()
+
+    def run(self) -> None:
+        while self._running:
+            timeout = max(0, self._started + self.interval - time.monotonic())
+            for key, _ in self._selector.select(timeout):
+                self._read(key.data)
+            if time.monotonic() - self._started >= self.interval:
+                self._log()
+        logging.error("All workers stopped")
+
+    def stop(
+        self,
+        timeout: float = 30,
+    ) -> None:
+        # SIGINT, so the workers flush as on CTRL-C
+        for worker in self._running:
+            if worker.process.poll() is None:
+                worker.process.send_signal(signal.SIGINT)
+        deadline = time.monotonic() + timeout
+        for worker in self._running:
+            try:
+                worker.process.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logging.warning(f"Killing {worker}")
+                worker.process.kill()
+                worker.process.wait()
+            # Last snapshot (sent by the worker when stopping)
+            for line in worker.reader:
+                self._add(worker, line)
+            worker.reader.close()
+        self._log()
+        self._running.clear()
+
+
+if __name__ == "__main__":
+
+    # Load env variables
+    load_dotenv(find_dotenv())
+
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
+
+    parser = argparse.ArgumentParser(
+        description="Run each IoT device script as several processes, each simulating a shard of the devices"
+    )
+    parser.add_argument(
+        "protocols",
+        nargs="*",
+        metavar="protocol",
+        help=f"IoT device scripts to run ({', '.join(PROTOCOLS)}, default: all)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.environ.get("LAUNCHER_WORKERS", 0)) or os.cpu_count(),
+        help="Processes per IoT device script (default: env var LAUNCHER_WORKERS or the number of CPUs)",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=float(os.environ.get("LAUNCHER_STATS_INTERVAL", 10)),
+        help="Seconds between throughput reports (default: env var LAUNCHER_STATS_INTERVAL or 10)",
+    )
+    parser.add_argument(
+        "--log-folder",
+        default="logs",
+        help="Folder of the workers log files (default: logs)",
+    )
+    args = parser.parse_args()
+    # Not argparse choices, checked against the default (all) on Python 3.11
+    for protocol in args.protocols:
+        if protocol not in PROTOCOLS:
+            parser.error(
+                f"invalid protocol '{protocol}' (choose from {', '.join(PROTOCOLS)})"
+            )
+    args.protocols = args.protocols or list(PROTOCOLS)
+
+    # Stopped (e.g. by stop.sh) same as CTRL-C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    supervisor = Supervisor(
+        list(dict.fromkeys(args.protocols)),
+        max(1, args.workers),
+        interval=args.interval,
+        log_folder=args.log_folder,
+    )
+    try:
+        supervisor.start()
+        supervisor.run()
+
+    except KeyboardInterrupt:
+        logging.info("CTRL-C pressed by user")
+
+    except Exception:
+        logging.error(sys_exc(sys.exc_info()))
+
+    finally:
+        logging.info("Stopping workers")
+        supervisor.stop()
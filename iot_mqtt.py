@@ -1,192 +1,528 @@
 import os
 import sys
-import json
 import time
+import asyncio
 import logging
 
+from collections import deque
+
 import paho.mqtt.client as mqtt
 
 from dotenv import load_dotenv, find_dotenv
 
 from utils import (
     sys_exc,
-    round_temp,
-    get_delta,
-    generate_payload,
-    get_next_interval,
     set_logging_handler,
-    get_details,
+    telemetry,
+)
+from utils.backoff import Backoff
+from utils.devices import DeviceTable
+from utils.engine import (
+    Simulator,
+    Transport,
+    run,
+)
+from utils.payload import compile_payload
+
+
+BUFFER_POLICIES = (
+    "drop-oldest",
+    "block",
 )
 
 
-def connect_mqtt(
-    host: str,
-    port: int,
-    client_id: str,
-    keepalive: int,
-):
-    def on_log(
+class MQTTConnection:
+    # paho client driven by the asyncio event loop (socket callbacks, no
+    # loop_start() thread). Up to `max_inflight` messages are published and
+    # not yet completed (QoS 0: written to the socket, QoS 1/2: acknowledged
+    # by the broker), publish() waits for a free slot (backpressure).
+    # While disconnected (reconnecting with backoff) messages are kept in a
+    # ring buffer of up to `buffer_size` messages, when full either the
+    # oldest one is dropped ("drop-oldest") or publish() waits ("block"),
+    # the buffer is drained once reconnected
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        client_id: str,
+        keepalive: int,
+        qos: int = 0,
+        max_inflight: int = 20,
+        buffer_size: int = 10000,
+        buffer_policy: str = "drop-oldest",
+        backoff: Backoff = None,
+    ) -> None:
+        if buffer_policy not in BUFFER_POLICIES:
+            raise ValueError(
+                f"Invalid buffer policy '{buffer_policy}', it must be one of: {', '.join(BUFFER_POLICIES)}"
+            )
+        self.host = host
+        self.port = port
+        self.client_id = client_id
+        self.keepalive = keepalive
+        self.qos = qos
+        self.max_inflight = max(1, max_inflight)
+        self.buffer_size = max(1, buffer_size)
+        self.buffer_policy = buffer_policy
+        self.backoff = backoff or Backoff()
+        self.client = None
+        self._loop = None
+        self._semaphore = None
+        self._pending = dict()
+        self._buffer = deque()
+        self._buffer_space = None
+        self._misc_task = None
+        self._reconnect_task = None
+        self._drain_task = None
+        self._closing = False
+        # Metrics
+        self.buffered = 0
+        self.dropped = 0
+        self._disconnected_time = 0
+        self._disconnected_since = None
+
+    def disconnected_time(self) -> float:
+        # Seconds disconnected (since connect() was called)
+        if self._disconnected_since is None:
+            return self._disconnected_time
+        return self._disconnected_time + time.monotonic() - self._disconnected_since
+
+    def buffer_length(self) -> int:
+        return len(self._buffer)
+
+    def is_connected(self) -> bool:
+        return self.client is not None and self.client.is_connected()
+
+    async def connect(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._semaphore = asyncio.Semaphore(self.max_inflight)
+        self._buffer_space = asyncio.Event()
+        self._disconnected_since = time.monotonic()
+        client = mqtt.Client(
+            mqtt.CallbackAPIVersion.VERSION2,
+            client_id=self.client_id,
+        )
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.on_publish = self._on_publish
+        client.on_log = self._on_log
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+        client.max_inflight_messages_set(self.max_inflight)
+        self.client = client
+        try:
+            client.connect(
+                self.host,
+                port=self.port,
+                keepalive=self.keepalive,
+            )
+        except Exception:
+            # Broker not available yet, messages buffered meanwhile
+            logging.error(sys_exc(sys.exc_info()))
+            self._reconnect_task = self._loop.create_task(self._reconnect())
+
+    def _on_socket_open(
+        self,
+        client,
+        userdata,
+        sock,
+    ) -> None:
+        self._loop.add_reader(sock, client.loop_read)
+        self._misc_task = self._loop.create_task(self._misc())
+
+    def _on_socket_close(
+        self,
+        client,
+        userdata,
+        sock,
+    ) -> None:
+        self._loop.remove_reader(sock)
+        if self._misc_task is not None:
+            self._misc_task.cancel()
+
+    def _on_socket_register_write(
+        self,
+        client,
+        userdata,
+        sock,
+    ) -> None:
+        self._loop.add_writer(sock, client.loop_write)
+
+    def _on_socket_unregister_write(
+        self,
+        client,
+        userdata,
+        sock,
+    ) -> None:
+        self._loop.remove_writer(sock)
+
+    async def _misc(self) -> None:
+        # Keep alive (PINGREQ) and retries
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    def _on_log(
+        self,
         client,
         userdata,
         level,
         message,
-    ):
-        logging.info(message)
+    ) -> None:
+        # Debug messages are logged for every publish
+        if level != mqtt.MQTT_LOG_DEBUG or telemetry.sample():
+            logging.info(f"{self.client_id}: {message}")
 
-    def on_connect(
+    def _on_connect(
+        self,
         client,
         userdata,
         flags,
         rc,
         properties,
-    ):
+    ) -> None:
         if rc == 0:
-            logging.info("Connected to MQTT Broker!")
+            logging.info(f"{self.client_id}: Connected to MQTT Broker!")
+            if self._disconnected_since is not None:
+                self._disconnected_time += time.monotonic() - self._disconnected_since
+                self._disconnected_since = None
+            self.backoff.reset()
+            if self._buffer and self._drain_task is None:
+                self._drain_task = self._loop.create_task(self._drain())
         else:
-            logging.error(f"Failed to connect, return code {rc}")
+            logging.error(f"{self.client_id}: Failed to connect, return code {rc}")
 
-    def on_disconnect(
+    def _on_disconnect(
+        self,
         client,
         userdata,
         flags,
         rc,
         properties,
-    ):
-        FIRST_RECONNECT_DELAY = 1
-        RECONNECT_RATE = 2
-        MAX_RECONNECT_COUNT = 12
-        MAX_RECONNECT_DELAY = 5
-        logging.info(f"Disconnected with result code: {rc}")
-        reconnect_count, reconnect_delay = 0, FIRST_RECONNECT_DELAY
-        while reconnect_count < MAX_RECONNECT_COUNT:
-            logging.info(f"Reconnecting in {reconnect_delay} seconds")
-            time.sleep(reconnect_delay)
+    ) -> None:
+        logging.info(f"{self.client_id}: Disconnected with result code: {rc}")
+        if self._disconnected_since is None:
+            self._disconnected_since = time.monotonic()
+        if self.qos == 0:
+            # Not written to the socket, these will never be published
+            for mid in list(self._pending):
+                self._complete(mid, failed=True)
+        if not self._closing and self._reconnect_task is None:
+            self._reconnect_task = self._loop.create_task(self._reconnect())
 
-            try:
-                client.reconnect()
-                logging.info("Reconnected successfully!")
-                return
-            except Exception:
-                logging.error(sys_exc(sys.exc_info()))
+    async def _reconnect(self) -> None:
+        # Retried until connected, the network loop is not blocked meanwhile
+        try:
+            while not self._closing:
+                reconnect_delay = self.backoff.next()
+                logging.info(
+                    f"{self.client_id}: Reconnecting in {reconnect_delay:.1f} seconds (attempt #{self.backoff.attempts})"
+                )
+                await asyncio.sleep(reconnect_delay)
 
-            reconnect_delay *= RECONNECT_RATE
-            reconnect_delay = min(reconnect_delay, MAX_RECONNECT_DELAY)
-            reconnect_count += 1
-        logging.info(f"Reconnect failed after {reconnect_count} attempts. Exiting")
+                try:
+                    self.client.reconnect()
+                    logging.info(f"{self.client_id}: Reconnected successfully!")
+                    return
+                except Exception:
+                    logging.error(sys_exc(sys.exc_info()))
+        finally:
+            self._reconnect_task = None
 
-    client = mqtt.Client(
-        mqtt.CallbackAPIVersion.VERSION2,
-        client_id=client_id,
-    )
-    client.on_connect = on_connect
-    client.on_disconnect = on_disconnect
-    client.on_log = on_log
-    client.connect(
-        host,
-        port=port,
-        keepalive=keepalive,
-    )
-    return client
+    async def _drain(self) -> None:
+        # Buffered messages published (at full speed) in order once reconnected
+        try:
+            while self._buffer and self.is_connected():
+                start, topic, message = self._buffer.popleft()
+                self._buffer_space.set()
+                try:
+                    if not await self._publish(topic, message, start):
+                        # Disconnected meanwhile (socket closed before
+                        # paho's state is updated), kept in order
+                        self._buffer.appendleft((start, topic, message))
+                        break
+                except Exception:
+                    telemetry.failed()
+                    logging.error(sys_exc(sys.exc_info()))
+            if self._buffer:
+                logging.info(
+                    f"{self.client_id}: Disconnected while draining, {len(self._buffer)} messages still buffered"
+                )
+        finally:
+            self._drain_task = None
 
+    def _on_publish(
+        self,
+        client,
+        userdata,
+        mid,
+        reason_code,
+        properties,
+    ) -> None:
+        self._complete(mid)
 
-if __name__ == "__main__":
+    def _complete(
+        self,
+        mid: int,
+        failed: bool = False,
+    ) -> None:
+        pending = self._pending.pop(mid, None)
+        if pending is None:
+            return
+        self._semaphore.release()
+        start, topic, message = pending
+        if failed:
+            telemetry.failed()
+            logging.error(
+                f"{self.client_id}: Error when sending message to topic {topic}: {message}"
+            )
+        else:
+            telemetry.sent(len(message), time.monotonic() - start)
+            if telemetry.sample():
+                logging.info(f"Sent message to topic {topic}: {message}")
 
-    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
-    set_logging_handler(FILE_APP)
+    async def publish(
+        self,
+        topic: str,
+        message: bytes,
+    ) -> None:
+        if self._buffer or not self.is_connected():
+            await self._buffer_message(topic, message)
+        elif not await self._publish(topic, message):
+            await self._buffer_message(topic, message)
 
-    # Load env variables
-    load_dotenv(find_dotenv())
-    LOCATION_DATA = os.environ["LOCATION_DATA"]
+    async def _buffer_message(
+        self,
+        topic: str,
+        message: bytes,
+        start: float = None,
+    ) -> None:
+        if start is None:
+            start = time.monotonic()
+        while len(self._buffer) >= self.buffer_size:
+            if self.buffer_policy == "drop-oldest":
+                self._buffer.popleft()
+                self.dropped += 1
+                telemetry.failed()
+            else:
+                self._buffer_space.clear()
+                await self._buffer_space.wait()
+        self._buffer.append((start, topic, message))
+        self.buffered += 1
+
+    async def _publish(
+        self,
+        topic: str,
+        message: bytes,
+        start: float = None,
+    ) -> bool:
+        await self._semaphore.acquire()
+        if start is None:
+            start = time.monotonic()
+        try:
+            result = self.client.publish(
+                topic,
+                message,
+                qos=self.qos,
+            )
+        except Exception:
+            self._semaphore.release()
+            raise
+        if result.rc == mqtt.MQTT_ERR_NO_CONN and self.qos == 0:
+            # Disconnected meanwhile, not sent
+            self._semaphore.release()
+            return False
+        elif result.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+            self._semaphore.release()
+            raise ConnectionError(
+                f"{self.client_id}: Error when sending message to topic {topic} (status={result.rc}): {message}"
+            )
+        else:
+            # QoS 1/2 not connected: kept by paho, sent once reconnected
+            self._pending[result.mid] = (start, topic, message)
+        return True
+
+    async def close(
+        self,
+        timeout: float = 10,
+    ) -> None:
+        # Waits for the messages in flight, then disconnects
+        self._closing = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+        deadline = time.monotonic() + timeout
+        while (
+            (self._pending or self._buffer)
+            and self.is_connected()
+            and time.monotonic() < deadline
+        ):
+            await asyncio.sleep(0.01)
+        if self.client is not None:
+            self.client.disconnect()
+
+
+class MQTTTransport(Transport):
+    # JSON payloads published to a topic per device, devices spread across
+    # the pool of connections
+    name = "mqtt"
+    timestamp_epoch = False
+
+    def __init__(
+        self,
+        manufacturer: str,
+        dev_family: str,
+        connections: list = None,
+    ) -> None:
+        self.connections = connections or list()
+        self.manufacturer = manufacturer
+        self.dev_family = dev_family
+        self.topics = None
+        # Payload builder
+        self.build_payload = compile_payload(
+            temperature_key="temperature",
+            location_key="location",
+            lat_key="latitude",
+            lng_key="longitude",
+            timestamp_key="epoch",
+            unit="F",
+            _timestamp_epoch=False,
+            serial_number_key=None,
+            _json=True,
+        )
+
+    def bind(
+        self,
+        devices: DeviceTable,
+    ) -> None:
+        super().bind(devices)
+        # Topics never change, built once
+        self.topics = [
+            f"python/mqtt/{self.manufacturer}/{self.dev_family}/{serial_number}"
+            for serial_number in devices.serial_numbers
+        ]
+
+    async def start(self) -> None:
+        connections = self.connections
+        # Reconnection metrics, on every telemetry summary line
+        telemetry.gauge(
+            "disconnected_s",
+            lambda: sum(connection.disconnected_time() for connection in connections),
+        )
+        telemetry.gauge(
+            "buffered",
+            lambda: sum(connection.buffer_length() for connection in connections),
+        )
+        telemetry.gauge(
+            "buffered_total",
+            lambda: sum(connection.buffered for connection in connections),
+        )
+        telemetry.gauge(
+            "dropped",
+            lambda: sum(connection.dropped for connection in connections),
+        )
+        for connection in connections:
+            await connection.connect()
+
+    def encode(
+        self,
+        _id: int,
+        temperature: float,
+        location: dict,
+        timestamp: str = None,
+    ) -> bytes:
+        return self.build_payload(
+            temperature,
+            self.devices.serial_numbers[_id],
+            location["city"],
+            location["lat"],
+            location["lng"],
+            timestamp=timestamp,
+        )
+
+    async def send_batch(
+        self,
+        records: list,
+    ) -> list:
+        connections = self.connections
+        retry = list()
+        for _id, message in records:
+            connection = connections[_id % len(connections)]
+            try:
+                await connection.publish(self.topics[_id], message)
+
+            except Exception:
+                telemetry.failed()
+                logging.error(sys_exc(sys.exc_info()))
+                logging.error(
+                    f"Error when sending message from device ({self.devices.serial_numbers[_id]}) to topic {self.topics[_id]}"
+                )
+                retry.append(_id)
+        return retry
+
+    async def close(self) -> None:
+        logging.info("Stopping MQTT connections")
+        for connection in self.connections:
+            await connection.close()
+
+
+def get_simulator() -> Simulator:
     MQTT_HOST = os.environ["MQTT_HOST"]
     MQTT_PORT = int(os.environ["MQTT_PORT"])
     MQTT_KEEPALIVE = int(os.environ["MQTT_KEEPALIVE"])
     MQTT_CLIENT_ID = os.environ["MQTT_CLIENT_ID"]
-    MQTT_DEVICES = min(25, int(os.environ["MQTT_DEVICES"]))
-    MQTT_MIN_ITERVAL_MS = int(os.environ["MQTT_MIN_ITERVAL_MS"])
-    MQTT_MAX_ITERVAL_MS = int(os.environ["MQTT_MAX_ITERVAL_MS"])
+    MQTT_QOS = int(os.environ.get("MQTT_QOS", 0))
+    MQTT_CONNECTIONS = max(1, int(os.environ.get("MQTT_CONNECTIONS", 1)))
+    MQTT_MAX_INFLIGHT = int(os.environ.get("MQTT_MAX_INFLIGHT", 20))
+    MQTT_BUFFER_SIZE = int(os.environ.get("MQTT_BUFFER_SIZE", 10000))
+    MQTT_BUFFER_POLICY = os.environ.get("MQTT_BUFFER_POLICY", "drop-oldest")
+    MQTT_RECONNECT_MAX_DELAY = float(os.environ.get("MQTT_RECONNECT_MAX_DELAY", 5))
 
     SEED = "^MQTT"
     MANUFACTURER = "PicoQ"
     DEVICE_FAMILY = "Q1"
 
-    # Devices cache
-    devices = dict()
-    for _id in range(MQTT_DEVICES):
-        serial_number, location, temp_mu, temp_sigma = get_details(
-            _id,
-            SEED,
-            LOCATION_DATA,
-        )
-        devices[_id] = {
-            "serial_number": serial_number,
-            "temperature": get_delta(temp_mu, temp_sigma) * 9 / 5 + 32,
-            "last_sent": get_next_interval(
-                MQTT_MIN_ITERVAL_MS,
-                MQTT_MAX_ITERVAL_MS,
-            ),
-            "location": location,
-        }
-
-    # Main thread loop
-    client = connect_mqtt(
-        MQTT_HOST,
-        MQTT_PORT,
-        MQTT_CLIENT_ID,
-        MQTT_KEEPALIVE,
+    transport = MQTTTransport(
+        MANUFACTURER,
+        DEVICE_FAMILY,
     )
-    client.loop_start()
-    try:
-        while True:
-            if client.is_connected:
-                for _id in range(MQTT_DEVICES):
-                    try:
-                        if devices[_id]["last_sent"] < time.time():
-                            devices[_id]["temperature"] = round_temp(
-                                devices[_id]["temperature"] + get_delta()
-                            )
-                            message = generate_payload(
-                                devices[_id]["temperature"],
-                                temperature_key="temperature",
-                                location=devices[_id]["location"]["city"],
-                                lat=devices[_id]["location"]["lat"],
-                                lng=devices[_id]["location"]["lng"],
-                                location_key="location",
-                                lat_key="latitude",
-                                lng_key="longitude",
-                                timestamp_key="epoch",
-                                unit="F",
-                                _timestamp_epoch=False,
-                            )
-                            topic = f"python/mqtt/{MANUFACTURER}/{DEVICE_FAMILY}/{devices[_id]['serial_number']}"
-                            result = client.publish(
-                                topic,
-                                json.dumps(message),
-                            )
-                            if result[0] == 0:
-                                logging.info(
-                                    f"Sent message from device ({devices[_id]['serial_number']}) to topic {topic}: {message}"
-                                )
-                            else:
-                                logging.error(
-                                    f"Error when sending message from device ({devices[_id]['serial_number']}) to topic {topic} (status={result[0]}): {message}"
-                                )
-
-                            devices[_id]["last_sent"] = get_next_interval(
-                                MQTT_MIN_ITERVAL_MS,
-                                MQTT_MAX_ITERVAL_MS,
-                            )
-
-                    except Exception:
-                        logging.error(sys_exc(sys.exc_info()))
-                        logging.error(
-                            f"Error when sending message from device ({devices[_id]['serial_number']}) to topic {topic}: {message}"
-                        )
-
-            time.sleep(0.05)
+    simulator = Simulator.from_env(
+        transport,
+        "MQTT",
+        SEED,
+        fahrenheit=True,
+    )
+
+    # Pool of connections, devices spread across them (client ids unique per
+    # connection and shard)
+    first_id = simulator.devices.first_id
+    client_id = f"{MQTT_CLIENT_ID}-{first_id}" if first_id else MQTT_CLIENT_ID
+    transport.connections = [
+        MQTTConnection(
+            MQTT_HOST,
+            MQTT_PORT,
+            f"{client_id}-{n}" if n else client_id,
+            MQTT_KEEPALIVE,
+            qos=MQTT_QOS,
+            max_inflight=MQTT_MAX_INFLIGHT,
+            buffer_size=MQTT_BUFFER_SIZE,
+            buffer_policy=MQTT_BUFFER_POLICY,
+            backoff=Backoff(max_delay=MQTT_RECONNECT_MAX_DELAY),
+        )
+        for n in range(MQTT_CONNECTIONS)
+    ]
+    return simulator
 
+
+if __name__ == "__main__":
+
+    # Load env variables
+    load_dotenv(find_dotenv())
+
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
+
+    try:
+        asyncio.run(run(get_simulator()))
     except KeyboardInterrupt:
         logging.info("CTRL-C pressed by user")
-
-    finally:
-        logging.info("Stopping MQTT loop")
-        client.loop_stop()
@@ -1,152 +1,468 @@
 import os
 import sys
-import json
 import pika
 import time
+import asyncio
 import logging
 
+from itertools import takewhile
+
 from dotenv import load_dotenv, find_dotenv
+from pika.adapters.asyncio_connection import AsyncioConnection
 
 from utils import (
     sys_exc,
-    round_temp,
-    get_delta,
-    generate_payload,
-    get_next_interval,
+    get_env_bool,
     set_logging_handler,
-    get_details,
+    telemetry,
+)
+from utils.backoff import Backoff
+from utils.engine import (
+    Simulator,
+    Transport,
+    run,
 )
+from utils.payload import compile_payload
+
+
+class AMQPPublisher:
+    # pika connection driven by the asyncio event loop, messages published
+    # round robin over `channels` channels. With publisher confirms up to
+    # `max_inflight` messages per channel are published and not yet
+    # confirmed (acked/nacked) by the broker, publish() waits for a free slot
+    # (backpressure). Without, published messages are written to the socket
+    # every `max_inflight` messages. The queue is only declared once, on the
+    # first connection (not on reconnections), it failing is fatal
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        queue: str,
+        channels: int = 1,
+        confirms: bool = True,
+        max_inflight: int = 100,
+        backoff: Backoff = None,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.queue = queue
+        self.channels = max(1, channels)
+        self.confirms = confirms
+        self.max_inflight = max(1, max_inflight)
+        self.backoff = backoff or Backoff()
+        # Same (empty) properties on every message
+        self.properties = pika.BasicProperties()
+        self._loop = None
+        # Window of unconfirmed messages per channel number
+        self._semaphores = dict()
+        self._connection = None
+        self._channels = list()
+        self._next_channel = 0
+        self._pending = dict()
+        self._delivery_tags = dict()
+        self._waiting = set()
+        self._unflushed = 0
+        self._declared = False
+        self._declaring = None
+        self._reconnect_task = None
+        self._closing = False
+
+    def is_open(self) -> bool:
+        return bool(self._channels)
+
+    def _future(self) -> asyncio.Future:
+        # Resolved by a pika callback, failed if disconnected meanwhile
+        future = self._loop.create_future()
+        self._waiting.add(future)
+        future.add_done_callback(self._waiting.discard)
+        return future
+
+    @staticmethod
+    def _resolve(
+        future: asyncio.Future,
+        result,
+    ) -> None:
+        if not future.done():
+            future.set_result(result)
+
+    async def connect(self) -> None:
+        # First connection, retried with backoff until the broker is
+        # available. The queue not declared (ValueError) is not retried
+        while True:
+            try:
+                await self._connect()
+                self.backoff.reset()
+                return
+            except ValueError:
+                self._closing = True
+                raise
+            except Exception:
+                logging.error(sys_exc(sys.exc_info()))
+            connect_delay = self.backoff.next()
+            logging.info(
+                f"Connecting in {connect_delay:.1f} seconds (attempt #{self.backoff.attempts})"
+            )
+            await asyncio.sleep(connect_delay)
 
+    async def _connect(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        opened = self._future()
+
+        def on_open_error(
+            connection,
+            error,
+        ) -> None:
+            if not opened.done():
+                opened.set_exception(
+                    error if isinstance(error, Exception) else ConnectionError(error)
+                )
 
-def connect(
-    host: str,
-    port: int,
-    channel: str,
-) -> tuple:
-    _connection = pika.BlockingConnection(
-        pika.ConnectionParameters(
-            host=host,
-            port=port,
+        self._connection = AsyncioConnection(
+            pika.ConnectionParameters(
+                host=self.host,
+                port=self.port,
+            ),
+            on_open_callback=lambda connection: self._resolve(opened, connection),
+            on_open_error_callback=on_open_error,
+            on_close_callback=self._on_connection_closed,
+            custom_ioloop=self._loop,
+        )
+        await opened
+
+        channels = [await self._open_channel() for _ in range(self.channels)]
+        if not self._declared:
+            self._declaring = declared = self._future()
+            channels[0].queue_declare(
+                queue=self.queue,
+                callback=lambda frame: self._resolve(declared, frame),
+            )
+            try:
+                await declared
+            except pika.exceptions.ChannelClosedByBroker as err:
+                # e.g. access refused, arguments not matching the existing queue
+                raise ValueError(f"Unable to declare the queue {self.queue}: {err}")
+            finally:
+                self._declaring = None
+            self._declared = True
+        self._channels = channels
+        logging.info(
+            f"Connected to RabbitMQ ({self.channels} channels, publisher confirms {'on' if self.confirms else 'off'})"
         )
-    )
-    _channel = _connection.channel()
-    _channel.queue_declare(queue=channel)
-    return (
-        _connection,
-        _channel,
-    )
 
+    async def _open_channel(self):
+        opened = self._future()
+        self._connection.channel(
+            on_open_callback=lambda channel: self._resolve(opened, channel)
+        )
+        channel = await opened
+        channel.add_on_close_callback(self._on_channel_closed)
+        self._pending[channel.channel_number] = dict()
+        self._delivery_tags[channel.channel_number] = 0
+        if channel.channel_number not in self._semaphores:
+            self._semaphores[channel.channel_number] = asyncio.Semaphore(
+                self.max_inflight
+            )
+        if self.confirms:
+            selected = self._future()
+            channel.confirm_delivery(
+                self._on_confirm,
+                callback=lambda frame: self._resolve(selected, frame),
+            )
+            await selected
+        return channel
 
-if __name__ == "__main__":
+    def _on_channel_closed(
+        self,
+        channel,
+        reason,
+    ) -> None:
+        # Closed by the broker, reconnected (all channels) from scratch
+        if self._declaring is not None and not self._declaring.done():
+            self._declaring.set_exception(reason)
+        if self._connection is not None and self._connection.is_open:
+            logging.error(f"Channel {channel.channel_number} closed: {reason}")
+            self._connection.close()
 
-    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
-    set_logging_handler(FILE_APP)
+    def _on_connection_closed(
+        self,
+        connection,
+        reason,
+    ) -> None:
+        self._channels = list()
+        # Not confirmed, whether the broker got them is unknown
+        unconfirmed = 0
+        for channel_number, pending in self._pending.items():
+            for _ in pending:
+                self._semaphores[channel_number].release()
+                telemetry.failed()
+                unconfirmed += 1
+        self._pending.clear()
+        self._delivery_tags.clear()
+        for future in list(self._waiting):
+            if not future.done():
+                future.set_exception(ConnectionError(f"Connection closed: {reason}"))
+        if self._closing:
+            return
+        logging.info(
+            f"Disconnected from RabbitMQ: {reason} ({unconfirmed} messages not confirmed)"
+        )
+        if self._reconnect_task is None:
+            self._reconnect_task = self._loop.create_task(self._reconnect())
 
-    # Load env variables
-    load_dotenv(find_dotenv())
-    LOCATION_DATA = os.environ["LOCATION_DATA"]
+    async def _reconnect(self) -> None:
+        # Retried until connected, the event loop is not blocked meanwhile
+        try:
+            while not self._closing:
+                reconnect_delay = self.backoff.next()
+                logging.info(
+                    f"Reconnecting in {reconnect_delay:.1f} seconds (attempt #{self.backoff.attempts})"
+                )
+                await asyncio.sleep(reconnect_delay)
+
+                try:
+                    await self._connect()
+                    logging.info("Reconnected successfully!")
+                    self.backoff.reset()
+                    return
+                except Exception:
+                    logging.error(sys_exc(sys.exc_info()))
+        finally:
+            self._reconnect_task = None
+
+    def _on_confirm(
+        self,
+        method_frame,
+    ) -> None:
+        method = method_frame.method
+        pending = self._pending.get(method_frame.channel_number)
+        if pending is None:
+            return
+        if method.multiple:
+            # All up to (and including) delivery_tag, in publishing order
+            tags = list(takewhile(lambda tag: tag <= method.delivery_tag, pending))
+        else:
+            tags = (method.delivery_tag,)
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        semaphore = self._semaphores[method_frame.channel_number]
+        now = time.monotonic()
+        for tag in tags:
+            item = pending.pop(tag, None)
+            if item is None:
+                continue
+            semaphore.release()
+            start, size = item
+            if acked:
+                telemetry.sent(size, now - start)
+            else:
+                telemetry.failed()
+                logging.error(
+                    f"Message nacked by the broker (channel {method_frame.channel_number}, delivery tag {tag})"
+                )
+
+    async def publish(
+        self,
+        body: bytes,
+    ) -> None:
+        if not self._channels:
+            raise ConnectionError("Not connected to RabbitMQ")
+        channels = self._channels
+        channel = channels[self._next_channel % len(channels)]
+        if self.confirms:
+            # Round robin, skipping the channels with a full window (waiting
+            # on the next one if all are full)
+            for n in range(len(channels)):
+                candidate = channels[(self._next_channel + n) % len(channels)]
+                if not self._semaphores[candidate.channel_number].locked():
+                    channel = candidate
+                    self._next_channel += n
+                    break
+            semaphore = self._semaphores[channel.channel_number]
+            await semaphore.acquire()
+            if channel not in self._channels:
+                # Disconnected meanwhile
+                semaphore.release()
+                raise ConnectionError("Not connected to RabbitMQ")
+        self._next_channel += 1
+        start = time.monotonic()
+        try:
+            channel.basic_publish(
+                "",
+                self.queue,
+                body,
+                self.properties,
+            )
+        except Exception:
+            if self.confirms:
+                semaphore.release()
+            raise
+        if self.confirms:
+            tag = self._delivery_tags[channel.channel_number] + 1
+            self._delivery_tags[channel.channel_number] = tag
+            self._pending[channel.channel_number][tag] = (start, len(body))
+        else:
+            telemetry.sent(len(body), time.monotonic() - start)
+            self._unflushed += 1
+            if self._unflushed >= self.max_inflight:
+                # Written to the socket by the event loop
+                self._unflushed = 0
+                await asyncio.sleep(0)
+
+    def pending(self) -> int:
+        return sum(len(pending) for pending in self._pending.values())
+
+    async def close(
+        self,
+        timeout: float = 30,
+    ) -> None:
+        # Waits for the messages in flight to be confirmed
+        self._closing = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+        deadline = time.monotonic() + timeout
+        while self.pending() and self.is_open() and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        connection = self._connection
+        if connection is not None and not (connection.is_closing or connection.is_closed):
+            connection.close()
+        while (
+            connection is not None
+            and not connection.is_closed
+            and time.monotonic() < deadline
+        ):
+            await asyncio.sleep(0.01)
+
+
+class AMQPTransport(Transport):
+    # JSON payloads published to `queue`, devices spread across the pool of
+    # publishers (connections)
+    name = "rabbitmq"
+    timestamp_epoch = False
+
+    def __init__(
+        self,
+        publishers: list,
+        queue: str,
+        manufacturer: str,
+        dev_family: str,
+    ) -> None:
+        self.publishers = publishers
+        self.queue = queue
+        # Payload builder
+        self.build_payload = compile_payload(
+            manufacturer=manufacturer,
+            dev_family=dev_family,
+            location_key="region",
+            lat_key="lat",
+            lng_key="lon",
+            temperature_key="temp",
+            manufacturer_key="provider",
+            dev_family_key="product",
+            serial_number_key="serno",
+            _timestamp_epoch=False,
+            _json=True,
+        )
+
+    async def start(self) -> None:
+        for publisher in self.publishers:
+            await publisher.connect()
+
+    def encode(
+        self,
+        _id: int,
+        temperature: float,
+        location: dict,
+        timestamp: str = None,
+    ) -> bytes:
+        return self.build_payload(
+            temperature,
+            self.devices.serial_numbers[_id],
+            location["city"],
+            location["lat"],
+            location["lng"],
+            timestamp=timestamp,
+        )
+
+    async def send_batch(
+        self,
+        records: list,
+    ) -> list:
+        publishers = self.publishers
+        retry = list()
+        for _id, message in records:
+            publisher = publishers[_id % len(publishers)]
+            if not publisher.is_open():
+                retry.append(_id)
+                continue
+            try:
+                await publisher.publish(message)
+                if telemetry.sample():
+                    logging.info(
+                        f"Sent message from device ({self.devices.serial_numbers[_id]}) to queue {self.queue}: {message}"
+                    )
+            except Exception:
+                telemetry.failed()
+                logging.error(sys_exc(sys.exc_info()))
+                logging.error(
+                    f"Error when sending message from device ({self.devices.serial_numbers[_id]}) to queue {self.queue}"
+                )
+                retry.append(_id)
+        return retry
+
+    async def close(self) -> None:
+        logging.info("Closing channels/connections")
+        for publisher in self.publishers:
+            try:
+                await publisher.close()
+            except Exception:
+                logging.error(sys_exc(sys.exc_info()))
+
+
+def get_simulator() -> Simulator:
     RABBITMQ_HOST = os.environ["RABBITMQ_HOST"]
     RABBITMQ_PORT = int(os.environ["RABBITMQ_PORT"])
-    RABBITMQ_DEVICES = min(25, int(os.environ["RABBITMQ_DEVICES"]))
     RABBITMQ_QUEUE = os.environ["RABBITMQ_QUEUE"]
-    RABBITMQ_MIN_ITERVAL_MS = int(os.environ["RABBITMQ_MIN_ITERVAL_MS"])
-    RABBITMQ_MAX_ITERVAL_MS = int(os.environ["RABBITMQ_MAX_ITERVAL_MS"])
+    RABBITMQ_CONFIRMS = get_env_bool("RABBITMQ_CONFIRMS")
+    RABBITMQ_CONNECTIONS = max(1, int(os.environ.get("RABBITMQ_CONNECTIONS", 1)))
+    RABBITMQ_CHANNELS = int(os.environ.get("RABBITMQ_CHANNELS", 1))
+    RABBITMQ_MAX_INFLIGHT = int(os.environ.get("RABBITMQ_MAX_INFLIGHT", 100))
 
     SEED = "$Rabbitmq"
     MANUFACTURER = "RMQ"
     DEVICE_FAMILY = "sx"
 
-    # Devices cache
-    devices = dict()
-    for _id in range(RABBITMQ_DEVICES):
-        serial_number, location, temp_mu, temp_sigma = get_details(
-            _id,
-            SEED,
-            LOCATION_DATA,
+    # Pool of connections, devices spread across them
+    publishers = [
+        AMQPPublisher(
+            RABBITMQ_HOST,
+            RABBITMQ_PORT,
+            RABBITMQ_QUEUE,
+            channels=RABBITMQ_CHANNELS,
+            confirms=RABBITMQ_CONFIRMS,
+            max_inflight=RABBITMQ_MAX_INFLIGHT,
         )
-        devices[_id] = {
-            "serial_number": serial_number,
-            "temperature": get_delta(temp_mu, temp_sigma),
-            "last_sent": get_next_interval(
-                RABBITMQ_MIN_ITERVAL_MS,
-                RABBITMQ_MAX_ITERVAL_MS,
-            ),
-            "location": location,
-        }
-
-    # RabbitMQ Connection/Channel
-    connection, channel = connect(
-        RABBITMQ_HOST,
-        RABBITMQ_PORT,
-        RABBITMQ_QUEUE,
+        for _ in range(RABBITMQ_CONNECTIONS)
+    ]
+    return Simulator.from_env(
+        AMQPTransport(
+            publishers,
+            RABBITMQ_QUEUE,
+            MANUFACTURER,
+            DEVICE_FAMILY,
+        ),
+        "RABBITMQ",
+        SEED,
     )
 
-    # Main thread loop
-    try:
-        while True:
-            if channel is not None and channel.is_open:
-                for _id in range(RABBITMQ_DEVICES):
-                    try:
-                        if devices[_id]["last_sent"] < time.time():
-                            devices[_id]["temperature"] = round_temp(
-                                devices[_id]["temperature"] + get_delta()
-                            )
-                            message = generate_payload(
-                                devices[_id]["temperature"],
-                                serial_number=devices[_id]["serial_number"],
-                                manufacturer=MANUFACTURER,
-                                dev_family=DEVICE_FAMILY,
-                                location=devices[_id]["location"]["city"],
-                                lat=devices[_id]["location"]["lat"],
-                                lng=devices[_id]["location"]["lng"],
-                                location_key="region",
-                                lat_key="lat",
-                                lng_key="lon",
-                                temperature_key="temp",
-                                manufacturer_key="provider",
-                                dev_family_key="product",
-                                serial_number_key="serno",
-                                _timestamp_epoch=False,
-                            )
-                            channel.basic_publish(
-                                exchange="",
-                                routing_key=RABBITMQ_QUEUE,
-                                body=json.dumps(message),
-                            )
-                            devices[_id]["last_sent"] = get_next_interval(
-                                RABBITMQ_MIN_ITERVAL_MS,
-                                RABBITMQ_MAX_ITERVAL_MS,
-                            )
-                            logging.info(
-                                f"Sent message from device ({devices[_id]['serial_number']}) to queue {RABBITMQ_QUEUE}: {message}"
-                            )
-                    except Exception:
-                        logging.error(sys_exc(sys.exc_info()))
-                        logging.error(
-                            f"Error when sending message from device ({devices[_id]['serial_number']}) to queue {RABBITMQ_QUEUE}: {message}"
-                        )
 
-            else:
-                connection, channel = connect(
-                    RABBITMQ_HOST,
-                    RABBITMQ_PORT,
-                    RABBITMQ_QUEUE,
-                )
+if __name__ == "__main__":
 
-            time.sleep(0.05)
+    # Load env variables
+    load_dotenv(find_dotenv())
+
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
 
+    try:
+        asyncio.run(run(get_simulator()))
     except KeyboardInterrupt:
         logging.info("CTRL-C pressed by user")
-
-    finally:
-        logging.info("Closing channel/connection")
-        if channel is not None:
-            try:
-                channel.close()
-            except Exception:
-                logging.error(sys_exc(sys.exc_info()))
-        if connection is not None:
-            try:
-                connection.close()
-            except Exception:
-                logging.error(sys_exc(sys.exc_info()))
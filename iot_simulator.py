@@ -0,0 +1,43 @@
+import os
+import asyncio
+import logging
+import argparse
+import importlib
+
+from dotenv import load_dotenv, find_dotenv
+
+from utils import set_logging_handler
+from utils.engine import run
+from iot_launcher import PROTOCOLS
+
+
+if __name__ == "__main__":
+
+    # Load env variables
+    load_dotenv(find_dotenv())
+
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
+
+    parser = argparse.ArgumentParser(
+        description="Run several IoT device scripts in one process, sharing the same event loop"
+    )
+    parser.add_argument(
+        "protocols",
+        nargs="+",
+        choices=PROTOCOLS,
+        help=f"IoT device scripts to run ({', '.join(PROTOCOLS)})",
+    )
+    args = parser.parse_args()
+
+    # Only the client libraries of the protocols run are imported
+    simulators = [
+        importlib.import_module(f"iot_{protocol}").get_simulator()
+        for protocol in dict.fromkeys(args.protocols)
+    ]
+    logging.info(f"Running {', '.join(dict.fromkeys(args.protocols))}")
+
+    try:
+        asyncio.run(run(*simulators))
+    except KeyboardInterrupt:
+        logging.info("CTRL-C pressed by user")
@@ -2,221 +2,451 @@ import os
 import sys
 import time
 import socket
+import asyncio
 import logging
 
 from dotenv import load_dotenv, find_dotenv
-from cefevent import CEFEvent
 from datetime import datetime
-from pysyslogclient import SyslogClient, FAC_USER, SEV_NOTICE
 
 from utils import (
     sys_exc,
-    round_temp,
-    get_delta,
-    get_epoch_milli,
-    get_next_interval,
     set_logging_handler,
-    get_details,
+    telemetry,
 )
+from utils.backoff import Backoff
+from utils.cef import CEFEncoder
+from utils.devices import DeviceTable
+from utils.engine import (
+    Simulator,
+    Transport,
+    run,
+)
+
+
+# Syslog facility/severity (RFC 3164)
+FAC_USER = 1
+SEV_NOTICE = 5
+
+FRAMINGS = (
+    "newline",
+    "octet-counting",
+)
+
+
+def get_host_name() -> str:
+    # Resolved once, socket.getfqdn() might be a slow DNS lookup
+    host_name = socket.getfqdn()
+    if not host_name:
+        host_name = socket.gethostname()
+    return host_name
+
+
+def get_cef_encoder(unit: str = "C") -> CEFEncoder:
+    # encode(header, severity, temperature, lat, lng, location)
+    # Extensions: https://github.com/kamushadenes/cefevent/blob/master/cefevent/extensions.py
+    return CEFEncoder(
+        (
+            ("deviceCustomFloatingPoint1", None),
+            ("deviceCustomFloatingPoint1Label", unit),
+            ("deviceCustomFloatingPoint2", None),
+            ("deviceCustomFloatingPoint2Label", "lat"),
+            ("deviceCustomFloatingPoint3", None),
+            ("deviceCustomFloatingPoint3Label", "lon"),
+            ("deviceDirection", None),
+        )
+    )
+
 
+def get_cef_header(
+    device_vendor: str,
+    device_product: str,
+    device_serial_number: str,
+    signature_id: int = 100,
+) -> str:
+    # Built once per device
+    return CEFEncoder.header(
+        version="0",
+        name="Telemetry",
+        deviceVendor=device_vendor,
+        deviceProduct=device_product,
+        deviceVersion=device_serial_number,
+        signatureId=str(signature_id),
+    )
 
-class SyslogClientRFC3164(SyslogClient):
+
+def syslog_message(
+    host_name: str,
+    encode,
+    cef_header: str,
+    temperature: float,
+    location: str,
+    lat: float,
+    lng: float,
+    timestamp: datetime = None,
+    facility: int = FAC_USER,
+    severity: int = SEV_NOTICE,
+) -> bytes:
+    # RFC 3164 message (not framed), example: <13>Apr 01 18:54:54 P3W32CDKHC CEF:0|SysTemp|SysIotLog|369f9aa5df41|100|Telemetry|5|cfp1=27.0156 cfp1Label=C deviceDirection=Region_25
+    pri = facility * 8 + severity
+
+    if timestamp is None:
+        timestamp = datetime.now()
+
+    message = encode(
+        cef_header,
+        severity,
+        temperature,
+        lat,
+        lng,
+        location,
+    )
+    syslog_data = "<%i>%s %s %s" % (
+        pri,
+        timestamp.strftime("%b %d %H:%M:%S"),
+        host_name,
+        message,
+    )
+    return syslog_data.encode("ASCII", "ignore")
+
+
+class SyslogPool:
+    # `size` persistent connections (TCP streams or UDP endpoints, asyncio so
+    # a slow or unreachable server does not block the other transports on the
+    # event loop) to the syslog server shared by all devices, messages are
+    # queued round robin on them and written by flush() (or once
+    # `batch_bytes` are queued on a connection): over TCP all messages queued
+    # with a single write, framed with a trailing newline or octet counting
+    # (RFC 6587), over UDP one datagram per message. Connecting and writing
+    # time out after `timeout` seconds. A connection failing is reconnected
+    # with backoff, its queued messages failed
     def __init__(
         self,
         host: str,
         port: int,
-        protocol: str,
-        device_product: str,
-        device_vendor: str,
-        device_serial_number: str,
-        forceipv4: bool = False,
-        clientname: str = None,
+        protocol: str = "TCP",
+        size: int = 1,
+        framing: str = "newline",
+        batch_bytes: int = 65536,
+        max_length: int = 1024,
+        timeout: float = 5,
     ) -> None:
-        SyslogClient.__init__(
-            self,
-            server=host,
-            port=port,
-            proto=protocol,
-            forceipv4=forceipv4,
-            clientname=clientname,
-            rfc="3164",
-            maxMessageLength=1024,
+        if framing not in FRAMINGS:
+            raise ValueError(
+                f"Invalid syslog framing '{framing}', it must be one of: {', '.join(FRAMINGS)}"
+            )
+        self.host = host
+        self.port = port
+        self.tcp = protocol.upper() == "TCP"
+        self.size = max(1, size)
+        self.framing = framing
+        self.batch_bytes = batch_bytes
+        self.max_length = max_length
+        self.timeout = timeout
+        self._addresses = None
+        # StreamWriter (TCP) or DatagramTransport (UDP)
+        self._writers = [None] * self.size
+        self._backoffs = [Backoff() for _ in range(self.size)]
+        self._retry_at = [0] * self.size
+        self._next = 0
+        # Per connection: messages queued, their bytes and when the first one was
+        self._queues = [list() for _ in range(self.size)]
+        self._bytes = [0] * self.size
+        self._queued_at = [None] * self.size
+
+    async def _timeout(
+        self,
+        awaitable,
+    ):
+        # Not asyncio.wait_for(), it might swallow the cancellation of the
+        # simulator when `awaitable` is done meanwhile (Python < 3.12)
+        task = asyncio.ensure_future(awaitable)
+        try:
+            done, _ = await asyncio.wait((task,), timeout=self.timeout)
+        finally:
+            if not task.done():
+                task.cancel()
+        if not done:
+            raise asyncio.TimeoutError(
+                f"Timeout ({self.timeout}s) with the syslog server {self.host}:{self.port}"
+            )
+        return task.result()
+
+    async def _open(
+        self,
+        family: int,
+        address: tuple,
+    ):
+        if self.tcp:
+            _, writer = await asyncio.open_connection(
+                address[0],
+                address[1],
+                family=family,
+            )
+            return writer
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            asyncio.DatagramProtocol,
+            remote_addr=address,
+            family=family,
         )
-        self.device_vendor = device_vendor
-        self.device_product = device_product
-        self.device_serial_number = device_serial_number
-        self.host_name = socket.getfqdn()
-        if self.host_name == None:
-            self.host_name = socket.gethostname()
+        return transport
 
-        self.is_connected = False
+    async def _connect(
+        self,
+        index: int,
+    ) -> bool:
+        if time.monotonic() < self._retry_at[index]:
+            return False
+        try:
+            if self._addresses is None:
+                self._addresses = await asyncio.get_running_loop().getaddrinfo(
+                    self.host,
+                    self.port,
+                    type=socket.SOCK_STREAM if self.tcp else socket.SOCK_DGRAM,
+                )
+            error = None
+            for family, _, _, _, address in self._addresses:
+                try:
+                    writer = await self._timeout(self._open(family, address))
+                except (OSError, asyncio.TimeoutError) as err:
+                    error = err
+                    continue
+                self._writers[index] = writer
+                self._backoffs[index].reset()
+                logging.info(
+                    f"Connected to syslog server {self.host}:{self.port} ({'TCP' if self.tcp else 'UDP'}, connection #{index})"
+                )
+                return True
+            raise error
+        except Exception:
+            logging.error(sys_exc(sys.exc_info()))
+            self._retry_at[index] = time.monotonic() + self._backoffs[index].next()
+        return False
 
-    def sys_connect(self) -> None:
+    def _close(
+        self,
+        index: int,
+    ) -> None:
+        if self._writers[index] is not None:
+            try:
+                self._writers[index].close()
+            except Exception:
+                logging.error(sys_exc(sys.exc_info()))
+            self._writers[index] = None
+
+    async def send(
+        self,
+        message: bytes,
+    ) -> None:
+        # Queued on the next connected connection
+        for _ in range(self.size):
+            index = self._next
+            self._next = (self._next + 1) % self.size
+            if self._writers[index] is not None or await self._connect(index):
+                break
+        else:
+            raise ConnectionError(
+                f"Not connected to the syslog server {self.host}:{self.port}"
+            )
+        if self.tcp and self.framing == "octet-counting":
+            message = message[: self.max_length]
+            message = b"%d %s" % (len(message), message)
+        else:
+            message = message[: self.max_length - 1] + b"\n"
+        if self._queued_at[index] is None:
+            self._queued_at[index] = time.monotonic()
+        self._queues[index].append(message)
+        self._bytes[index] += len(message)
+        if self._bytes[index] >= self.batch_bytes:
+            await self._flush(index)
+
+    async def _flush(
+        self,
+        index: int,
+    ) -> None:
+        queue = self._queues[index]
+        size = self._bytes[index]
+        queued_at = self._queued_at[index]
+        self._queues[index] = list()
+        self._bytes[index] = 0
+        self._queued_at[index] = None
+        writer = self._writers[index]
         try:
-            self.is_connected = self.connect()
+            if writer is None or writer.is_closing():
+                raise ConnectionError(
+                    f"Not connected to the syslog server {self.host}:{self.port}"
+                )
+            if self.tcp:
+                writer.write(b"".join(queue))
+                # Waits only while the server is not keeping up
+                if writer.transport.get_write_buffer_size():
+                    await self._timeout(writer.drain())
+            else:
+                for message in queue:
+                    writer.sendto(message)
         except Exception:
+            telemetry.failed(len(queue))
             logging.error(sys_exc(sys.exc_info()))
-            self.is_connected = False
-            time.sleep(1)
+            logging.error(
+                f"Error when sending {len(queue)} messages to the syslog server (connection #{index})"
+            )
+            self._close(index)
+            self._retry_at[index] = time.monotonic() + self._backoffs[index].next()
+            return
+        telemetry.sent(size, time.monotonic() - queued_at, len(queue))
+
+    async def flush(self) -> None:
+        for index in range(self.size):
+            if self._queues[index]:
+                await self._flush(index)
+
+    async def close(self) -> None:
+        await self.flush()
+        for index in range(self.size):
+            writer = self._writers[index]
+            self._close(index)
+            if self.tcp and writer is not None:
+                try:
+                    await self._timeout(writer.wait_closed())
+                except Exception:
+                    logging.error(sys_exc(sys.exc_info()))
+
+
+class SyslogTransport(Transport):
+    # CEF messages (RFC 3164) over the SyslogPool sockets, the messages of a
+    # tick written together
+    name = "syslog"
 
-    def cef_message(
+    def __init__(
         self,
-        severity: int,
-        signature_id: int,
-        location: str,
-        lat: float,
-        lng: float,
-        temperature: float,
-        unit: str,
-    ):
-        c = CEFEvent(strict=True)
-        c.set_field("version", "0")
-        c.set_field("name", "Telemetry")
-        c.set_field("deviceVendor", self.device_vendor)
-        c.set_field("deviceProduct", self.device_product)
-        c.set_field("deviceVersion", self.device_serial_number)
-        c.set_field("signatureId", str(signature_id))
-        c.set_field("severity", severity)
-        # Extensions: https://github.com/kamushadenes/cefevent/blob/master/cefevent/extensions.py
-        c.set_field("deviceCustomFloatingPoint1", temperature)
-        c.set_field("deviceCustomFloatingPoint1Label", unit)
-        c.set_field("deviceCustomFloatingPoint2", lat)
-        c.set_field("deviceCustomFloatingPoint2Label", "lat")
-        c.set_field("deviceCustomFloatingPoint3", lng)
-        c.set_field("deviceCustomFloatingPoint3Label", "lon")
-        c.set_field("deviceDirection", location)
-        return c.build_cef()
-
-    def log(
+        pool: SyslogPool,
+        device_vendor: str,
+        device_product: str,
+        unit: str = "C",
+    ) -> None:
+        self.pool = pool
+        self.device_vendor = device_vendor
+        self.device_product = device_product
+        self.host_name = get_host_name()
+        self.cef_encode = get_cef_encoder(unit).encode
+        self.cef_headers = None
+
+    def bind(
         self,
+        devices: DeviceTable,
+    ) -> None:
+        super().bind(devices)
+        # CEF prefix fields built once per device
+        self.cef_headers = [
+            get_cef_header(
+                self.device_vendor,
+                self.device_product,
+                serial_number,
+            )
+            for serial_number in devices.serial_numbers
+        ]
+
+    def timestamp(self) -> datetime:
+        return datetime.now()
+
+    def format_timestamp(
+        self,
+        timestamp: datetime,
+    ) -> bytes:
+        return timestamp.strftime("%b %d %H:%M:%S").encode("ascii")
+
+    def encode(
+        self,
+        _id: int,
         temperature: float,
-        location: str,
-        lat: float,
-        lng: float,
+        location: dict,
         timestamp: datetime = None,
-        facility: int = FAC_USER,
-        severity: int = SEV_NOTICE,
-        unit: str = "C",
-    ) -> str:
-        pri = facility * 8 + severity
-
-        if timestamp is None:
-            timestamp = datetime.now()
-
-        message = self.cef_message(
-            severity,
-            100,
-            location,
-            lat,
-            lng,
-            temperature,
-            unit,
-        )
-        syslog_data = "<%i>%s %s %s\n" % (
-            pri,
-            timestamp.strftime("%b %d %H:%M:%S"),
+    ) -> bytes:
+        return syslog_message(
             self.host_name,
-            message,
+            self.cef_encode,
+            self.cef_headers[_id],
+            temperature=temperature,
+            location=location["city"],
+            lat=location["lat"],
+            lng=location["lng"],
+            timestamp=timestamp,
         )
 
-        self.send(syslog_data.encode("ASCII", "ignore"))
+    async def send_batch(
+        self,
+        records: list,
+    ) -> list:
+        retry = list()
+        for _id, syslog_data in records:
+            try:
+                await self.pool.send(syslog_data)
 
-        return syslog_data  # Example: <13>Apr 01 18:54:54 P3W32CDKHC CEF:0|SysTemp|SysIotLog|369f9aa5df41|100|Telemetry|5|cfp1=27.0156 cfp1Label=C deviceDirection=Region_25
+                if telemetry.sample():
+                    logging.info(f"Syslog message sent: {syslog_data.decode('ASCII')}")
 
+            except ConnectionError:
+                retry.append(_id)
 
-if __name__ == "__main__":
+            except Exception:
+                telemetry.failed()
+                logging.error(sys_exc(sys.exc_info()))
+                logging.error(
+                    f"Error when sending message from device ({self.devices.serial_numbers[_id]}))"
+                )
+                retry.append(_id)
 
-    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
-    set_logging_handler(FILE_APP)
+        # Messages of this tick written
+        await self.pool.flush()
+        return retry
 
-    # Load env variables
-    load_dotenv(find_dotenv())
-    LOCATION_DATA = os.environ["LOCATION_DATA"]
+    async def close(self) -> None:
+        await self.pool.close()
+        logging.info("Stopped SysLog client")
+
+
+def get_simulator() -> Simulator:
     SYSLOG_HOST = os.environ["SYSLOG_HOST"]
     SYSLOG_PORT = int(os.environ["SYSLOG_PORT"])
     SYSLOG_PROTOCOL = os.environ["SYSLOG_PROTOCOL"]
-    SYSLOG_DEVICES = min(25, int(os.environ["SYSLOG_DEVICES"]))
-    SYSLOG_MIN_ITERVAL_MS = int(os.environ["SYSLOG_MIN_ITERVAL_MS"])
-    SYSLOG_MAX_ITERVAL_MS = int(os.environ["SYSLOG_MAX_ITERVAL_MS"])
+    SYSLOG_CONNECTIONS = int(os.environ.get("SYSLOG_CONNECTIONS", 1))
+    SYSLOG_FRAMING = os.environ.get("SYSLOG_FRAMING", "newline")
+    SYSLOG_BATCH_BYTES = int(os.environ.get("SYSLOG_BATCH_BYTES", 65536))
+    SYSLOG_TIMEOUT = float(os.environ.get("SYSLOG_TIMEOUT", 5))
 
     SEED = "#Syslog"
     MANUFACTURER = "SysIotLog"
     DEVICE_FAMILY = "SysTemp"
 
-    # Devices cache
-    devices = dict()
-    for _id in range(SYSLOG_DEVICES):
-        serial_number, location, temp_mu, temp_sigma = get_details(
-            _id,
-            SEED,
-            LOCATION_DATA,
-        )
-        devices[_id] = {
-            "serial_number": serial_number,
-            "temperature": get_delta(temp_mu, temp_sigma),
-            "unit": "C",
-            "last_sent": get_next_interval(
-                SYSLOG_MIN_ITERVAL_MS,
-                SYSLOG_MAX_ITERVAL_MS,
-            ),
-            "location": location,
-            "client": SyslogClientRFC3164(
-                SYSLOG_HOST,
-                SYSLOG_PORT,
-                SYSLOG_PROTOCOL,
-                MANUFACTURER,
-                DEVICE_FAMILY,
-                serial_number,
-            ),
-        }
+    # Connections shared by all devices
+    pool = SyslogPool(
+        SYSLOG_HOST,
+        SYSLOG_PORT,
+        protocol=SYSLOG_PROTOCOL,
+        size=SYSLOG_CONNECTIONS,
+        framing=SYSLOG_FRAMING,
+        batch_bytes=SYSLOG_BATCH_BYTES,
+        timeout=SYSLOG_TIMEOUT,
+    )
+    return Simulator.from_env(
+        SyslogTransport(
+            pool,
+            DEVICE_FAMILY,
+            MANUFACTURER,
+        ),
+        "SYSLOG",
+        SEED,
+    )
 
-    # Main thread loop
-    try:
-        while True:
-            for _id in range(SYSLOG_DEVICES):
-                if devices[_id]["client"].is_connected:
-                    try:
-                        if devices[_id]["last_sent"] < time.time():
-                            devices[_id]["temperature"] = round_temp(
-                                devices[_id]["temperature"] + get_delta()
-                            )
-
-                            timestamp = get_epoch_milli()
-                            syslog_data = devices[_id]["client"].log(
-                                temperature=devices[_id]["temperature"],
-                                location=devices[_id]["location"]["city"],
-                                lat=devices[_id]["location"]["lat"],
-                                lng=devices[_id]["location"]["lng"],
-                                unit=devices[_id]["unit"],
-                            )
-
-                            logging.info(f"Syslog message sent: {syslog_data.strip('\n').strip(' ')}")
-
-                            devices[_id]["last_sent"] = get_next_interval(
-                                SYSLOG_MIN_ITERVAL_MS,
-                                SYSLOG_MAX_ITERVAL_MS,
-                            )
-                            time.sleep(0.01)
-
-                    except (BrokenPipeError, ConnectionRefusedError):
-                        logging.error(sys_exc(sys.exc_info()))
-                        devices[_id]["client"].sys_connect()
-                        time.sleep(1)
-                        break
-
-                    except Exception:
-                        logging.error(sys_exc(sys.exc_info()))
-                        logging.error(
-                            f"Error when sending message from device ({devices[_id]['serial_number']}))"
-                        )
-
-                else:
-                    devices[_id]["client"].sys_connect()
-
-            time.sleep(0.05)
 
+if __name__ == "__main__":
+
+    # Load env variables
+    load_dotenv(find_dotenv())
+
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
+
+    try:
+        asyncio.run(run(get_simulator()))
     except KeyboardInterrupt:
         logging.info("CTRL-C pressed by user")
-
-    finally:
-        logging.info("Stopped SysLog client")
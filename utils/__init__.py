@@ -1,23 +1,185 @@
+import os
 import sys
 import json
 import time
 import random
 import hashlib
 import logging
+import threading
 
-from datetime import datetime, timezone
 from functools import lru_cache
 
 
+MAX_DEVICES = 25
+
+
+class Telemetry:
+    # Per interval counters (sent, failed, bytes, latency and schedule lag
+    # percentiles) logged as one summary line every `interval` seconds (0 = disabled), per message
+    # logs are only emitted for the messages sampled (`sample_rate`, 0 to 1)
+    def __init__(
+        self,
+        interval: float = 0,
+        sample_rate: float = 1,
+        max_latencies: int = 10000,
+    ) -> None:
+        self.interval = interval
+        self.sample_rate = sample_rate
+        self.max_latencies = max_latencies
+        # Snapshots also written as JSON lines here (e.g. pipe to iot_launcher.py)
+        self.report_file = None
+        self._gauges = dict()
+        self._lock = threading.Lock()
+        self._reset(time.monotonic())
+
+    def _reset(
+        self,
+        now: float,
+    ) -> None:
+        self._started = now
+        self._sent = 0
+        self._failed = 0
+        self._bytes = 0
+        self._latencies_seen = 0
+        self._latencies = list()
+        self._lags_seen = 0
+        self._lags = list()
+
+    def sample(self) -> bool:
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def sent(
+        self,
+        size: int = 0,
+        latency: float = None,
+        count: int = 1,
+    ) -> None:
+        with self._lock:
+            self._sent += count
+            self._bytes += size
+            if latency is not None:
+                self._latencies_seen += 1
+                self._keep(self._latencies, self._latencies_seen, latency)
+
+    def lag(
+        self,
+        seconds: float,
+    ) -> None:
+        # How late a message was taken for sending vs its intended start time
+        # (see RateScheduler)
+        with self._lock:
+            self._lags_seen += 1
+            self._keep(self._lags, self._lags_seen, seconds)
+
+    def _keep(
+        self,
+        samples: list,
+        seen: int,
+        value: float,
+    ) -> None:
+        # Reservoir sampling, to keep memory bounded
+        if len(samples) < self.max_latencies:
+            samples.append(value)
+        else:
+            n = random.randrange(seen)
+            if n < self.max_latencies:
+                samples[n] = value
+
+    def failed(
+        self,
+        count: int = 1,
+    ) -> None:
+        with self._lock:
+            self._failed += count
+
+    def gauge(
+        self,
+        name: str,
+        callback,
+    ) -> None:
+        # callback() value added to every snapshot/summary line as `name`
+        self._gauges[name] = callback
+
+    def snapshot(self) -> dict:
+        # Counters since the last snapshot (counters are reset)
+        now = time.monotonic()
+        with self._lock:
+            result = {
+                "elapsed": max(now - self._started, 1e-9),
+                "sent": self._sent,
+                "failed": self._failed,
+                "bytes": self._bytes,
+            }
+            latencies = sorted(self._latencies)
+            lags = sorted(self._lags)
+            self._reset(now)
+        for prefix, samples in (("", latencies), ("lag_", lags)):
+            if samples:
+                for p in (50, 90, 99):
+                    result[f"{prefix}p{p}"] = samples[
+                        min(len(samples) - 1, int(len(samples) * p / 100))
+                    ]
+                result[f"{prefix}max"] = samples[-1]
+        for name, callback in self._gauges.items():
+            result[name] = callback()
+        return result
+
+    def tick(
+        self,
+        force: bool = False,
+    ) -> None:
+        if self.interval <= 0 and not force:
+            return
+        if not force and time.monotonic() - self._started < self.interval:
+            return
+        stats = self.snapshot()
+        if self.report_file is not None:
+            try:
+                self.report_file.write(json.dumps(stats) + "\n")
+                self.report_file.flush()
+            except (OSError, ValueError):
+                # Reader gone (e.g. launcher stopped)
+                self.report_file = None
+        elapsed = stats["elapsed"]
+        summary = f"Telemetry ({elapsed:.1f}s): sent={stats['sent']} ({stats['sent'] / elapsed:.1f}/s), failed={stats['failed']}, bytes={stats['bytes']} ({stats['bytes'] / elapsed:.1f}/s)"
+        if "max" in stats:
+            percentiles = " ".join(
+                f"{p}={stats[p] * 1000:.2f}" for p in ("p50", "p90", "p99", "max")
+            )
+            summary += f", latency ms {percentiles}"
+        if "lag_max" in stats:
+            percentiles = " ".join(
+                f"{p}={stats['lag_' + p] * 1000:.2f}" for p in ("p50", "p90", "p99", "max")
+            )
+            summary += f", schedule lag ms {percentiles}"
+        for name in self._gauges:
+            value = stats[name]
+            summary += f", {name}={value:.1f}" if isinstance(value, float) else f", {name}={value}"
+        logging.info(summary)
+
+
+telemetry = Telemetry()
+
+
 def set_logging_handler(
     app_name: str,
     level: int = logging.INFO,
+    stats_interval: float = None,
+    sample_rate: float = None,
 ) -> None:
     logging.basicConfig(
         format=f"[{app_name}] %(asctime)s.%(msecs)03d [%(levelname)s]: %(message)s",
         level=level,
         datefmt="%Y-%m-%d %H:%M:%S",
     )
+    if stats_interval is None:
+        stats_interval = float(os.environ.get("LOG_STATS_INTERVAL", 0))
+    if sample_rate is None:
+        sample_rate = float(os.environ.get("LOG_SAMPLE_RATE", 1))
+    telemetry.interval = stats_interval
+    telemetry.sample_rate = sample_rate
+    if os.environ.get("TELEMETRY_FD"):
+        telemetry.report_file = os.fdopen(int(os.environ["TELEMETRY_FD"]), "w")
 
 
 def sys_exc(exc_info) -> str:
@@ -25,12 +187,67 @@ def sys_exc(exc_info) -> str:
     return f"{exc_type} | {exc_tb.tb_lineno} | {exc_obj}"
 
 
-def get_epoch_milli() -> int:
-    return int(datetime.now(timezone.utc).timestamp() * 1000)
+def get_env_bool(
+    name: str,
+    default: bool = False,
+) -> bool:
+    return os.environ.get(name, str(default)).strip().lower() in ("true", "yes", "1")
+
 
+def get_devices_count(
+    devices: int,
+    scale_mode: bool = False,
+) -> int:
+    if scale_mode:
+        return max(0, devices)
+    return min(MAX_DEVICES, devices)
 
-def get_isotimestamp() -> str:
-    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+def get_shard(devices: int) -> tuple:
+    # (first device id, number of devices) of this process, the device ids
+    # are split in SHARD_COUNT contiguous blocks (env vars set by iot_launcher.py)
+    shard_count = max(1, int(os.environ.get("SHARD_COUNT", 1)))
+    shard_index = int(os.environ.get("SHARD_INDEX", 0))
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(
+            f"Invalid SHARD_INDEX {shard_index}, it must be between 0 and {shard_count - 1}"
+        )
+    first_id = devices * shard_index // shard_count
+    return first_id, devices * (shard_index + 1) // shard_count - first_id
+
+
+def get_epoch_milli(ns: int = None) -> int:
+    if ns is None:
+        ns = time.time_ns()
+    return ns // 1000000
+
+
+# (epoch seconds, "%Y-%m-%d %H:%M:%S" UTC) of the last formatted timestamp
+_isotimestamp_cache = (None, None)
+
+
+def get_isotimestamp(ns: int = None) -> str:
+    global _isotimestamp_cache
+    if ns is None:
+        ns = time.time_ns()
+    seconds, ns = divmod(ns, 1000000000)
+    cache = _isotimestamp_cache
+    if cache[0] != seconds:
+        cache = (
+            seconds,
+            time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(seconds)),
+        )
+        _isotimestamp_cache = cache
+    return f"{cache[1]}.{ns // 1000:06d}"
+
+
+def get_timestamp(
+    epoch: bool = True,
+    ns: int = None,
+):
+    if epoch:
+        return get_epoch_milli(ns)
+    return get_isotimestamp(ns)
 
 
 def round_temp(t: float) -> float:
@@ -61,7 +278,16 @@ def generate_serial_number(
 
 @lru_cache
 def get_locations(location_data_file: str) -> list:
+    # JSON location data or location store file (memory mapped, see
+    # utils/locations.py)
+    from utils.locations import (
+        LocationStore,
+        is_location_store,
+    )
+
     try:
+        if is_location_store(location_data_file):
+            return LocationStore(location_data_file)
         with open(location_data_file, "r") as f:
             result = json.loads(f.read())
     except Exception:
@@ -69,26 +295,37 @@ def get_locations(location_data_file: str) -> list:
         result = [
             {
                 "city": "Prime Meridian",
-                "lat": "0",
-                "lng": "0",
+                "lat": 0.0,
+                "lng": 0.0,
                 "country": "Ghana",
             }
         ]
     return result
 
 
+def get_location_id(
+    serial_number: str,
+    locations: list,
+) -> int:
+    return int(serial_number, 16) % len(locations)
+
+
+@lru_cache(maxsize=None)
+def get_temp_mu(city: str) -> int:
+    seed_loc_hash = hashlib.sha256(city.encode("utf-8")).hexdigest()
+    seed_loc = int(seed_loc_hash[-12:], 16)
+    return 7 + seed_loc % 17
+
+
 def get_details(
     id: int,
     seed: str,
     location_data_file: str,
 ) -> tuple:
     serial_number = generate_serial_number(id, seed)
-    seed_sn = int(serial_number, 16)
     locations = get_locations(location_data_file)
-    location = locations[seed_sn % len(locations)]
-    seed_loc_hash = hashlib.sha256(location["city"].encode("utf-8")).hexdigest()
-    seed_loc = int(seed_loc_hash[-12:], 16)
-    temp_mu = 7 + seed_loc % 17
+    location = locations[get_location_id(serial_number, locations)]
+    temp_mu = get_temp_mu(location["city"])
     temp_sigma = 1
     return (
         serial_number,
@@ -0,0 +1,120 @@
+import io
+import json
+import struct
+
+from fastavro import parse_schema, schemaless_writer
+from confluent_kafka.schema_registry import (
+    Schema,
+    SchemaRegistryClient,
+)
+
+
+# Avro primitive types encoded by compile_avro_encoder
+STRUCT_FORMATS = {
+    "double": "<d",
+    "float": "<f",
+}
+VARINT_TYPES = (
+    "int",
+    "long",
+)
+
+
+def encode_long(n: int) -> bytes:
+    # Zig-zag, variable length (Avro int and long)
+    n = (n << 1) ^ (n >> 63)
+    result = bytearray()
+    while n & ~0x7F:
+        result.append((n & 0x7F) | 0x80)
+        n >>= 7
+    result.append(n)
+    return bytes(result)
+
+
+# String lengths up to 1023 (bytes) are looked up
+VARINTS = tuple(encode_long(n) for n in range(1024))
+
+
+def compile_avro_encoder(parsed_schema: dict):
+    # Returns encode(record) -> bytes, same as fastavro.schemaless_writer for
+    # a record schema of string, double, float, int, long and boolean fields
+    # (None if the schema has any other type, see AvroValueSerializer)
+    if not isinstance(parsed_schema, dict) or parsed_schema.get("type") != "record":
+        return None
+    namespace = {
+        "varints": VARINTS,
+        "encode_long": encode_long,
+    }
+    lines = list()
+    parts = list()
+    for n, field in enumerate(parsed_schema["fields"]):
+        _type = field["type"]
+        if not isinstance(_type, str):
+            return None
+        value = f"record[{field['name']!r}]"
+        if _type == "string":
+            lines.append(f"    v{n} = {value}.encode('utf-8')")
+            lines.append(f"    l{n} = len(v{n})")
+            parts.append(f"varints[l{n}] if l{n} < 1024 else encode_long(l{n})")
+            parts.append(f"v{n}")
+        elif _type in STRUCT_FORMATS:
+            namespace[f"pack_{n}"] = struct.Struct(STRUCT_FORMATS[_type]).pack
+            parts.append(f"pack_{n}({value})")
+        elif _type in VARINT_TYPES:
+            parts.append(f"encode_long({value})")
+        elif _type == "boolean":
+            parts.append(f"b'\\x01' if {value} else b'\\x00'")
+        else:
+            return None
+
+    source = "def encode(record, header=b''):\n"
+    source += "".join(f"{line}\n" for line in lines)
+    source += f"    return b''.join((header, {', '.join(f'({part})' for part in parts)}))\n"
+    exec(source, namespace)
+    return namespace["encode"]
+
+
+class AvroValueSerializer:
+    # Same bytes as AvroSerializer(schema_registry_client, schema_str) with
+    # the default TopicNameStrategy, but the schema is parsed (and compiled
+    # into an encoder) once and the wire format header (magic byte + schema
+    # id) is built once the schema is registered (on the first record)
+    # instead of on every record
+    def __init__(
+        self,
+        schema_registry_client: SchemaRegistryClient,
+        schema_str: str,
+        topic: str,
+        compiled: bool = True,
+    ) -> None:
+        self.schema_registry_client = schema_registry_client
+        self.schema = Schema(schema_str, schema_type="AVRO")
+        self.parsed_schema = parse_schema(json.loads(schema_str))
+        self.subject = f"{topic}-value"
+        self.header = None
+        self._encode = compile_avro_encoder(self.parsed_schema) if compiled else None
+        self._buffer = io.BytesIO()
+
+    def register(self) -> int:
+        schema_id = self.schema_registry_client.register_schema(
+            self.subject,
+            self.schema,
+        )
+        self.header = struct.pack(">bI", 0, schema_id)
+        return schema_id
+
+    def __call__(
+        self,
+        record: dict,
+    ) -> bytes:
+        if self.header is None:
+            self.register()
+        if self._encode is not None:
+            return self._encode(record, self.header)
+        # Schema types not compiled
+        buffer = self._buffer
+        buffer.seek(0)
+        buffer.truncate()
+        buffer.write(self.header)
+        schemaless_writer(buffer, self.parsed_schema, record)
+        return buffer.getvalue()
@@ -0,0 +1,29 @@
+import random
+
+
+class Backoff:
+    # Exponential backoff with jitter, attempt n waits a random time between
+    # half and all of min(max_delay, first_delay * rate ** n) seconds
+    def __init__(
+        self,
+        first_delay: float = 1,
+        rate: float = 2,
+        max_delay: float = 5,
+        jitter: float = 0.5,
+    ) -> None:
+        self.first_delay = first_delay
+        self.rate = rate
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.attempts = 0
+
+    def reset(self) -> None:
+        self.attempts = 0
+
+    def next(self) -> float:
+        delay = min(
+            self.max_delay,
+            self.first_delay * self.rate ** min(self.attempts, 64),
+        )
+        self.attempts += 1
+        return delay * (1 - self.jitter * random.random())
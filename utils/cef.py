@@ -0,0 +1,132 @@
+from cefevent import CEFEvent
+
+
+# Severity names accepted by cefevent (otherwise an int in [0-10])
+SEVERITY_NAMES = (
+    "Unknown",
+    "Low",
+    "Medium",
+    "High",
+    "Very-High",
+)
+SEVERITIES = {
+    **{name: name for name in SEVERITY_NAMES},
+    **{n: str(n) for n in range(11)},
+}
+# Default prefix fields (CEFEvent.reset)
+PREFIXES = {
+    "version": 0,
+    "deviceVendor": "CEF Vendor",
+    "deviceProduct": "CEF Product",
+    "deviceVersion": "1.0",
+    "signatureId": "0",
+    "name": "CEF Event",
+}
+
+
+def escape_prefix(value: str) -> str:
+    # Same as CEFEvent.set_prefix
+    return value.replace("\\", "\\\\").replace("|", "\\|").strip()
+
+
+def format_severity(value) -> str:
+    # Same as CEFEvent.set_prefix (strict)
+    severity = SEVERITIES.get(value) if isinstance(value, (int, str)) else None
+    if severity is None:
+        if value in SEVERITY_NAMES:
+            return value
+        if int(value) not in range(0, 11):
+            raise ValueError(f"The severity must be an int in [0-10]. Not: {value}")
+        severity = str(int(value))
+    return severity
+
+
+class CEFEncoder:
+    # Same string as CEFEvent(strict=True).build_cef() with the prefix fields
+    # and then the `extensions` (field, value) set in order, a value of None
+    # meaning the field is set on every event (Floating Point and String
+    # fields only). The constant extensions are validated and escaped once,
+    # the prefix fields (but the severity) once per header(), encode() only
+    # formats the severity and the variable extensions
+    def __init__(
+        self,
+        extensions: tuple,
+    ) -> None:
+        event = CEFEvent(strict=True)
+        namespace = {
+            "format_severity": format_severity,
+            "SEVERITIES": SEVERITIES,
+        }
+        args = list()
+        lines = list()
+        parts = list()
+        constant = ""
+        names = set()
+        for n, (field, value) in enumerate(extensions):
+            name = event.get_cef_field_name(field)
+            if name is None:
+                raise ValueError(f"Unknown CEF field: {field}")
+            if name in names:
+                raise ValueError(f"CEF field {field} set more than once")
+            names.add(name)
+            separator = " " if n else ""
+            if value is not None:
+                # Raises ValueError if invalid
+                constant += f"{separator}{name}={event.set_field(field, value)}"
+                continue
+            metadata = event.get_field_metadata(field)
+            data_type = metadata["data_type"]
+            arg = f"v{len(args)}"
+            args.append(arg)
+            error = f"raise ValueError({f'Invalid value for field: {field}'!r})"
+            if data_type == ["Floating Point"]:
+                lines.append("    try:")
+                lines.append(f"        {arg} = float({arg})")
+                lines.append("    except Exception:")
+                lines.append(f"        {error}")
+                # Set by short name, falsy values are rejected
+                if field != metadata.get("full_name"):
+                    lines.append(f"    if not {arg}:")
+                    lines.append(f"        {error}")
+                lines.append(f"    {arg} = repr({arg})")
+            elif data_type == ["String"]:
+                lines.append(f"    {arg} = str({arg}).strip()")
+                if metadata["length"] > 0:
+                    lines.append(f"    if len({arg}) > {metadata['length']}:")
+                    lines.append(f"        {error}")
+                lines.append(
+                    f"    {arg} = {arg}.replace('\\\\', '\\\\\\\\').replace('=', '\\\\=').replace('\\n', '\\\\n')"
+                )
+                if field != metadata.get("full_name"):
+                    lines.append(f"    if not {arg}:")
+                    lines.append(f"        {error}")
+            else:
+                raise ValueError(
+                    f"CEF field {field} not supported, data type: {', '.join(data_type)}"
+                )
+            parts.append(repr(f"{constant}{separator}{name}="))
+            parts.append(arg)
+            constant = ""
+        parts.append(repr(constant))
+        self.fields = tuple(field for field, value in extensions if value is None)
+
+        source = f"def encode(header, severity, {', '.join(args + [''])}):\n"
+        source += "    s = SEVERITIES.get(severity) if severity.__class__ is int else None\n"
+        source += "    if s is None:\n"
+        source += "        s = format_severity(severity)\n"
+        source += "".join(f"{line}\n" for line in lines)
+        source += f"    return ''.join((header, s, '|', {', '.join(parts)}))\n"
+        exec(source, namespace)
+        self.encode = namespace["encode"]
+
+    @staticmethod
+    def header(**prefixes) -> str:
+        # Prefix fields up to the severity, e.g. CEF:0|Vendor|Product|1.0|100|Name|
+        values = {prefix: str(value) for prefix, value in PREFIXES.items()}
+        for prefix, value in prefixes.items():
+            if prefix not in PREFIXES:
+                raise ValueError(f"Unknown CEF prefix: {prefix}")
+            values[prefix] = escape_prefix(value)
+        return "CEF:{version}|{deviceVendor}|{deviceProduct}|{deviceVersion}|{signatureId}|{name}|".format(
+            **values
+        )
@@ -0,0 +1,83 @@
+import os
+
+from array import array
+
+from utils import (
+    get_locations,
+    get_temp_mu,
+)
+from utils.identity import get_identities
+from utils.random_walk import TemperatureWalk
+
+
+class DeviceTable:
+    # Device state kept in parallel arrays indexed by device id (instead of
+    # one dict per device) so a single process can hold 100k+ devices
+    __slots__ = (
+        "serial_numbers",
+        "temperatures",
+        "location_ids",
+        "locations",
+        "walker",
+        "first_id",
+    )
+
+    def __init__(
+        self,
+        devices: int,
+        seed: str,
+        location_data_file: str,
+        fahrenheit: bool = False,
+        temp_sigma: float = 1,
+        random_seed: str = None,
+        use_numpy: bool = None,
+        first_id: int = 0,
+        identity_cache_dir: str = None,
+    ) -> None:
+        # Device `_id` is the global device id `first_id + _id` (sharding)
+        self.first_id = first_id
+        self.locations = get_locations(location_data_file)
+        # Identities (serial numbers) saved to/loaded from IDENTITY_CACHE_DIR if set
+        if identity_cache_dir is None:
+            identity_cache_dir = os.environ.get("IDENTITY_CACHE_DIR") or None
+        self.serial_numbers, self.location_ids = get_identities(
+            first_id,
+            devices,
+            seed,
+            self.locations,
+            cache_dir=identity_cache_dir,
+        )
+        # get_temp_mu() is memoized, one hash per location (city) used
+        locations = self.locations
+        temp_mus = array(
+            "d",
+            [get_temp_mu(locations[n]["city"]) for n in self.location_ids],
+        )
+
+        # Same seed, simulator (seed) and shard -> same temperatures on every run
+        if random_seed:
+            random_seed = f"{random_seed}{seed}{first_id or ''}"
+        self.walker = TemperatureWalk(
+            seed=random_seed,
+            use_numpy=use_numpy,
+        )
+        self.temperatures = self.walker.initial(
+            temp_mus,
+            temp_sigma=temp_sigma,
+            fahrenheit=fahrenheit,
+        )
+
+    def __len__(self) -> int:
+        return len(self.serial_numbers)
+
+    def location(
+        self,
+        _id: int,
+    ) -> dict:
+        return self.locations[self.location_ids[_id]]
+
+    def walk(
+        self,
+        ids: list,
+    ) -> list:
+        return self.walker.step(self.temperatures, ids)
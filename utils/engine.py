@@ -0,0 +1,437 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+
+from utils import (
+    sys_exc,
+    get_env_bool,
+    get_devices_count,
+    get_shard,
+    get_timestamp,
+    telemetry,
+)
+from utils.devices import DeviceTable
+from utils.recording import (
+    RecordWriter,
+    Recording,
+    get_recording_file,
+)
+from utils.scheduler import DeviceScheduler, RateScheduler
+
+
+class Transport:
+    # Plugin interface of the Simulator engine, one implementation per
+    # protocol (iot_*.py). bind() is called once with the device table (per
+    # device constants: keys, topics...), encode() builds the record of a
+    # device and send_batch() sends (or queues) the records of all the
+    # devices due on a tick
+    name = "transport"
+    # Timestamps as epoch millis or ISO 8601 strings
+    timestamp_epoch = True
+
+    def bind(
+        self,
+        devices: DeviceTable,
+    ) -> None:
+        self.devices = devices
+
+    async def start(self) -> None:
+        pass
+
+    def timestamp(self):
+        # Shared by all the records of a tick (BATCH_TIMESTAMP)
+        return get_timestamp(epoch=self.timestamp_epoch)
+
+    def format_timestamp(
+        self,
+        timestamp,
+    ) -> bytes:
+        # As written in the payloads (found and rewritten on playback)
+        return str(timestamp).encode("ascii")
+
+    def encode(
+        self,
+        _id: int,
+        temperature: float,
+        location: dict,
+        timestamp=None,
+    ):
+        raise NotImplementedError
+
+    def dump(
+        self,
+        record,
+    ) -> bytes:
+        # Record as written to a recording (records not bytes, e.g. dicts,
+        # must override dump() and load())
+        return record
+
+    def load(
+        self,
+        payload: bytes,
+    ):
+        return payload
+
+    async def send_batch(
+        self,
+        records: list,
+    ) -> list:
+        # `records`: (device id, record) tuples. Returns the ids of the
+        # devices to retry (not sent nor queued)
+        raise NotImplementedError
+
+    async def poll(self) -> None:
+        # Called on every tick, e.g. to send the batches lingering
+        pass
+
+    def next_flush_in(self) -> float:
+        # Seconds until poll() has something to send (None: nothing to send)
+        return None
+
+    def paused_for(self) -> float:
+        # Seconds until sending is resumed (e.g. server overloaded)
+        return 0
+
+    async def close(self) -> None:
+        pass
+
+
+async def poll(transport: Transport) -> None:
+    # As send_batch(), errors logged so the simulator (and the others on the
+    # same event loop) keeps running
+    try:
+        await transport.poll()
+    except Exception:
+        logging.error(sys_exc(sys.exc_info()))
+        logging.error(f"Error when polling ({transport.name})")
+
+
+class Simulator:
+    # Engine shared by all the IoT device scripts: this process' shard of the
+    # devices (DeviceTable), when each one is due (DeviceScheduler) and their
+    # temperature walk, the records of the devices due on a tick are sent by
+    # the transport in one batch. With a `target_rate` (msgs/sec, all the
+    # shards) devices are due at that aggregate rate instead (RateScheduler,
+    # optionally ramped up over `ramp_seconds` in `rate_steps` steps)
+    def __init__(
+        self,
+        transport: Transport,
+        devices: int,
+        seed: str,
+        location_data_file: str,
+        min_interval_ms: int,
+        max_interval_ms: int,
+        fahrenheit: bool = False,
+        batch_timestamp: bool = False,
+        random_seed: str = None,
+        recording_dir: str = None,
+        target_rate: float = None,
+        ramp_seconds: float = 0,
+        rate_steps: int = 0,
+    ) -> None:
+        self.transport = transport
+        self.batch_timestamp = batch_timestamp
+        first_id, shard_devices = get_shard(devices)
+        if target_rate and shard_devices:
+            # This shard's share of the rate
+            self.scheduler = RateScheduler(
+                target_rate * shard_devices / devices,
+                shard_devices,
+                ramp_seconds=ramp_seconds,
+                steps=rate_steps,
+            )
+            telemetry.gauge(f"{transport.name}_target_rate", self.scheduler.rate)
+        else:
+            # Same seed, simulator (seed) and shard -> same intervals per
+            # device on every run
+            self.scheduler = DeviceScheduler(
+                min_interval_ms,
+                max_interval_ms,
+                seed=(
+                    f"{random_seed}{seed}{first_id or ''}_intervals"
+                    if random_seed
+                    else None
+                ),
+            )
+        self.devices = DeviceTable(
+            shard_devices,
+            seed,
+            location_data_file,
+            fahrenheit=fahrenheit,
+            random_seed=random_seed,
+            first_id=first_id,
+        )
+        for _id in range(shard_devices):
+            self.scheduler.add(_id)
+        transport.bind(self.devices)
+        # Records also written to `recording_dir` (see Playback)
+        self.recorder = None
+        self._started_ns = time.monotonic_ns()
+        if recording_dir:
+            self.recorder = RecordWriter(
+                get_recording_file(recording_dir, transport.name, first_id),
+                transport.name,
+                self.devices.serial_numbers,
+                first_id=first_id,
+            )
+
+    @classmethod
+    def from_env(
+        cls,
+        transport: Transport,
+        prefix: str,
+        seed: str,
+        fahrenheit: bool = False,
+    ):
+        # Env vars {prefix}_DEVICES, {prefix}_MIN_ITERVAL_MS,
+        # {prefix}_MAX_ITERVAL_MS and {prefix}_TARGET_RATE, plus the general
+        # ones. A Playback of the
+        # recording of this transport and shard if PLAYBACK_DIR is set
+        devices = get_devices_count(
+            int(os.environ[f"{prefix}_DEVICES"]),
+            scale_mode=get_env_bool("SCALE_MODE"),
+        )
+        playback_dir = os.environ.get("PLAYBACK_DIR") or None
+        if playback_dir:
+            first_id, _ = get_shard(devices)
+            return Playback(
+                transport,
+                Recording(get_recording_file(playback_dir, transport.name, first_id)),
+                speed=float(os.environ.get("PLAYBACK_SPEED", 1)),
+                loop=get_env_bool("PLAYBACK_LOOP"),
+            )
+        return cls(
+            transport,
+            devices,
+            seed,
+            os.environ["LOCATION_DATA"],
+            int(os.environ[f"{prefix}_MIN_ITERVAL_MS"]),
+            int(os.environ[f"{prefix}_MAX_ITERVAL_MS"]),
+            fahrenheit=fahrenheit,
+            batch_timestamp=get_env_bool("BATCH_TIMESTAMP"),
+            random_seed=os.environ.get("SIMULATOR_SEED"),
+            recording_dir=os.environ.get("RECORD_DIR") or None,
+            target_rate=float(os.environ.get(f"{prefix}_TARGET_RATE") or 0),
+            ramp_seconds=float(os.environ.get("RATE_RAMP_SECONDS") or 0),
+            rate_steps=int(os.environ.get("RATE_STEPS") or 0),
+        )
+
+    async def step(self) -> float:
+        # One tick, returns the seconds until the next one
+        transport = self.transport
+        paused_for = transport.paused_for()
+        if paused_for > 0:
+            return paused_for
+
+        scheduler = self.scheduler
+        devices = self.devices
+        due = scheduler.due()
+        if due:
+            # Same timestamp for all devices due on this tick
+            timestamp = transport.timestamp() if self.batch_timestamp else None
+            encode = transport.encode
+            recorder = self.recorder
+            if recorder is not None:
+                elapsed_ns = time.monotonic_ns() - self._started_ns
+                if timestamp is not None:
+                    formatted = transport.format_timestamp(timestamp)
+            records = list()
+            for _id, temperature in zip(due, devices.walk(due)):
+                try:
+                    if recorder is None:
+                        record = encode(
+                            _id,
+                            temperature,
+                            devices.location(_id),
+                            timestamp,
+                        )
+                    else:
+                        # Timestamp known, so it can be found in the payload
+                        if not self.batch_timestamp:
+                            timestamp = transport.timestamp()
+                            formatted = transport.format_timestamp(timestamp)
+                        record = encode(
+                            _id,
+                            temperature,
+                            devices.location(_id),
+                            timestamp,
+                        )
+                        recorder.write(
+                            elapsed_ns,
+                            _id,
+                            transport.dump(record),
+                            formatted,
+                        )
+                    records.append((_id, record))
+                except Exception:
+                    logging.error(sys_exc(sys.exc_info()))
+                    logging.error(
+                        f"Error when encoding the record of device ({devices.serial_numbers[_id]})"
+                    )
+                    scheduler.retry(_id)
+
+            try:
+                retry = set(await transport.send_batch(records) or ())
+            except Exception:
+                logging.error(sys_exc(sys.exc_info()))
+                logging.error(f"Error when sending {len(records)} records ({transport.name})")
+                retry = {_id for _id, _ in records}
+            for _id, _ in records:
+                if _id in retry:
+                    scheduler.retry(_id)
+                else:
+                    scheduler.add(_id)
+
+        await poll(transport)
+        telemetry.tick()
+        return scheduler.next_in(timeout=transport.next_flush_in())
+
+    async def run(self) -> None:
+        await self.transport.start()
+        try:
+            while True:
+                await asyncio.sleep(await self.step())
+
+        finally:
+            logging.info(f"Stopping {self.transport.name}")
+            try:
+                await self.transport.close()
+            except Exception:
+                logging.error(sys_exc(sys.exc_info()))
+            if self.recorder is not None:
+                self.recorder.close()
+                logging.info(
+                    f"{self.recorder.records} records written to {self.recorder.recording_file}"
+                )
+
+
+class Playback:
+    # Sends the records of a recording (see Simulator, RECORD_DIR) instead of
+    # generating them: at the pace recorded (`speed` 1), `speed` times faster
+    # or as fast as possible (`speed` 0), up to `max_batch` records per
+    # send_batch(). Payloads are read from the memory mapped recording, the
+    # timestamp in each one rewritten with the current time (the only copy)
+    def __init__(
+        self,
+        transport: Transport,
+        recording: Recording,
+        speed: float = 1,
+        loop: bool = False,
+        max_batch: int = 1000,
+    ) -> None:
+        if recording.name != transport.name:
+            raise ValueError(
+                f"Recording {recording.recording_file} is of {recording.name}, not {transport.name}"
+            )
+        self.transport = transport
+        self.speed = max(0, speed)
+        self.loop = loop
+        self.max_batch = max(1, max_batch)
+        # Serial numbers (and first device id) recorded, as a DeviceTable
+        self.devices = recording
+        self.skipped = 0
+        transport.bind(recording)
+
+    async def _send(
+        self,
+        records: list,
+    ) -> None:
+        transport = self.transport
+        try:
+            self.skipped += len(await transport.send_batch(records) or ())
+        except Exception:
+            logging.error(sys_exc(sys.exc_info()))
+            logging.error(f"Error when sending {len(records)} records ({transport.name})")
+            self.skipped += len(records)
+        await poll(transport)
+        telemetry.tick()
+
+    async def _wait(
+        self,
+        seconds: float,
+    ) -> None:
+        # Records lingering sent meanwhile
+        transport = self.transport
+        deadline = time.monotonic() + seconds
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return
+            next_flush_in = transport.next_flush_in()
+            if next_flush_in is not None:
+                timeout = min(timeout, next_flush_in)
+            await asyncio.sleep(max(timeout, transport.paused_for()))
+            await poll(transport)
+            telemetry.tick()
+
+    async def play(self) -> None:
+        transport = self.transport
+        speed = self.speed
+        load = transport.load
+        started = time.monotonic()
+        timestamp = None
+        records = list()
+        for elapsed_ns, _id, payload, offset, length in self.devices.records():
+            if speed > 0:
+                wait = started + elapsed_ns / 1e9 / speed - time.monotonic()
+                if wait > 0:
+                    if records:
+                        await self._send(records)
+                        records = list()
+                    await self._wait(wait)
+                    timestamp = None
+            if timestamp is None:
+                # Once per batch
+                timestamp = transport.format_timestamp(transport.timestamp())
+            if offset >= 0:
+                payload = b"".join(
+                    (payload[:offset], timestamp, payload[offset + length :])
+                )
+            else:
+                payload = payload.tobytes()
+            records.append((_id, load(payload)))
+            if len(records) >= self.max_batch:
+                await self._send(records)
+                records = list()
+                timestamp = None
+                # Other tasks run, even at max speed
+                await asyncio.sleep(0)
+        if records:
+            await self._send(records)
+
+    async def run(self) -> None:
+        transport = self.transport
+        await transport.start()
+        try:
+            while True:
+                await self.play()
+                logging.info(
+                    f"Played back {self.devices.recording_file} ({transport.name}), records not sent: {self.skipped}"
+                )
+                if not self.loop:
+                    break
+
+        finally:
+            logging.info(f"Stopping {transport.name}")
+            try:
+                await transport.close()
+            except Exception:
+                logging.error(sys_exc(sys.exc_info()))
+
+
+async def run(*simulators) -> None:
+    # All the simulators/playbacks (e.g. one per protocol) on the same event
+    # loop, all stopped (their transports closed) once one fails or on CTRL-C
+    tasks = [asyncio.create_task(simulator.run()) for simulator in simulators]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()
+
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.wait(tasks)
+        telemetry.tick(force=True)
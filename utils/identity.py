@@ -0,0 +1,84 @@
+import os
+import hashlib
+import logging
+
+from array import array
+
+
+# Serial numbers are the last 12 hex digits (6 bytes) of the SHA-256 digest
+SERIAL_NUMBER_BYTES = 6
+
+
+def generate_digests(
+    first_id: int,
+    count: int,
+    seed: str,
+) -> bytes:
+    # Serial numbers of ids first_id to first_id + count - 1 in one pass, as
+    # bytes (same as generate_serial_number(id, seed) once hex encoded)
+    sha256 = hashlib.sha256
+    suffix = f"_{seed}".encode("utf-8")
+    return b"".join(
+        [
+            sha256(b"%d%s" % (_id, suffix)).digest()[-SERIAL_NUMBER_BYTES:]
+            for _id in range(first_id, first_id + count)
+        ]
+    )
+
+
+def get_cache_file(
+    cache_dir: str,
+    first_id: int,
+    count: int,
+    seed: str,
+) -> str:
+    seed_hash = hashlib.sha256(seed.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, f"identities-{seed_hash}-{first_id}-{count}.bin")
+
+
+def load_digests(
+    first_id: int,
+    count: int,
+    seed: str,
+    cache_dir: str = None,
+) -> bytes:
+    # Generated once and saved on `cache_dir` (if set), loaded from there on
+    # the next runs
+    if cache_dir is None:
+        return generate_digests(first_id, count, seed)
+    cache_file = get_cache_file(cache_dir, first_id, count, seed)
+    try:
+        with open(cache_file, "rb") as f:
+            digests = f.read()
+        if len(digests) == count * SERIAL_NUMBER_BYTES:
+            return digests
+        logging.warning(f"Invalid identity cache file {cache_file}, regenerating it")
+    except FileNotFoundError:
+        pass
+    digests = generate_digests(first_id, count, seed)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Renamed once written, processes loading it never see a partial file
+    with open(f"{cache_file}.{os.getpid()}", "wb") as f:
+        f.write(digests)
+    os.replace(f"{cache_file}.{os.getpid()}", cache_file)
+    return digests
+
+
+def get_identities(
+    first_id: int,
+    count: int,
+    seed: str,
+    locations: list,
+    cache_dir: str = None,
+) -> tuple:
+    # (serial numbers, location ids) of ids first_id to first_id + count - 1,
+    # same as generate_serial_number() and get_location_id() per id
+    digests = load_digests(first_id, count, seed, cache_dir=cache_dir).hex()
+    step = SERIAL_NUMBER_BYTES * 2
+    serial_numbers = [digests[n : n + step] for n in range(0, len(digests), step)]
+    locations_count = len(locations)
+    location_ids = array(
+        "I",
+        [int(serial_number, 16) % locations_count for serial_number in serial_numbers],
+    )
+    return serial_numbers, location_ids
@@ -0,0 +1,173 @@
+import os
+import sys
+import json
+import mmap
+import struct
+import logging
+import argparse
+
+from array import array
+
+
+# Header: magic, rows, strings, string bytes. Then the columns: lat and lng
+# (float64), city and country (uint32, string ids), string offsets (uint64,
+# strings + 1) and the UTF-8 strings, all little endian
+MAGIC = b"IOTLOC\x00\x01"
+HEADER = struct.Struct("<8sQQQ")
+
+
+def is_location_store(location_data_file: str) -> bool:
+    with open(location_data_file, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _column(
+    typecode: str,
+    values,
+) -> bytes:
+    column = array(typecode, values)
+    if sys.byteorder != "little":
+        column.byteswap()
+    return column.tobytes()
+
+
+def compile_locations(
+    locations: list,
+    location_store_file: str,
+) -> None:
+    # List of dicts (city, lat, lng and country) to a location store file,
+    # city and country names interned
+    strings = dict()
+    cities = array("I")
+    countries = array("I")
+    for location in locations:
+        cities.append(strings.setdefault(location["city"], len(strings)))
+        countries.append(strings.setdefault(location.get("country", ""), len(strings)))
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = [0]
+    for string in encoded:
+        offsets.append(offsets[-1] + len(string))
+
+    # Renamed once written, processes loading it never see a partial file
+    with open(f"{location_store_file}.{os.getpid()}", "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(locations), len(encoded), offsets[-1]))
+        f.write(_column("d", (float(location["lat"]) for location in locations)))
+        f.write(_column("d", (float(location["lng"]) for location in locations)))
+        f.write(_column("I", cities))
+        f.write(_column("I", countries))
+        f.write(_column("Q", offsets))
+        f.write(b"".join(encoded))
+    os.replace(f"{location_store_file}.{os.getpid()}", location_store_file)
+
+
+class LocationStore:
+    # Read only list of locations memory mapped from a location store file
+    # (see compile_locations), so the pages are shared between processes and
+    # only the rows accessed are read. Rows are returned as dicts (city, lat,
+    # lng and country) as the JSON location data, built on first access
+    __slots__ = (
+        "lats",
+        "lngs",
+        "cities",
+        "countries",
+        "_offsets",
+        "_strings",
+        "_decoded",
+        "_rows",
+        "_mmap",
+    )
+
+    def __init__(
+        self,
+        location_store_file: str,
+    ) -> None:
+        with open(location_store_file, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, rows, strings, size = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"Invalid location store file {location_store_file}")
+        view = memoryview(self._mmap)
+        columns = list()
+        offset = HEADER.size
+        for typecode, count in (
+            ("d", rows),
+            ("d", rows),
+            ("I", rows),
+            ("I", rows),
+            ("Q", strings + 1),
+        ):
+            end = offset + count * array(typecode).itemsize
+            if sys.byteorder == "little":
+                columns.append(view[offset:end].cast(typecode))
+            else:
+                # Copied, not memory mapped
+                column = array(typecode, view[offset:end])
+                column.byteswap()
+                columns.append(column)
+            offset = end
+        self.lats, self.lngs, self.cities, self.countries, self._offsets = columns
+        self._strings = view[offset : offset + size]
+        self._decoded = [None] * strings
+        self._rows = dict()
+
+    def __len__(self) -> int:
+        return len(self.lats)
+
+    def __iter__(self):
+        for n in range(len(self.lats)):
+            yield self[n]
+
+    def string(
+        self,
+        n: int,
+    ) -> str:
+        # Interned, decoded once
+        string = self._decoded[n]
+        if string is None:
+            string = str(
+                self._strings[self._offsets[n] : self._offsets[n + 1]], "utf-8"
+            )
+            self._decoded[n] = string
+        return string
+
+    def __getitem__(
+        self,
+        n: int,
+    ) -> dict:
+        if n < 0:
+            n += len(self.lats)
+        row = self._rows.get(n)
+        if row is None:
+            row = {
+                "city": self.string(self.cities[n]),
+                "lat": self.lats[n],
+                "lng": self.lngs[n],
+                "country": self.string(self.countries[n]),
+            }
+            self._rows[n] = row
+        return row
+
+
+if __name__ == "__main__":
+    from utils import set_logging_handler
+
+    FILE_APP = os.path.splitext(os.path.split(__file__)[-1])[0]
+    set_logging_handler(FILE_APP)
+
+    parser = argparse.ArgumentParser(
+        description="Compile a JSON location data file (list of city, lat, lng and country) into a memory mapped location store file"
+    )
+    parser.add_argument(
+        "location_data",
+        help="JSON location data file, e.g. config/uk_coordinates.json",
+    )
+    parser.add_argument(
+        "location_store",
+        help="Location store file, e.g. config/uk_coordinates.bin (set it as LOCATION_DATA)",
+    )
+    args = parser.parse_args()
+
+    with open(args.location_data, "r") as f:
+        locations = json.loads(f.read())
+    compile_locations(locations, args.location_store)
+    logging.info(f"{len(locations)} locations written to {args.location_store}")
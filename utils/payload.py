@@ -0,0 +1,136 @@
+import json
+
+from json.encoder import encode_basestring_ascii
+
+from utils import (
+    get_epoch_milli,
+    get_isotimestamp,
+)
+
+
+# Same fields (and order) as utils.generate_payload
+PAYLOAD_FIELDS = (
+    "temperature",
+    "manufacturer",
+    "dev_family",
+    "location",
+    "lat",
+    "lng",
+    "serial_number",
+    "unit",
+)
+CONSTANT_FIELDS = (
+    "manufacturer",
+    "dev_family",
+    "unit",
+)
+STRING_FIELDS = (
+    "location",
+    "serial_number",
+)
+
+
+def _number(value):
+    # A number json.dumps can encode: NumPy (and other numeric) scalars are
+    # converted to float
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return float(value)
+
+
+def compile_payload(
+    manufacturer: str = None,
+    dev_family: str = None,
+    unit: str = None,
+    timestamp_key: str = "timestamp",
+    temperature_key: str = "temperature",
+    manufacturer_key: str = "manufacturer",
+    dev_family_key: str = "dev_family",
+    serial_number_key: str = "serial_number",
+    location_key: str = "location",
+    unit_key: str = "unit",
+    lat_key: str = "lat",
+    lng_key: str = "lng",
+    _timestamp_epoch: bool = True,
+    _json: bool = False,
+):
+    # Returns build(temperature, serial_number, location, lat, lng, timestamp=None)
+    # generating the same payload as utils.generate_payload, as a dict or, if
+    # _json is True, as the bytes of json.dumps(payload). Constant fields set
+    # to None, per message fields with the key set to None and per message
+    # fields given as None are left out
+    local_vars = dict(locals())
+    namespace = {
+        "encode": encode_basestring_ascii,
+        "dumps": json.dumps,
+        "number": _number,
+        "get_timestamp": get_epoch_milli if _timestamp_epoch else get_isotimestamp,
+    }
+
+    # (key, argument name or None if constant, value if constant)
+    fields = [(timestamp_key, "timestamp", None)]
+    for field in PAYLOAD_FIELDS:
+        key = local_vars[f"{field}_key"]
+        if field in CONSTANT_FIELDS:
+            if local_vars[field] is not None:
+                fields.append((key, None, local_vars[field]))
+        elif key is not None:
+            fields.append((key, field, None))
+
+    # `fast` returned if all the per message fields pass their `checks`,
+    # `fallback` (per message fields given as None left out) otherwise
+    items = list()
+    checks = list()
+    for n, (key, arg, value) in enumerate(fields):
+        namespace[f"key_{n}"] = key
+        if arg is None:
+            namespace[f"value_{n}"] = value
+            arg = f"value_{n}"
+        elif arg != "timestamp":
+            checks.append(f"{arg} is not None")
+            if _json and arg not in STRING_FIELDS:
+                arg = f"number({arg})"
+        items.append(f"key_{n}: {arg}")
+    fast = "{" + ", ".join(items) + "}"
+    fallback = f"{{key: value for key, value in {fast}.items() if value is not None}}"
+
+    if _json:
+        fallback = f"dumps({fallback}).encode(\"utf-8\")"
+        template = list()
+        args = list()
+        checks = list()
+        for key, arg, value in fields:
+            if arg is None:
+                value = json.dumps(value).replace("%", "%%")
+            elif arg == "timestamp":
+                value = "%d" if _timestamp_epoch else '"%s"'
+                args.append(arg)
+            elif arg in STRING_FIELDS:
+                value = "%s"
+                args.append(f"encode({arg})")
+                checks.append(f"{arg} is not None")
+            else:
+                # %r of a finite float is float.__repr__, what json.dumps uses
+                # for numbers. Anything else (None, nan/inf, int, NumPy
+                # scalars) goes through json.dumps
+                value = "%r"
+                args.append(arg)
+                checks.append(f"type({arg}) is float and {arg} - {arg} == 0.0")
+            template.append(f"{json.dumps(key).replace('%', '%%')}: {value}")
+        namespace["template"] = "{" + ", ".join(template) + "}"
+        fast = f"(template % ({', '.join(args)},)).encode(\"utf-8\")"
+
+    body = (
+        f"    if {' and '.join(checks)}:\n"
+        f"        return {fast}\n"
+        f"    return {fallback}\n"
+    )
+
+    source = (
+        "def build(temperature, serial_number=None, location=None, lat=None, lng=None, timestamp=None):\n"
+        "    if timestamp is None:\n"
+        "        timestamp = get_timestamp()\n"
+        f"{body}"
+    )
+    exec(source, namespace)
+    return namespace["build"]
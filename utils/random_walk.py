@@ -0,0 +1,193 @@
+import math
+import random
+import hashlib
+
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+TWO_PI = 2 * math.pi
+# SplitMix64 (counter based generator) constants
+MASK64 = (1 << 64) - 1
+GOLDEN64 = 0x9E3779B97F4A7C15
+MIX64_1 = 0xBF58476D1CE4E5B9
+MIX64_2 = 0x94D049BB133111EB
+
+
+def _round4(t: float) -> float:
+    # Same as numpy.round(t, 4): round half to even of t * 10^4
+    return round(t * 10000.0) / 10000.0
+
+
+def get_seed64(seed=None) -> int:
+    # 64 bits key of the counter based streams, random if no seed
+    if seed is None:
+        return random.SystemRandom().getrandbits(64)
+    return int.from_bytes(
+        hashlib.sha256(str(seed).encode("utf-8")).digest()[:8], "little"
+    )
+
+
+def mix64(z: int) -> int:
+    # SplitMix64 output of the counter `z`
+    z = (z + GOLDEN64) & MASK64
+    z = ((z ^ (z >> 30)) * MIX64_1) & MASK64
+    z = ((z ^ (z >> 27)) * MIX64_2) & MASK64
+    return z ^ (z >> 31)
+
+
+def _mix64_numpy(z):
+    # mix64() of a uint64 array (wrapping arithmetic)
+    z = z + np.uint64(GOLDEN64)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(MIX64_1)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(MIX64_2)
+    return z ^ (z >> np.uint64(31))
+
+
+class TemperatureWalk:
+    # Batch Gaussian random walk of the device temperatures. The initial
+    # temperatures are drawn from a seeded MT19937 stream (the NumPy generator
+    # is loaded with the state of random.Random). Each step of a device is
+    # drawn from its own counter based stream, SplitMix64 of (seed, device
+    # id, step count of the device), so the walk of every device is the same
+    # for a given seed whatever the order the devices are due in. Both
+    # backends use Box-Muller on the same uniforms, so the output is the same
+    # with or without NumPy for a given seed
+    def __init__(
+        self,
+        seed=None,
+        mu: float = 0,
+        sigma: float = 0.01,
+        use_numpy: bool = None,
+    ) -> None:
+        self.mu = mu
+        self.sigma = sigma
+        self._random = random.Random(seed)
+        self._seed64 = get_seed64(seed)
+        # Steps done per device (allocated by initial())
+        self._steps = None
+        if use_numpy is None:
+            use_numpy = np is not None
+        elif use_numpy and np is None:
+            raise ImportError("NumPy is not installed")
+        self.use_numpy = use_numpy
+        if self.use_numpy:
+            state = self._random.getstate()[1]
+            self._rng = np.random.RandomState()
+            self._rng.set_state(
+                (
+                    "MT19937",
+                    np.array(state[:624], dtype=np.uint32),
+                    state[624],
+                )
+            )
+
+    def _gauss(
+        self,
+        n: int,
+        mu: float,
+        sigma: float,
+    ):
+        if self.use_numpy:
+            u = self._rng.random_sample(2 * n)
+            z = np.sqrt(-2.0 * np.log(1.0 - u[0::2])) * np.cos(TWO_PI * u[1::2])
+            return np.round(z * sigma + mu, 4)
+        result = list()
+        rand = self._random.random
+        for _ in range(n):
+            u1 = rand()
+            u2 = rand()
+            z = math.sqrt(-2.0 * math.log(1.0 - u1)) * math.cos(TWO_PI * u2)
+            result.append(_round4(z * sigma + mu))
+        return result
+
+    def _step_gauss(
+        self,
+        ids: list,
+    ):
+        # One draw per device from its stream, counter (id << 32 | steps).
+        # The 64 bits output is split into the two uniforms of Box-Muller
+        mu = self.mu
+        sigma = self.sigma
+        if self.use_numpy:
+            steps = self._steps[ids]
+            self._steps[ids] = steps + np.uint64(1)
+            keys = np.uint64(self._seed64) + (
+                (ids.astype(np.uint64) << np.uint64(32)) | steps
+            )
+            z = _mix64_numpy(keys)
+            u1 = (z >> np.uint64(32)) * (1.0 / (1 << 32))
+            u2 = (z & np.uint64(0xFFFFFFFF)) * (1.0 / (1 << 32))
+            z = np.sqrt(-2.0 * np.log(1.0 - u1)) * np.cos(TWO_PI * u2)
+            return np.round(z * sigma + mu, 4)
+        result = list()
+        steps = self._steps
+        # mix64() inlined (hot loop), GOLDEN64 added to the key once
+        base = self._seed64 + GOLDEN64
+        sqrt, log, cos = math.sqrt, math.log, math.cos
+        scale = 1.0 / (1 << 32)
+        for _id in ids:
+            z = (base + ((_id << 32) | steps[_id])) & MASK64
+            steps[_id] += 1
+            z = ((z ^ (z >> 30)) * MIX64_1) & MASK64
+            z = ((z ^ (z >> 27)) * MIX64_2) & MASK64
+            z ^= z >> 31
+            z = sqrt(-2.0 * log(1.0 - (z >> 32) * scale)) * cos(
+                TWO_PI * (z & 0xFFFFFFFF) * scale
+            )
+            result.append(_round4(z * sigma + mu))
+        return result
+
+    def initial(
+        self,
+        temp_mus: list,
+        temp_sigma: float = 1,
+        fahrenheit: bool = False,
+    ):
+        if self.use_numpy:
+            self._steps = np.zeros(len(temp_mus), dtype=np.uint64)
+        else:
+            self._steps = array("Q", bytes(8 * len(temp_mus)))
+        if self.use_numpy:
+            result = self._gauss(len(temp_mus), 0, temp_sigma) + np.asarray(
+                temp_mus, dtype=np.float64
+            )
+            result = np.round(result, 4)
+            if fahrenheit:
+                result = result * 9 / 5 + 32
+            return result
+        result = array("d")
+        for temp_mu, delta in zip(
+            temp_mus, self._gauss(len(temp_mus), 0, temp_sigma)
+        ):
+            temperature = _round4(temp_mu + delta)
+            if fahrenheit:
+                temperature = temperature * 9 / 5 + 32
+            result.append(temperature)
+        return result
+
+    def step(
+        self,
+        temperatures,
+        ids: list,
+    ) -> list:
+        if not ids:
+            return list()
+        if self.use_numpy:
+            ids = np.asarray(ids, dtype=np.intp)
+            result = np.round(
+                temperatures[ids] + self._step_gauss(ids),
+                4,
+            )
+            temperatures[ids] = result
+            return result.tolist()
+        result = list()
+        for _id, delta in zip(ids, self._step_gauss(ids)):
+            temperature = _round4(temperatures[_id] + delta)
+            temperatures[_id] = temperature
+            result.append(temperature)
+        return result
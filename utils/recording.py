@@ -0,0 +1,116 @@
+import os
+import mmap
+import struct
+
+from utils.identity import SERIAL_NUMBER_BYTES
+
+
+# Header: magic, transport name, first device id (shard) and number of
+# devices, then the serial numbers (12 ASCII chars each). Then the records,
+# each one: nanoseconds since the recording started, device id, payload
+# length, offset and length of the timestamp in the payload (-1 if none) and
+# the payload (as sent), all little endian. Append only, a truncated last
+# record (e.g. process killed) is ignored
+MAGIC = b"IOTREC\x00\x01"
+HEADER = struct.Struct("<8s16sII")
+RECORD = struct.Struct("<QIIiH")
+SERIAL_NUMBER_LENGTH = SERIAL_NUMBER_BYTES * 2
+
+
+def get_recording_file(
+    recording_dir: str,
+    name: str,
+    first_id: int = 0,
+) -> str:
+    # One file per transport and shard
+    return os.path.join(recording_dir, f"{name}.{first_id}.rec")
+
+
+class RecordWriter:
+    # Writes the records of a simulator (see Simulator, RECORD_DIR)
+    def __init__(
+        self,
+        recording_file: str,
+        name: str,
+        serial_numbers: list,
+        first_id: int = 0,
+        buffer_size: int = 1 << 20,
+    ) -> None:
+        os.makedirs(os.path.dirname(recording_file) or ".", exist_ok=True)
+        self.recording_file = recording_file
+        self.records = 0
+        self._file = open(recording_file, "wb", buffering=buffer_size)
+        self._file.write(
+            HEADER.pack(MAGIC, name.encode("utf-8"), first_id, len(serial_numbers))
+        )
+        self._file.write("".join(serial_numbers).encode("ascii"))
+
+    def write(
+        self,
+        elapsed_ns: int,
+        _id: int,
+        payload: bytes,
+        timestamp: bytes = None,
+    ) -> None:
+        # `timestamp`: as formatted in the payload, rewritten on playback
+        offset = payload.find(timestamp) if timestamp else -1
+        self._file.write(
+            RECORD.pack(
+                elapsed_ns,
+                _id,
+                len(payload),
+                offset,
+                len(timestamp) if offset >= 0 else 0,
+            )
+        )
+        self._file.write(payload)
+        self.records += 1
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class Recording:
+    # Recording file memory mapped, records read in order as memoryview
+    # slices (no copy)
+    def __init__(
+        self,
+        recording_file: str,
+    ) -> None:
+        with open(recording_file, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, name, first_id, devices = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"Invalid recording file {recording_file}")
+        self.recording_file = recording_file
+        self.name = name.rstrip(b"\x00").decode("utf-8")
+        self.first_id = first_id
+        view = memoryview(self._mmap)
+        offset = HEADER.size + devices * SERIAL_NUMBER_LENGTH
+        serial_numbers = str(view[HEADER.size : offset], "ascii")
+        self.serial_numbers = [
+            serial_numbers[n : n + SERIAL_NUMBER_LENGTH]
+            for n in range(0, len(serial_numbers), SERIAL_NUMBER_LENGTH)
+        ]
+        self._view = view
+        self._start = offset
+
+    def __len__(self) -> int:
+        # Devices, as DeviceTable
+        return len(self.serial_numbers)
+
+    def records(self):
+        # (nanoseconds since the recording started, device id, payload,
+        # timestamp offset, timestamp length)
+        view = self._view
+        unpack_from = RECORD.unpack_from
+        size = RECORD.size
+        end = len(view)
+        offset = self._start
+        while offset + size <= end:
+            elapsed_ns, _id, length, ts_offset, ts_length = unpack_from(view, offset)
+            offset += size
+            if offset + length > end:
+                break
+            yield elapsed_ns, _id, view[offset : offset + length], ts_offset, ts_length
+            offset += length
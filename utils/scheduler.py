@@ -0,0 +1,269 @@
+import math
+import time
+import heapq
+import bisect
+import collections
+
+from array import array
+
+from utils import get_next_interval, telemetry
+from utils.random_walk import get_seed64, mix64
+
+
+class DeviceScheduler:
+    # Min-heap of (next fire time, device id): only due devices are popped
+    # and the main loop sleeps until the next one is due instead of polling.
+    # With a `seed` the intervals of each device are drawn from its own
+    # stream (SplitMix64 of seed, device id and interval count), so they are
+    # the same on every run
+    def __init__(
+        self,
+        min_interval_ms: int,
+        max_interval_ms: int,
+        retry_interval: float = 0.05,
+        max_sleep: float = 1,
+        seed: str = None,
+    ) -> None:
+        self.min_interval_ms = min_interval_ms
+        self.max_interval_ms = max_interval_ms
+        self.retry_interval = retry_interval
+        self.max_sleep = max_sleep
+        self._heap = list()
+        self._seed64 = None if seed is None else get_seed64(seed)
+        # Intervals drawn per device (seeded only)
+        self._counts = array("L")
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def add(
+        self,
+        _id: int,
+        next_fire: float = None,
+    ) -> None:
+        if next_fire is None:
+            next_fire = self._next_interval(_id)
+        heapq.heappush(self._heap, (next_fire, _id))
+
+    def _next_interval(
+        self,
+        _id: int,
+    ) -> float:
+        if self._seed64 is None:
+            return get_next_interval(
+                self.min_interval_ms,
+                self.max_interval_ms,
+            )
+        counts = self._counts
+        if _id >= len(counts):
+            counts.frombytes(bytes(counts.itemsize * (_id + 1 - len(counts))))
+        count = counts[_id]
+        counts[_id] = count + 1
+        span = self.max_interval_ms - self.min_interval_ms + 1
+        interval_ms = self.min_interval_ms + mix64(
+            self._seed64 + ((_id << 32) | count)
+        ) % span
+        return time.time() + interval_ms / 1000
+
+    def retry(
+        self,
+        _id: int,
+    ) -> None:
+        self.add(_id, time.time() + self.retry_interval)
+
+    def due(
+        self,
+        now: float = None,
+    ) -> list:
+        if now is None:
+            now = time.time()
+        result = list()
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            result.append(heapq.heappop(heap)[1])
+        return result
+
+    def next_in(
+        self,
+        now: float = None,
+        timeout: float = None,
+    ) -> float:
+        max_sleep = self.max_sleep if timeout is None else min(self.max_sleep, timeout)
+        if not self._heap:
+            return max_sleep
+        if now is None:
+            now = time.time()
+        return min(max_sleep, max(0, self._heap[0][0] - now))
+
+    def sleep(
+        self,
+        timeout: float = None,
+    ) -> None:
+        time.sleep(self.next_in(timeout=timeout))
+
+
+class RateProfile:
+    # Target rate (msgs/sec) over time: `rate` from the start, or reached
+    # after `ramp_seconds` (linear ramp from 0, or in `steps` equal steps),
+    # then held. Piecewise linear, so the intended start time of the k-th
+    # message is solved exactly (no drift)
+    def __init__(
+        self,
+        rate: float,
+        ramp_seconds: float = 0,
+        steps: int = 0,
+    ) -> None:
+        if rate <= 0:
+            raise ValueError(f"Invalid rate {rate}, it must be greater than 0")
+        self.target = rate
+        # (start, duration, start rate, end rate, messages before start)
+        self._segments = list()
+        start = 0
+        if ramp_seconds > 0 and steps > 0:
+            duration = ramp_seconds / steps
+            for n in range(steps):
+                self._add(start, duration, rate * (n + 1) / steps, rate * (n + 1) / steps)
+                start += duration
+        elif ramp_seconds > 0:
+            self._add(start, ramp_seconds, 0, rate)
+            start += ramp_seconds
+        self._add(start, math.inf, rate, rate)
+        self._starts = [segment[4] for segment in self._segments]
+
+    def _add(
+        self,
+        start: float,
+        duration: float,
+        start_rate: float,
+        end_rate: float,
+    ) -> None:
+        count = 0
+        if self._segments:
+            _start, _duration, _start_rate, _end_rate, _count = self._segments[-1]
+            count = _count + (_start_rate + _end_rate) / 2 * _duration
+        self._segments.append((start, duration, start_rate, end_rate, count))
+
+    def rate(
+        self,
+        elapsed: float,
+    ) -> float:
+        for start, duration, start_rate, end_rate, _ in self._segments:
+            if elapsed < start + duration:
+                return start_rate + (end_rate - start_rate) * max(0, elapsed - start) / duration
+        return self.target
+
+    def intended(
+        self,
+        k: int,
+    ) -> float:
+        # Seconds since the start when the k-th message (from 0) is due
+        n = bisect.bisect_right(self._starts, k) - 1
+        start, duration, start_rate, end_rate, count = self._segments[n]
+        k -= count
+        if start_rate == end_rate:
+            return start + k / start_rate
+        # k = start_rate * s + slope * s^2 / 2
+        slope = (end_rate - start_rate) / duration
+        return start + (math.sqrt(start_rate**2 + 2 * slope * k) - start_rate) / slope
+
+
+class RateScheduler:
+    # Open loop: the messages are due at their intended start times (see
+    # RateProfile), not when the previous ones were sent, devices taken
+    # round robin. How late each one is taken for sending (schedule lag,
+    # stalls included: no coordinated omission) goes to the telemetry.
+    # Same interface as DeviceScheduler
+    def __init__(
+        self,
+        rate: float,
+        devices: int,
+        ramp_seconds: float = 0,
+        steps: int = 0,
+        max_batch: int = 10000,
+        retry_interval: float = 0.05,
+        max_sleep: float = 1,
+    ) -> None:
+        self.profile = RateProfile(rate, ramp_seconds=ramp_seconds, steps=steps)
+        self.devices = devices
+        self.max_batch = max(1, max_batch)
+        self.retry_interval = retry_interval
+        self.max_sleep = max_sleep
+        # Set when first used (not while the simulator is set up)
+        self._started = None
+        self._next = 0
+        self._cursor = 0
+        # Due again after `retry_interval`, as late as they already were
+        self._retries = collections.deque()
+        self._intended = dict()
+
+    def __len__(self) -> int:
+        return self.devices
+
+    def add(
+        self,
+        _id: int,
+        next_fire: float = None,
+    ) -> None:
+        # Paced by the rate, not per device
+        pass
+
+    def retry(
+        self,
+        _id: int,
+    ) -> None:
+        now = time.monotonic()
+        self._retries.append(
+            (now + self.retry_interval, self._intended.get(_id, now), _id)
+        )
+
+    def _start(
+        self,
+        now: float,
+    ) -> float:
+        if self._started is None:
+            self._started = now
+        return self._started
+
+    def rate(self) -> float:
+        now = time.monotonic()
+        return self.profile.rate(now - self._start(now))
+
+    def due(
+        self,
+        now: float = None,
+    ) -> list:
+        if now is None:
+            now = time.monotonic()
+        # Each device once per batch at most
+        limit = min(self.max_batch, self.devices)
+        intended = dict()
+        retries = self._retries
+        while retries and retries[0][0] <= now and len(intended) < limit:
+            _, start, _id = retries.popleft()
+            intended[_id] = start
+        started = self._start(now)
+        profile = self.profile
+        while len(intended) < limit:
+            start = started + profile.intended(self._next)
+            if start > now or self._cursor in intended:
+                break
+            intended[self._cursor] = start
+            self._next += 1
+            self._cursor = (self._cursor + 1) % self.devices
+        for start in intended.values():
+            telemetry.lag(now - start)
+        self._intended = intended
+        return list(intended)
+
+    def next_in(
+        self,
+        now: float = None,
+        timeout: float = None,
+    ) -> float:
+        max_sleep = self.max_sleep if timeout is None else min(self.max_sleep, timeout)
+        if now is None:
+            now = time.monotonic()
+        start = self._start(now) + self.profile.intended(self._next)
+        if self._retries:
+            start = min(start, self._retries[0][0])
+        return min(max_sleep, max(0, start - now))
@@ -0,0 +1,77 @@
+import json
+import codecs
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+# In order of preference
+JSON_BACKENDS = (
+    "orjson",
+    "msgspec",
+    "json",
+)
+
+
+def get_json_backend(backend: str = None) -> str:
+    # First backend installed if not set
+    available = {
+        "orjson": orjson is not None,
+        "msgspec": msgspec is not None,
+        "json": True,
+    }
+    if backend is None:
+        return next(name for name in JSON_BACKENDS if available[name])
+    if backend not in available:
+        raise ValueError(
+            f"Invalid JSON backend '{backend}', it must be one of: {', '.join(JSON_BACKENDS)}"
+        )
+    if not available[backend]:
+        raise ImportError(f"JSON backend '{backend}' is not installed")
+    return backend
+
+
+class JSONValidator:
+    # Checks the payload is a JSON object holding all `required_keys`, the
+    # payload is parsed but not re-serialised so the original bytes can be
+    # written through
+    def __init__(
+        self,
+        required_keys: tuple = tuple(),
+        backend: str = None,
+        encoding: str = "utf-8",
+    ) -> None:
+        self.required_keys = frozenset(required_keys)
+        self.backend = get_json_backend(backend)
+        if self.backend == "orjson":
+            self._loads = orjson.loads
+        elif self.backend == "msgspec":
+            self._loads = msgspec.json.Decoder().decode
+        else:
+            self._loads = json.loads
+        # Bytes are parsed as is when UTF-8, otherwise decoded first
+        self.encoding = None if codecs.lookup(encoding).name == "utf-8" else encoding
+
+    def __call__(
+        self,
+        data: bytes,
+    ) -> dict:
+        try:
+            if self.encoding is not None:
+                data = data.decode(self.encoding)
+            payload = self._loads(data)
+        except Exception as err:
+            raise ValueError(f"Invalid payload, not JSON: {err}")
+        if not isinstance(payload, dict):
+            raise ValueError("Invalid payload, not a JSON object")
+        if not self.required_keys.issubset(payload):
+            missing = ", ".join(sorted(self.required_keys.difference(payload)))
+            raise ValueError(f"Invalid payload, missing keys: {missing}")
+        return payload